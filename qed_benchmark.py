@@ -0,0 +1,510 @@
+r"""Benchmarks of qed_eval on synthetic data of scalable size.
+
+Writes synthetic annotation and prediction jsonl files at multiples of the size
+of qed-dev, times the loading, normalization and scoring functions of qed_eval
+on them, and writes the timings to a JSON file so that they can be compared
+across revisions:
+
+   python qed_benchmark.py \
+     --scales=1,10,100 \
+     --output=qed_benchmark.json
+
+Besides the default code paths, the benchmarks time the alternatives they are
+meant to be faster than, i.e. scoring in one process, pure Python non-strict
+scoring, plain Entity objects, the original normalize_text, parsing instead of
+reading the cache and parsing in one process. The ratios of these are logged
+and stored as "ratios" in the output file.
+
+Synthetic examples are made of random words with the shape of qed-dev: a
+lowercase question, a paragraph of sentences with one selected sentence, and
+referential equalities between spans of the question and the selected sentence,
+some of which are bridged. Predictions are copies of the annotations whose
+mentions and answers are shifted, replaced or dropped at the given noise rate.
+"""
+
+import copy
+import functools
+import json
+import os
+import platform
+import random
+import re
+import string
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Mapping, Optional, Text, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+
+import qed_core
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+    'scales', ['1', '10', '100'],
+    'Sizes of the synthetic files to benchmark on, as multiples of the number '
+    'of examples in qed-dev.')
+flags.DEFINE_string('output', 'qed_benchmark.json',
+                    'Path of the JSON file the results are written to.')
+flags.DEFINE_string(
+    'data_dir', None,
+    'Directory to write the synthetic files to. Defaults to a temporary '
+    'directory that is deleted afterwards.')
+flags.DEFINE_integer('repeats', 3,
+                     'Number of runs of each benchmark; the fastest counts.')
+flags.DEFINE_integer(
+    'parallel_workers', os.cpu_count() or 1,
+    'Number of processes of the num_workers benchmarks.')
+flags.DEFINE_integer('min_mentions', 1,
+                     'Minimum number of referential equalities per example.')
+flags.DEFINE_integer('max_mentions', 2,
+                     'Maximum number of referential equalities per example.')
+flags.DEFINE_float(
+    'bridging_rate', 0.14,
+    'Fraction of referential equalities whose context entity is bridged, '
+    'i.e. has -1 offsets.')
+flags.DEFINE_float(
+    'noise', 0.1,
+    'Probability that a predicted mention or answer differs from the '
+    'annotated one.')
+flags.DEFINE_integer('seed', 0, 'Seed of the synthetic data.')
+
+# Number of lines of qed-dev.jsonlines, the unit of the scales.
+DEV_SIZE = 1355
+
+# Explanation types and their frequencies in qed-dev.
+EXPLANATION_TYPES = (('single_sentence', 0.75), ('multi_sentence', 0.14),
+                     ('none', 0.11))
+
+VOCABULARY_SIZE = 20000
+_FUNCTION_WORDS = ('the', 'a', 'an', 'of', 'in', 'and', 'to', 'was', 'is',
+                   'for', 'on', 'by', 'with', 'as')
+_PUNCTUATION_WORDS = (',', '--', '(', ')', "'s", '%', ':')
+_BRIDGES = ('of', 'in', 'on', 'for')
+
+# Pairs of (benchmark, faster or smaller alternative) whose ratios are reported.
+RATIOS = (
+    ('compute_scores_strict', 'compute_scores_strict_workers'),
+    ('compute_scores_non_strict', 'compute_scores_non_strict_workers'),
+    ('score_example_loop_non_strict', 'compute_scores_non_strict'),
+    ('compute_scores_strict', 'compute_scores_strict_compact'),
+    ('normalize_text_reference', 'normalize_text'),
+    ('normalize_text_reference', 'normalize_batch'),
+    ('load_data', 'load_data_cached'),
+    ('load_data', 'load_data_workers'),
+    ('load_data_bytes', 'load_data_compact_bytes'),
+)
+
+
+def _random_words(rng: random.Random, num_words: int) -> List[Text]:
+  """Draws words with a long-tailed distribution, like entity names."""
+  words = []
+  for _ in range(num_words):
+    draw = rng.random()
+    if draw < 0.2:
+      words.append(rng.choice(_FUNCTION_WORDS))
+    elif draw < 0.25:
+      words.append(rng.choice(_PUNCTUATION_WORDS))
+    else:
+      word = 'w%d' % min(int(rng.paretovariate(0.8)), VOCABULARY_SIZE)
+      words.append(word.capitalize() if draw > 0.85 else word)
+  return words
+
+
+def _word_starts(words: List[Text]) -> List[int]:
+  """Char offsets of words in ' '.join(words), with the end as last entry."""
+  starts = [0]
+  for word in words:
+    starts.append(starts[-1] + len(word) + 1)
+  starts[-1] -= 1
+  return starts
+
+
+def _reference(text: Text, start: int, end: int) -> Dict[Text, Any]:
+  return {'start': start, 'end': end, 'string': text[start:end]}
+
+
+def _random_span(rng: random.Random, starts: List[int], first: int,
+                 last: int, max_words: int) -> Tuple[int, int]:
+  """Char offsets of a random run of words among words first to last - 1."""
+  begin = rng.randrange(first, last)
+  stop = min(last, begin + rng.randint(1, max_words))
+  # Word ends are one char before the start of the next word.
+  return starts[begin], starts[stop] - (1 if stop < len(starts) - 1 else 0)
+
+
+def generate_example(rng: random.Random, example_id: int, min_mentions: int,
+                     max_mentions: int, bridging_rate: float) -> Dict[Text, Any]:
+  """Generates a synthetic annotated example in the jsonl format of qed-dev.
+
+  Args:
+    rng: random generator.
+    example_id: the example_id of the example.
+    min_mentions: minimum number of referential equalities.
+    max_mentions: maximum number of referential equalities.
+    bridging_rate: probability that a context entity is bridged.
+
+  Returns:
+    The parsed json line.
+  """
+  question_words = [w.lower() for w in _random_words(rng, rng.randint(6, 12))]
+  question_text = ' '.join(question_words)
+  question_starts = _word_starts(question_words)
+  words, sentence_starts = [], []
+  for _ in range(rng.randint(4, 8)):
+    sentence_starts.append(len(words))
+    words.extend(_random_words(rng, rng.randint(10, 30)) + ['.'])
+  paragraph_text = ' '.join(words)
+  starts = _word_starts(words)
+  selected = rng.randrange(len(sentence_starts))
+  first = sentence_starts[selected]
+  last = (sentence_starts[selected + 1]
+          if selected + 1 < len(sentence_starts) else len(words))
+
+  referential_equalities = []
+  for _ in range(rng.randint(min_mentions, max_mentions)):
+    question_reference = _reference(
+        question_text,
+        *_random_span(rng, question_starts, 0, len(question_words), 4))
+    if rng.random() < bridging_rate:
+      sentence_reference = {
+          'start': -1, 'end': -1, 'bridge': rng.choice(_BRIDGES), 'string': ''
+      }
+    else:
+      sentence_reference = _reference(
+          paragraph_text, *_random_span(rng, starts, first, last - 1, 4))
+      sentence_reference['bridge'] = False
+    referential_equalities.append({
+        'question_reference': question_reference,
+        'sentence_reference': sentence_reference
+    })
+  answer_span = _random_span(rng, starts, first, last - 1, 5)
+  nq_answers = [[_reference(paragraph_text, *answer_span)]]
+  if rng.random() < 0.5:
+    nq_answers.append([
+        _reference(paragraph_text, answer_span[0],
+                   min(len(paragraph_text), answer_span[1] + 10))
+    ])
+  answer_reference = _reference(paragraph_text, *answer_span)
+  explanation_type = rng.choices(
+      [t for t, _ in EXPLANATION_TYPES],
+      weights=[w for _, w in EXPLANATION_TYPES])[0]
+  return {
+      'example_id': example_id,
+      'title_text': ' '.join(_random_words(rng, 3)),
+      'question_text': question_text,
+      'paragraph_text': paragraph_text,
+      'sentence_starts': [starts[i] for i in sentence_starts],
+      'original_nq_answers': nq_answers,
+      'annotation': {
+          'referential_equalities': referential_equalities,
+          'answer': [{
+              'sentence_reference': dict(answer_reference, bridge=False),
+              'paragraph_reference': answer_reference
+          }],
+          'explanation_type': explanation_type,
+          'selected_sentence': _reference(paragraph_text, starts[first],
+                                          starts[last - 1] + 2),
+      }
+  }
+
+
+def _perturbed_reference(rng: random.Random, text: Text,
+                         reference: Mapping[Text, Any]) -> Dict[Text, Any]:
+  """Moves the end of a reference by a word, or to a random span."""
+  starts = _word_starts(text.split(' '))
+  if rng.random() < 0.5:
+    return dict(
+        reference,
+        **_reference(text, *_random_span(rng, starts, 0, len(starts) - 1, 4)))
+  start, end = reference['start'], reference['end']
+  if rng.random() < 0.5 and end < len(text):
+    end = text.find(' ', end + 1)
+    end = len(text) if end == -1 else end
+  elif ' ' in text[start:end]:
+    end = text.rindex(' ', start, end)
+  return dict(reference, **_reference(text, start, end))
+
+
+def perturb_example(rng: random.Random, example: Mapping[Text, Any],
+                    noise: float) -> Dict[Text, Any]:
+  """Returns a prediction of example with mistakes at the given rate.
+
+  Args:
+    rng: random generator.
+    example: an example of generate_example.
+    noise: probability that each mention and the answer are changed, by moving
+      its end by a word, replacing it with a random span or, for referential
+      equalities, dropping it.
+
+  Returns:
+    The predicted example.
+  """
+  prediction = copy.deepcopy(example)
+  annotation = prediction['annotation']
+  referential_equalities = []
+  for equality in annotation['referential_equalities']:
+    if rng.random() < noise:
+      draw = rng.random()
+      if draw < 0.2:
+        continue
+      elif draw < 0.6:
+        equality['question_reference'] = _perturbed_reference(
+            rng, example['question_text'], equality['question_reference'])
+      elif equality['sentence_reference']['start'] != -1:
+        equality['sentence_reference'] = _perturbed_reference(
+            rng, example['paragraph_text'], equality['sentence_reference'])
+    referential_equalities.append(equality)
+  annotation['referential_equalities'] = referential_equalities
+  if rng.random() < noise:
+    answer = annotation['answer'][0]
+    answer['paragraph_reference'] = _perturbed_reference(
+        rng, example['paragraph_text'], answer['paragraph_reference'])
+  return prediction
+
+
+def write_dataset(annotation_fname: Text,
+                  prediction_fname: Text,
+                  num_examples: int,
+                  min_mentions: int = 1,
+                  max_mentions: int = 2,
+                  bridging_rate: float = 0.14,
+                  noise: float = 0.1,
+                  seed: int = 0) -> None:
+  """Writes synthetic annotation and prediction jsonl files.
+
+  Args:
+    annotation_fname: path of the annotation file.
+    prediction_fname: path of the prediction file, which predicts every
+      example of the annotation file.
+    num_examples: number of lines of each file.
+    min_mentions: minimum number of referential equalities per example.
+    max_mentions: maximum number of referential equalities per example.
+    bridging_rate: probability that a context entity is bridged.
+    noise: probability that a predicted mention or answer differs from the
+      annotated one.
+    seed: seed of the generator.
+  """
+  rng = random.Random(seed)
+  example_ids = set()
+  with open(annotation_fname, 'w') as annotation_file, open(
+      prediction_fname, 'w') as prediction_file:
+    while len(example_ids) < num_examples:
+      example_id = rng.randrange(-2**63, 2**63)
+      if example_id in example_ids:
+        continue
+      example_ids.add(example_id)
+      example = generate_example(rng, example_id, min_mentions, max_mentions,
+                                 bridging_rate)
+      annotation_file.write(json.dumps(example) + '\n')
+      prediction_file.write(
+          json.dumps(perturb_example(rng, example, noise)) + '\n')
+
+
+def reference_normalize_text(text: Text) -> Text:
+  """The original normalize_text, which qed_core.normalize_text replaced."""
+  text = text.lower()
+  to_replace = set(string.punctuation)
+  text = ''.join('' if ch in to_replace else ch for ch in text)
+  text = re.sub(r'\b(a|an|the)\b', ' ', text)
+  return ' '.join(text.split())
+
+
+def _mention_texts(fname: Text) -> List[Text]:
+  """All texts that loading fname normalizes, in load order."""
+  texts = []
+  with open(fname) as f:
+    for line in f:
+      elem = json.loads(line)
+      for answer in elem['annotation'].get('answer', []):
+        texts.append(answer['paragraph_reference']['string'])
+      for answer in elem['original_nq_answers']:
+        texts.extend(a['string'] for a in answer)
+      for equality in elem['annotation'].get('referential_equalities', []):
+        texts.append(equality['question_reference']['string'])
+        if equality['sentence_reference']['start'] != -1:
+          texts.append(equality['sentence_reference']['string'])
+  return texts
+
+
+def _best_time(function: Callable[[], Any], repeats: int,
+               setup: Optional[Callable[[], Any]] = None) -> float:
+  """Fastest wall time of repeats calls of function, after setup if given."""
+  times = []
+  for _ in range(repeats):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+def _score_pairs(function: Callable[..., Any],
+                 pairs: List[Tuple[Any, Any]], strict: bool) -> List[Any]:
+  """Calls function(annotation, prediction, strict) on each pair."""
+  return [function(annotation, prediction, strict)
+          for annotation, prediction in pairs]
+
+
+def _memory(function: Callable[[], Any]) -> Tuple[int, int]:
+  """Bytes allocated by Python for the result of function, and at the peak."""
+  tracemalloc.start()
+  try:
+    result = function()  # pylint: disable=unused-variable
+    return tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+
+
+def run_benchmarks(annotation_fname: Text,
+                   prediction_fname: Text,
+                   num_workers: int,
+                   repeats: int = 3) -> Dict[Text, Any]:
+  """Times qed_eval on an annotation and a prediction file.
+
+  Args:
+    annotation_fname: path of the annotation file.
+    prediction_fname: path of the prediction file.
+    num_workers: number of processes of the parallel benchmarks.
+    repeats: number of runs of each benchmark; the fastest counts.
+
+  Returns:
+    Dict from benchmark name to its time in seconds, except for the "*_bytes"
+    entries, which hold the memory used by the loaded examples and the
+    "*_peak_bytes" entries, which hold the peak memory while loading them.
+  """
+  results = {}
+
+  def time_it(name, function, setup=None):
+    results[name] = _best_time(function, repeats, setup)
+    logging.info('%s: %.4fs', name, results[name])
+
+  time_it('load_data', lambda: qed_core.load_data(annotation_fname))
+  time_it('load_data_compact',
+          lambda: qed_core.load_data(annotation_fname, compact=True))
+  time_it('load_data_workers',
+          lambda: qed_core.load_data(annotation_fname, num_workers=num_workers))
+  cache_fname = annotation_fname + qed_core.CACHE_SUFFIX
+  if os.path.exists(cache_fname):
+    os.remove(cache_fname)
+  qed_core.load_data(annotation_fname, use_cache=True)  # Writes the cache.
+  time_it('load_data_cached',
+          lambda: qed_core.load_data(annotation_fname, use_cache=True))
+  for name, compact in (('load_data', False), ('load_data_compact', True)):
+    results[name + '_bytes'], results[name + '_peak_bytes'] = _memory(
+        functools.partial(qed_core.load_data, annotation_fname,
+                          compact=compact))
+    logging.info('%s: %d bytes, %d at the peak', name, results[name + '_bytes'],
+                 results[name + '_peak_bytes'])
+
+  texts = _mention_texts(annotation_fname) + _mention_texts(prediction_fname)
+  time_it('normalize_text_reference',
+          lambda: [reference_normalize_text(text) for text in texts])
+  time_it('normalize_text',
+          lambda: [qed_core.normalize_text(text) for text in texts],
+          setup=qed_core.normalize_text.cache_clear)
+  time_it('normalize_batch', lambda: qed_core.normalize_batch(texts))
+
+  annotation_dict = qed_core.load_data(annotation_fname)
+  prediction_dict = qed_core.load_data(prediction_fname)
+  compact_annotation_dict = qed_core.load_data(annotation_fname, compact=True)
+  compact_prediction_dict = qed_core.load_data(prediction_fname, compact=True)
+  pairs = [(annotation, prediction_dict[example_id])
+           for example_id, annotation in annotation_dict.items()
+           if example_id in prediction_dict]
+  for strict, mode in ((True, 'strict'), (False, 'non_strict')):
+    time_it(
+        'compute_scores_' + mode,
+        functools.partial(qed_core.compute_scores, annotation_dict,
+                          prediction_dict, strict))
+    time_it(
+        'compute_scores_%s_compact' % mode,
+        functools.partial(qed_core.compute_scores, compact_annotation_dict,
+                          compact_prediction_dict, strict))
+    time_it(
+        'compute_scores_%s_workers' % mode,
+        functools.partial(qed_core.compute_scores, annotation_dict,
+                          prediction_dict, strict, num_workers))
+    time_it(
+        'compute_answer_accuracy_' + mode,
+        functools.partial(_score_pairs, qed_core.compute_answer_accuracy,
+                          pairs, strict))
+  # Pure Python non-strict scoring, which compute_scores replaces with
+  # qed_vectorized when NumPy is installed.
+  time_it(
+      'score_example_loop_non_strict',
+      functools.partial(_score_pairs, qed_core.score_example, pairs, False))
+  return results
+
+
+def ratios(results: Mapping[Text, float]) -> Dict[Text, float]:
+  """Ratios of the RATIOS pairs, keyed by 'slower/faster'."""
+  return {
+      '%s/%s' % (slower, faster): results[slower] / results[faster]
+      for slower, faster in RATIOS
+      if results.get(faster)
+  }
+
+
+def _environment() -> Dict[Text, Any]:
+  try:
+    import numpy  # pylint: disable=g-import-not-at-top
+    numpy_version = numpy.__version__
+  except ImportError:
+    numpy_version = None
+  return {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'numpy': numpy_version,
+  }
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  with tempfile.TemporaryDirectory() as tmpdir:
+    data_dir = FLAGS.data_dir or tmpdir
+    report = {
+        'timestamp': time.time(),
+        'environment': _environment(),
+        'config': {
+            name: FLAGS[name].value for name in
+            ('repeats', 'parallel_workers', 'min_mentions', 'max_mentions',
+             'bridging_rate', 'noise', 'seed')
+        },
+        'runs': [],
+    }
+    for scale in FLAGS.scales:
+      num_examples = int(float(scale) * DEV_SIZE)
+      annotation_fname = os.path.join(data_dir,
+                                      'synthetic-%sx.jsonlines' % scale)
+      prediction_fname = os.path.join(
+          data_dir, 'synthetic-%sx-prediction.jsonlines' % scale)
+      logging.info('Writing %d synthetic examples to %s.', num_examples,
+                   annotation_fname)
+      write_dataset(annotation_fname, prediction_fname, num_examples,
+                    FLAGS.min_mentions, FLAGS.max_mentions,
+                    FLAGS.bridging_rate, FLAGS.noise, FLAGS.seed)
+      results = run_benchmarks(annotation_fname, prediction_fname,
+                               FLAGS.parallel_workers, FLAGS.repeats)
+      run_ratios = ratios(results)
+      for name, ratio in run_ratios.items():
+        logging.info('%sx ratio %s: %.2f', scale, name, ratio)
+      report['runs'].append({
+          'scale': float(scale),
+          'num_examples': num_examples,
+          'results': results,
+          'ratios': run_ratios,
+      })
+  with open(FLAGS.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  logging.info('Wrote benchmark results to %s.', FLAGS.output)
+
+
+if __name__ == '__main__':
+  app.run(main)
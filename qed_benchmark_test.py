@@ -0,0 +1,86 @@
+"""Tests for qed_benchmark."""
+
+import json
+import os
+import tempfile
+
+import qed_benchmark
+import qed_eval
+from absl.testing import absltest
+
+
+class QedBenchmarkTest(absltest.TestCase):
+
+  def write_dataset(self, num_examples=200, **kwargs):
+    tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    annotation_path = os.path.join(tmpdir, "annotation.jsonlines")
+    prediction_path = os.path.join(tmpdir, "prediction.jsonlines")
+    qed_benchmark.write_dataset(annotation_path, prediction_path, num_examples,
+                                **kwargs)
+    return annotation_path, prediction_path
+
+  def test_generated_examples_load(self):
+    annotation_path, prediction_path = self.write_dataset(
+        min_mentions=1, max_mentions=5, noise=0.0)
+    with open(annotation_path) as f:
+      lines = [json.loads(line) for line in f]
+    self.assertLen(lines, 200)
+    self.assertLen({line["example_id"] for line in lines}, 200)
+    single_sentence = [
+        line for line in lines
+        if line["annotation"]["explanation_type"] == "single_sentence"
+    ]
+    # No example is skipped as incorrectly formatted.
+    annotation_dict = qed_eval.load_data(annotation_path)
+    self.assertLen(annotation_dict, len(single_sentence))
+    self.assertEqual(
+        {len(example.aligned_nps) for example in annotation_dict.values()},
+        {1, 2, 3, 4, 5})
+    score_dict = qed_eval.compute_scores(
+        annotation_dict, qed_eval.load_data(prediction_path), strict=True)
+    self.assertEqual(score_dict["exact_match_accuracy"], 1.0)
+    self.assertEqual(score_dict["answer_accuracy"], 1.0)
+
+  def test_bridging_rate(self):
+    for bridging_rate in (0.0, 1.0):
+      annotation_path, _ = self.write_dataset(bridging_rate=bridging_rate)
+      starts = {
+          c.start_offset
+          for example in qed_eval.load_data(annotation_path).values()
+          for _, c in example.aligned_nps
+      }
+      if bridging_rate:
+        self.assertEqual(starts, {-1})
+      else:
+        self.assertNotIn(-1, starts)
+
+  def test_noise(self):
+    annotation_path, prediction_path = self.write_dataset(noise=0.5)
+    annotation_dict = qed_eval.load_data(annotation_path)
+    prediction_dict = qed_eval.load_data(prediction_path)
+    self.assertEqual(set(prediction_dict), set(annotation_dict))
+    for strict in (True, False):
+      score_dict = qed_eval.compute_scores(annotation_dict, prediction_dict,
+                                           strict)
+      self.assertBetween(score_dict["pair"][2], 0.3, 0.9)
+      self.assertBetween(score_dict["answer_accuracy"], 0.3, 0.9)
+
+  def test_reference_normalize_text(self):
+    annotation_path, prediction_path = self.write_dataset()
+    for fname in (annotation_path, prediction_path):
+      for text in qed_benchmark._mention_texts(fname):
+        self.assertEqual(qed_eval.normalize_text(text),
+                         qed_benchmark.reference_normalize_text(text))
+
+  def test_run_benchmarks(self):
+    annotation_path, prediction_path = self.write_dataset(num_examples=50)
+    results = qed_benchmark.run_benchmarks(
+        annotation_path, prediction_path, num_workers=2, repeats=1)
+    for slower, faster in qed_benchmark.RATIOS:
+      self.assertGreater(results[slower], 0)
+      self.assertGreater(results[faster], 0)
+    self.assertLen(qed_benchmark.ratios(results), len(qed_benchmark.RATIOS))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,2900 @@
+r"""Loading and scoring of QED examples, without the command line interface.
+
+This module holds everything qed_eval does except flag parsing: loading jsonl
+files into QEDExamples, scoring predictions against annotations and the
+incremental, streaming, asynchronous and multi-system variants of scoring. See
+the qed_eval module docstring for the file format and the score dict.
+
+It only imports the standard library, and modules that only some runs need
+(NumPy, process pools, mmap, hashlib, tracemalloc, decompression) are imported
+where they are used. That keeps the import cheap for short-lived jobs and for
+worker processes, which import this module rather than qed_eval, and it
+registers no flags. qed_eval re-exports all of its names.
+"""
+
+import array
+import bisect
+import collections.abc
+import contextlib
+import dataclasses
+import functools
+import heapq
+import importlib
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import string
+import struct
+import sys
+import time
+from typing import (IO, Any, Callable, Collection, Dict, FrozenSet, Iterable,
+                    Iterator, List, Mapping, MutableMapping, Optional,
+                    Sequence, Set, Text, Tuple, Union)
+
+MIN_F1_FOR_NON_STRICT_OVERLAP = 0.9
+
+# Examples with at most this many (annotated, predicted) mention or alignment
+# pairs compare all of them, which is faster than indexing the predictions for
+# the few mentions of QED.
+MAX_PAIRS_WITHOUT_INDEX = 16
+
+# Number of distinct texts whose normalization is memoized. Mention strings
+# such as titles and entity names repeat a lot across examples.
+NORMALIZE_CACHE_SIZE = 1 << 16
+
+# Entity types, indexed by the type codes used in packed entity keys.
+ENTITY_TYPES = ('question', 'context')
+ENTITY_TYPE_CODES = {
+    entity_type: i for i, entity_type in enumerate(ENTITY_TYPES)
+}
+# Entity offsets must be below this to fit in a packed entity key.
+MAX_OFFSET = 1 << 30
+_KEY_START_SHIFT = 33
+
+# Suffix and format version of the binary caches written by load_data. Bump the
+# version whenever loading or normalization changes.
+CACHE_SUFFIX = '.qedcache'
+CACHE_VERSION = 1
+_CACHE_MAGIC = b'QEDC'
+# magic, version, source digest, byte order, number of entities, strings,
+# string bytes, examples and NQ answers.
+_CACHE_HEADER = struct.Struct('<4sI32s8s5q')
+
+# Suffix and format version of the example_id indexes written by load_index.
+INDEX_SUFFIX = '.qedindex'
+INDEX_VERSION = 1
+_INDEX_MAGIC = b'QEDI'
+# magic, version, byte order, size and modification time of the indexed file,
+# number of indexed lines.
+_INDEX_HEADER = struct.Struct('<4sI8s3q')
+
+# Suffix and format version of the reports written by write_validation_report.
+VALIDATION_SUFFIX = '.qedvalidation'
+VALIDATION_VERSION = 1
+
+# Number of shards handed to each worker when scoring with num_workers > 1.
+SHARDS_PER_WORKER = 4
+
+# Number of sorted runs that an external sort merges at once. More runs are
+# first merged into fewer, longer runs, to bound the number of open files.
+MAX_MERGE_RUNS = 64
+
+# Modules that decompress jsonl files with these suffixes.
+COMPRESSION_MODULES = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma'}
+
+# Keys of the score dict, in the order of the qed_eval module docstring.
+SCORE_NAMES = ('exact_match_accuracy', 'question_mention', 'context_mention',
+               'all_mention', 'pair', 'answer_accuracy')
+
+
+# Functions that are timed while instrumented, see instrumented().
+_TIMED_FUNCTIONS = ('load_data', 'read_cache', 'write_cache', 'load_index',
+                    'validate_file', 'load_single_line',
+                    'load_aligned_entities', 'normalize_text',
+                    'normalize_batch', 'compute_multi_scores')
+# Functions that are timed and whose score dicts get the instrumentation
+# report while instrumented.
+_REPORTING_FUNCTIONS = ('compute_scores',)
+# Functions whose calls are counted while instrumented, and their counters.
+_COUNTED_FUNCTIONS = {'overlap': 'overlap_comparisons'}
+
+
+class Instrumentation:
+  """Wall and CPU time per phase and counters of an evaluation run.
+
+  Phases nest. For instance normalize_text runs within load_aligned_entities,
+  which runs within load_single_line and load_data, so the time of an inner
+  phase is also part of the outer ones.
+
+  Only work done in this process is timed and counted, except for the parse
+  counters, which worker processes report back. With num_workers > 1 the time
+  spent in workers only shows up in the load_data and compute_scores phases.
+  """
+
+  def __init__(self, track_memory: bool = False):
+    # Wall seconds, CPU seconds and number of calls of each phase.
+    self.timings = collections.defaultdict(lambda: [0.0, 0.0, 0])
+    self.counters = collections.Counter()
+    self.track_memory = track_memory
+    self.peak_memory = 0
+
+  def timed(self, name: Text,
+            function: Callable[..., Any]) -> Callable[..., Any]:
+    """Wraps function so that its calls are timed as the phase name."""
+    timing = self.timings[name]
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      wall, cpu = time.perf_counter(), time.process_time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        timing[0] += time.perf_counter() - wall
+        timing[1] += time.process_time() - cpu
+        timing[2] += 1
+
+    return wrapper
+
+  def counted(self, name: Text,
+              function: Callable[..., Any]) -> Callable[..., Any]:
+    """Wraps function so that its calls are counted at the counter name."""
+    counters = self.counters
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      counters[name] += 1
+      return function(*args, **kwargs)
+
+    return wrapper
+
+  def reporting(self, name: Text,
+                function: Callable[..., Any]) -> Callable[..., Any]:
+    """Like timed, but also adds report() to the returned score dicts."""
+    timed = self.timed(name, function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      return dict(timed(*args, **kwargs), **self.report())
+
+    return wrapper
+
+  def report(self) -> Mapping[Text, Any]:
+    """Returns the 'timings' and 'counters' sections of the score dict.
+
+    Timings map each phase that ran to its total wall and CPU seconds and its
+    number of calls. With
+    track_memory, a 'peak_memory_bytes' entry holds the peak memory allocated
+    by Python so far.
+    """
+    report = {
+        'timings': {
+            name: {'wall_seconds': wall, 'cpu_seconds': cpu, 'calls': calls}
+            for name, (wall, cpu, calls) in sorted(self.timings.items())
+            if calls
+        },
+        'counters': dict(sorted(self.counters.items())),
+    }
+    if self.track_memory:
+      import tracemalloc  # pylint: disable=g-import-not-at-top
+      if tracemalloc.is_tracing():
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+      report['peak_memory_bytes'] = self.peak_memory
+    return report
+
+
+_instrumentation = None  # type: Optional[Instrumentation]
+
+
+@contextlib.contextmanager
+def instrumented(track_memory: bool = False) -> Iterator[Instrumentation]:
+  """Times and counts the loading and scoring done within the context.
+
+  The functions in _TIMED_FUNCTIONS, _REPORTING_FUNCTIONS and
+  _COUNTED_FUNCTIONS are replaced with wrappers that time or count their calls
+  for as long as the context lasts, so instrumentation costs nothing when it
+  is not enabled. Within the context, the score dicts of compute_scores have
+  the sections of Instrumentation.report() added.
+
+  Args:
+    track_memory: whether to also track peak memory with tracemalloc.
+
+  Yields:
+    The Instrumentation that collects the timings and counters.
+
+  Raises:
+    ValueError: if instrumentation is already enabled.
+  """
+  global _instrumentation
+  if _instrumentation is not None:
+    raise ValueError('Instrumentation is already enabled.')
+  instrumentation = Instrumentation(track_memory)
+  module_globals = globals()
+  originals = {
+      name: module_globals[name]
+      for name in (_TIMED_FUNCTIONS + _REPORTING_FUNCTIONS +
+                   tuple(_COUNTED_FUNCTIONS))
+  }
+  for name in _TIMED_FUNCTIONS:
+    module_globals[name] = instrumentation.timed(name, originals[name])
+  for name in _REPORTING_FUNCTIONS:
+    module_globals[name] = instrumentation.reporting(name, originals[name])
+  for name, counter in _COUNTED_FUNCTIONS.items():
+    module_globals[name] = instrumentation.counted(counter, originals[name])
+  if track_memory:
+    import tracemalloc  # pylint: disable=g-import-not-at-top
+    tracemalloc.start()
+  _instrumentation = instrumentation
+  try:
+    yield instrumentation
+  finally:
+    _instrumentation = None
+    module_globals.update(originals)
+    if track_memory:
+      instrumentation.report()  # Records the peak memory.
+      tracemalloc.stop()
+
+
+def _instrumentation_counters() -> Optional[MutableMapping[Text, int]]:
+  """The counters of the enabled instrumentation, if any."""
+  return None if _instrumentation is None else _instrumentation.counters
+
+
+_ARTICLES_RE = re.compile(r'\b(a|an|the)\b')
+# Deleting punctuation with a regex is faster than str.translate, both on
+# single mentions and on the long joined strings of normalize_batch.
+_PUNCTUATION_RE = re.compile('[%s]+' % re.escape(string.punctuation))
+# Separates texts in normalize_batch. It is neither whitespace, punctuation nor
+# a word character, so it does not change how the texts around it normalize.
+_BATCH_SEPARATOR = '\x00'
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_text(text: Text) -> Text:
+  """Lowercases text and removes punctuation, articles and extra whitespace."""
+  text = _PUNCTUATION_RE.sub('', text.lower())
+  return ' '.join(_ARTICLES_RE.sub(' ', text).split())
+
+
+def normalize_batch(texts: Collection[Text]) -> List[Text]:
+  """Normalizes many texts at once, with the same output as normalize_text.
+
+  Distinct texts are joined into a single string which is lowercased, stripped
+  of punctuation and articles in one pass, then split back.
+
+  Args:
+    texts: texts to normalize, typically all mention strings of a file.
+
+  Returns:
+    The normalized texts, in the same order.
+  """
+  unique_texts = list(dict.fromkeys(texts))
+  if any(_BATCH_SEPARATOR in text for text in unique_texts):
+    return [normalize_text(text) for text in texts]
+  joined = _PUNCTUATION_RE.sub(
+      '', _BATCH_SEPARATOR.join(unique_texts).lower())
+  normalized = {
+      text: ' '.join(part.split()) for text, part in zip(
+          unique_texts,
+          _ARTICLES_RE.sub(' ', joined).split(_BATCH_SEPARATOR))
+  }
+  return [normalized[text] for text in texts]
+
+
+def _check_offset(name: Text, value: int) -> None:
+  """Rejects offsets that pack_entity_key cannot pack."""
+  if not -1 <= value < MAX_OFFSET:
+    raise ValueError('%s %d out of range [-1, %d).' % (name, value, MAX_OFFSET))
+
+
+def pack_entity_key(start_offset: int, end_offset: int, type_code: int) -> int:
+  """Packs an entity span and type code into a single int64.
+
+  Two entities have the same key iff they have the same span and type. Offsets
+  must lie in [-1, MAX_OFFSET), which Entity checks when it is created.
+
+  Args:
+    start_offset: start char offset, -1 for bridged entities.
+    end_offset: end char offset, -1 for bridged entities.
+    type_code: index of the entity type in ENTITY_TYPES.
+
+  Returns:
+    The packed key.
+  """
+  return (((start_offset + 1) << _KEY_START_SHIFT) | ((end_offset + 1) << 1) |
+          type_code)
+
+
+def _has_start(key: int) -> bool:
+  """Whether a packed key belongs to an entity whose start_offset is not -1."""
+  return key >> _KEY_START_SHIFT != 0
+
+
+# eq=False keeps dataclasses from generating __eq__ and __hash__, so that the
+# ones below also accept EntityViews.
+@dataclasses.dataclass(frozen=True, eq=False)
+class Entity:
+  """Entity in either document or query."""
+
+  # Inclusive start char offset of this entity mention. -1 refers to the start
+  # of the answering sentence. The answering sentence is given in the data
+  # as example["annotation"]["selected_sentence"].
+  start_offset: int
+
+  # Exclusive end char offset of this entity mention. -1 refers to the entire
+  # answering sentence.
+  end_offset: int
+  # type must be either context or query.
+  type: Text
+  # entity mention text.
+  text: Text
+  normalized_text: Text
+
+  def __post_init__(self):
+    _check_offset('start_offset', self.start_offset)
+    _check_offset('end_offset', self.end_offset)
+
+  # Entities and EntityViews compare and hash by all their fields, which is
+  # what strict matching compares, so that they can be mixed in sets and dicts.
+  def __hash__(self):
+    return hash(self.strict_key)
+
+  def __eq__(self, other):
+    if not isinstance(other, (Entity, EntityView)):
+      return NotImplemented
+    return self.strict_key == other.strict_key
+
+  @property
+  def key(self) -> int:
+    """Packed (start_offset, end_offset, type), see pack_entity_key."""
+    return pack_entity_key(self.start_offset, self.end_offset,
+                           ENTITY_TYPE_CODES[self.type])
+
+  @property
+  def strict_key(self) -> Tuple[int, Text, Text]:
+    """What strict matching compares: the packed key and both texts."""
+    # pack_entity_key inlined, this runs once per entity when scoring.
+    return ((((self.start_offset + 1) << _KEY_START_SHIFT) |
+             ((self.end_offset + 1) << 1) | ENTITY_TYPE_CODES[self.type]),
+            self.text, self.normalized_text)
+
+
+def _unchecked_entity(start_offset: int, end_offset: int,
+                      type: Text,  # pylint: disable=redefined-builtin
+                      text: Text, normalized_text: Text) -> Entity:
+  """Creates an Entity without checking its offsets, for validated files."""
+  entity = object.__new__(Entity)
+  # Bypasses the frozen __setattr__ as well, which halves the cost.
+  entity.__dict__.update(
+      start_offset=start_offset,
+      end_offset=end_offset,
+      type=type,
+      text=text,
+      normalized_text=normalized_text)
+  return entity
+
+
+@dataclasses.dataclass
+class QEDExample:
+  """A single training/test example."""
+  example_id: int
+  title: Text
+  question: Text
+  answer: List[Entity]
+  nq_answers: List[List[Entity]]
+  # the first entity is query entity, the second is document entity.
+  aligned_nps: List[Tuple[Entity, Entity]]
+  # either single_sentence or multi_sentence.
+  explanation_type: Text
+  # AnswerIndex of an annotated example, built by answer_index when it is
+  # first scored against.
+  answer_index: Optional['AnswerIndex'] = dataclasses.field(
+      default=None, compare=False, repr=False)
+
+
+class EntityView:
+  """Entity stored in an EntityStore, behaving like an Entity."""
+
+  __slots__ = ('_store', '_index')
+
+  def __init__(self, store: 'EntityStore', index: int):
+    self._store = store
+    self._index = index
+
+  @property
+  def start_offset(self) -> int:
+    return self._store.starts[self._index]
+
+  @property
+  def end_offset(self) -> int:
+    return self._store.ends[self._index]
+
+  @property
+  def type(self) -> Text:
+    return ENTITY_TYPES[self._store.types[self._index]]
+
+  @property
+  def text(self) -> Text:
+    return self._store.strings[self._store.texts[self._index]]
+
+  @property
+  def normalized_text(self) -> Text:
+    return self._store.strings[self._store.normalized_texts[self._index]]
+
+  @property
+  def key(self) -> int:
+    """Packed (start_offset, end_offset, type), see pack_entity_key."""
+    return self._store.keys[self._index]
+
+  @property
+  def strict_key(self) -> Tuple[int, Text, Text]:
+    """What strict matching compares: the packed key and both texts."""
+    return self._store.strict_key(self._index)
+
+  def __hash__(self):
+    # Same basis as Entity.__hash__, since the two compare equal.
+    return hash(self.strict_key)
+
+  def __eq__(self, other):
+    if not isinstance(other, (Entity, EntityView)):
+      return NotImplemented
+    return self.strict_key == other.strict_key
+
+  def __reduce__(self):
+    # Pickles as a standalone Entity rather than dragging the store along.
+    return (Entity, (self.start_offset, self.end_offset, self.type, self.text,
+                     self.normalized_text))
+
+  def __repr__(self):
+    return ('EntityView(start_offset=%d, end_offset=%d, type=%r, text=%r)' %
+            (self.start_offset, self.end_offset, self.type, self.text))
+
+
+class EntityList(collections.abc.Sequence):
+  """Read-only list of consecutive entities of an EntityStore."""
+
+  __slots__ = ('_store', '_start', '_stop')
+
+  def __init__(self, store: 'EntityStore', start: int, stop: int):
+    self._store = store
+    self._start = start
+    self._stop = stop
+
+  @property
+  def bounds(self) -> Tuple[int, int]:
+    """Start and stop index of the viewed entities in the store."""
+    return self._start, self._stop
+
+  def __len__(self):
+    return self._stop - self._start
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError('entity index out of range')
+    return EntityView(self._store, self._start + i)
+
+  def __iter__(self):
+    # Faster than Sequence.__iter__, which goes through __getitem__.
+    store = self._store
+    return (EntityView(store, i) for i in range(self._start, self._stop))
+
+  def columns(self) -> Tuple[Sequence[int], Sequence[int], List[Text]]:
+    """Returns the start offsets, end offsets and normalized texts.
+
+    They are read column-wise from the store, which is faster than going
+    through one EntityView per entity.
+    """
+    store, start, stop = self._store, self._start, self._stop
+    strings = store.strings
+    return (store.starts[start:stop], store.ends[start:stop],
+            [strings[i] for i in store.normalized_texts[start:stop]])
+
+  def __eq__(self, other):
+    return list(self) == list(other)
+
+  def __reduce__(self):
+    return (list, (list(self),))
+
+  def __repr__(self):
+    return repr(list(self))
+
+
+class AlignedEntityList(EntityList):
+  """Read-only list of (question, context) entity pairs of an EntityStore.
+
+  The two entities of the i-th pair are stored at start + 2 * i and
+  start + 2 * i + 1.
+  """
+
+  __slots__ = ()
+
+  def __len__(self):
+    return (self._stop - self._start) // 2
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError('alignment index out of range')
+    index = self._start + 2 * i
+    return (EntityView(self._store, index), EntityView(self._store, index + 1))
+
+  def __iter__(self):
+    store = self._store
+    return ((EntityView(store, i), EntityView(store, i + 1))
+            for i in range(self._start, self._stop, 2))
+
+
+class EntityStore:
+  """Column-wise storage for all entities of a loaded file.
+
+  Offsets and type codes live in typed arrays and all strings are interned in
+  a single table, so an entity costs a few machine words instead of an Entity
+  object with two strings of its own. QEDExamples built by add_example hold
+  EntityList views into the store instead of lists of Entity objects.
+  """
+
+  def __init__(self):
+    self.starts = array.array('q')
+    self.ends = array.array('q')
+    self.types = array.array('b')
+    self.texts = array.array('q')
+    self.normalized_texts = array.array('q')
+    # Packed keys, see pack_entity_key.
+    self.keys = array.array('q')
+    self.strings = []
+    self._string_ids = {}
+
+  def __len__(self):
+    return len(self.starts)
+
+  def strict_key(self, index: int) -> Tuple[int, Text, Text]:
+    """Returns Entity.strict_key of the entity at index."""
+    strings = self.strings
+    return (self.keys[index], strings[self.texts[index]],
+            strings[self.normalized_texts[index]])
+
+  def strict_keys(self, start: int, stop: int) -> List[Tuple[int, Text, Text]]:
+    """Returns the strict keys of the entities in [start, stop)."""
+    strings = self.strings
+    return [(key, strings[text], strings[normalized_text])
+            for key, text, normalized_text in zip(
+                self.keys[start:stop], self.texts[start:stop],
+                self.normalized_texts[start:stop])]
+
+  def intern(self, text: Text) -> int:
+    """Returns the id of text in the string table, adding it if needed."""
+    string_id = self._string_ids.get(text)
+    if string_id is None:
+      string_id = self._string_ids[text] = len(self.strings)
+      self.strings.append(text)
+    return string_id
+
+  def add(self, entity: Entity) -> int:
+    """Appends an entity to the store and returns its index."""
+    self.starts.append(entity.start_offset)
+    self.ends.append(entity.end_offset)
+    self.types.append(ENTITY_TYPE_CODES[entity.type])
+    self.texts.append(self.intern(entity.text))
+    self.normalized_texts.append(self.intern(entity.normalized_text))
+    self.keys.append(entity.key)
+    return len(self.starts) - 1
+
+  def add_entities(self, entities: Collection[Entity]) -> EntityList:
+    """Appends entities to the store and returns a view of them."""
+    start = len(self)
+    for entity in entities:
+      self.add(entity)
+    return EntityList(self, start, len(self))
+
+  def normalize_texts(self) -> None:
+    """Sets the normalized text of every entity to normalize_text(text).
+
+    All distinct entity texts are normalized with a single normalize_batch
+    call, so loaders can skip normalize_text while parsing.
+    """
+    text_ids = sorted(set(self.texts))
+    normalized = normalize_batch([self.strings[i] for i in text_ids])
+    normalized_ids = {
+        text_id: self.intern(text)
+        for text_id, text in zip(text_ids, normalized)
+    }
+    self.normalized_texts = array.array(
+        'q', [normalized_ids[text_id] for text_id in self.texts])
+
+  def add_example(self, example: QEDExample) -> QEDExample:
+    """Returns a copy of example whose entities live in this store."""
+    aligned_start = len(self)
+    for question_entity, context_entity in example.aligned_nps:
+      self.add(question_entity)
+      self.add(context_entity)
+    aligned_nps = AlignedEntityList(self, aligned_start, len(self))
+    return QEDExample(
+        example_id=example.example_id,
+        title=self.strings[self.intern(example.title)],  # Shared by examples.
+        question=self.strings[self.intern(example.question)],
+        answer=self.add_entities(example.answer),
+        nq_answers=[self.add_entities(a) for a in example.nq_answers],
+        aligned_nps=aligned_nps,
+        explanation_type=self.strings[self.intern(example.explanation_type)])
+
+
+def load_answer(answer: List[Mapping[Text, Any]],
+                normalize: bool = True,
+                check: bool = True) -> List[Entity]:
+  """Loads annotated QED answer, potentially composed of multiple spans."""
+  entity = Entity if check else _unchecked_entity
+  output_answer = []
+  for a in answer:
+    text = a['paragraph_reference']['string']
+    output_answer.append(
+        entity(
+            text=text,
+            normalized_text=normalize_text(text) if normalize else '',
+            start_offset=a['paragraph_reference']['start'],
+            end_offset=a['paragraph_reference']['end'],
+            type='context'))
+  return output_answer
+
+
+def load_nq_answers(answer_list: List[List[Mapping[Text, Any]]],
+                    normalize: bool = True,
+                    check: bool = True) -> List[List[Entity]]:
+  """Loads annotated NQ answers, each potentially composed of multiple spans."""
+  entity = Entity if check else _unchecked_entity
+  output_answer_list = []
+  for answer in answer_list:
+    output_answer = []
+    for a in answer:
+      text = a['string']
+      output_answer.append(
+          entity(
+              text=text,
+              normalized_text=normalize_text(text) if normalize else '',
+              start_offset=a['start'],
+              end_offset=a['end'],
+              type='context'))
+    output_answer_list.append(output_answer)
+  return output_answer_list
+
+
+def load_aligned_entities(
+    alignment_dict: List[Mapping[Text, Any]],
+    question_text: Text,
+    context_text: Text,
+    normalize: bool = True,
+    check: bool = True) -> List[Tuple[Entity, Entity]]:
+  """Loads aligned entities from json.
+
+  Args:
+    alignment_dict: the referential_equalities of the annotation.
+    question_text: the question the question references point into.
+    context_text: the paragraph the sentence references point into.
+    normalize: whether to normalize the entity texts.
+    check: whether to check that the mention strings match the texts at their
+      offsets and that the offsets are in range. Files that passed
+      validate_file can skip that.
+
+  Returns:
+    The (question entity, context entity) pairs.
+
+  Raises:
+    ValueError: if a mention string does not match its offsets.
+  """
+  if not check:
+    return _load_trusted_aligned_entities(alignment_dict, normalize)
+  aligned_nps = []
+  for single_np_alignment in alignment_dict:
+    q_entity_text = single_np_alignment['question_reference']['string']
+    q_entity_offset = (single_np_alignment['question_reference']['start'],
+                       single_np_alignment['question_reference']['end'])
+    c_entity_text = single_np_alignment['sentence_reference']['string']
+    c_entity_offset = (single_np_alignment['sentence_reference']['start'],
+                       single_np_alignment['sentence_reference']['end'])
+    if q_entity_text != question_text[q_entity_offset[0]:q_entity_offset[1]]:
+      logging.error(
+          'Question entity offset not proper. from text: %s, from byte offset %s',
+          q_entity_text, question_text[q_entity_offset[0]:q_entity_offset[1]])
+      raise ValueError()
+
+    question_entity = Entity(
+        text=question_text[q_entity_offset[0]:q_entity_offset[1]],
+        normalized_text=normalize_text(q_entity_text) if normalize else '',
+        start_offset=q_entity_offset[0],
+        end_offset=q_entity_offset[1],
+        type='question')
+    if c_entity_offset[0] != -1:
+      if c_entity_text != context_text[c_entity_offset[0]:c_entity_offset[1]]:
+        logging.error(
+            'Context entity offset not proper. from text: %s, from byte offset %s',
+            c_entity_text, context_text[c_entity_offset[0]:c_entity_offset[1]])
+        raise ValueError()
+      doc_entity = Entity(
+          text=context_text[c_entity_offset[0]:c_entity_offset[1]],
+          normalized_text=normalize_text(c_entity_text) if normalize else '',
+          start_offset=c_entity_offset[0],
+          end_offset=c_entity_offset[1],
+          type='context')
+    else:  # this is a bridging linguistic context instance.
+      doc_entity = Entity(
+          text='',
+          start_offset=-1,
+          end_offset=-1,
+          type='context',
+          normalized_text='')
+    aligned_nps.append((question_entity, doc_entity))
+  return aligned_nps
+
+
+def _load_trusted_aligned_entities(
+    alignment_dict: List[Mapping[Text, Any]],
+    normalize: bool) -> List[Tuple[Entity, Entity]]:
+  """load_aligned_entities taking the mention strings as they are."""
+  entity = _unchecked_entity
+  aligned_nps = []
+  for single_np_alignment in alignment_dict:
+    question_reference = single_np_alignment['question_reference']
+    sentence_reference = single_np_alignment['sentence_reference']
+    q_entity_text = question_reference['string']
+    question_entity = entity(
+        text=q_entity_text,
+        normalized_text=normalize_text(q_entity_text) if normalize else '',
+        start_offset=question_reference['start'],
+        end_offset=question_reference['end'],
+        type='question')
+    if sentence_reference['start'] != -1:
+      c_entity_text = sentence_reference['string']
+      doc_entity = entity(
+          text=c_entity_text,
+          normalized_text=normalize_text(c_entity_text) if normalize else '',
+          start_offset=sentence_reference['start'],
+          end_offset=sentence_reference['end'],
+          type='context')
+    else:  # this is a bridging linguistic context instance.
+      doc_entity = entity(
+          text='',
+          start_offset=-1,
+          end_offset=-1,
+          type='context',
+          normalized_text='')
+    aligned_nps.append((question_entity, doc_entity))
+  return aligned_nps
+
+
+def load_single_line(elem: Mapping[Text, Any],
+                     normalize: bool = True,
+                     check: bool = True) -> QEDExample:
+  """Loads a QEDExample from json.
+
+  Args:
+    elem: the parsed json line.
+    normalize: whether to normalize the entity texts. Otherwise normalized_text
+      is left empty, for callers that normalize all texts at once with
+      EntityStore.normalize_texts.
+    check: whether to check the mention offsets, see load_aligned_entities.
+
+  Returns:
+    The QEDExample.
+  """
+  return QEDExample(
+      example_id=elem['example_id'],
+      title=elem['title_text'],
+      question=elem['question_text'],
+      answer=load_answer(elem['annotation'].get('answer', []), normalize,
+                         check),
+      nq_answers=load_nq_answers(elem['original_nq_answers'], normalize, check),
+      aligned_nps=load_aligned_entities(
+          elem['annotation'].get('referential_equalities', []),
+          elem['question_text'],
+          elem['paragraph_text'],
+          normalize,
+          check),
+      explanation_type=elem['annotation']['explanation_type'])
+
+
+def _json_decoder(fast_json: bool) -> Callable[[Text], Any]:
+  """Returns orjson.loads if fast_json is set and orjson is installed."""
+  loads = json.loads
+  if fast_json:
+    try:
+      import orjson  # pylint: disable=g-import-not-at-top
+    except ImportError:
+      logging.warning('orjson is not installed, falling back to json.')
+    else:
+      loads = orjson.loads
+  if _instrumentation is not None:
+    return _instrumentation.timed('parse_json', loads)
+  return loads
+
+
+def parse_lines(
+    lines: Iterable[Text],
+    counters: MutableMapping[Text, int],
+    loads: Callable[[Text], Any] = json.loads,
+    normalize: bool = True,
+    check: bool = True) -> Iterator[Optional[QEDExample]]:
+  """Parses jsonl lines, yielding None for skipped lines.
+
+  Args:
+    lines: the lines to parse.
+    counters: incremented at 'examples_read' for every line, at
+      'incorrectly_formatted' for every line that raises a ValueError while
+      loading and at 'not_single_sentence' for every example that is skipped
+      because of its explanation type.
+    loads: the json decoder to use.
+    normalize: passed on to load_single_line.
+    check: passed on to load_single_line.
+
+  Yields:
+    The QEDExample of each line whose explanation is single_sentence, None for
+    the other lines.
+  """
+  for line in lines:
+    counters['examples_read'] += 1
+    try:
+      example = load_single_line(loads(line), normalize, check)
+    except ValueError:
+      counters['incorrectly_formatted'] += 1
+      yield None
+      continue
+    if example.explanation_type == 'single_sentence':
+      yield example
+    else:
+      counters['not_single_sentence'] += 1
+      yield None
+
+
+def open_jsonl(fname: Text) -> IO[Text]:
+  """Opens a jsonl file as text, decompressing it by its suffix."""
+  module = COMPRESSION_MODULES.get(os.path.splitext(fname)[1])
+  if module is None:
+    return open(fname)
+  return importlib.import_module(module).open(fname, 'rt')
+
+
+def _is_compressed(fname: Text) -> bool:
+  return os.path.splitext(fname)[1] in COMPRESSION_MODULES
+
+
+def iter_examples(fname: Text,
+                  fast_json: bool = False) -> Iterator[Optional[QEDExample]]:
+  """Yields one QEDExample per line of a jsonl file.
+
+  Lines that are not correctly formatted or whose explanation is not
+  single_sentence yield None, so that the i-th yielded value always
+  corresponds to the i-th line of the file.
+
+  Args:
+    fname: path to the jsonl file, which may be compressed.
+    fast_json: whether to parse lines with orjson when it is installed.
+
+  Yields:
+    The QEDExample of each line, or None if the line was skipped.
+  """
+  counters = collections.Counter()
+  with open_jsonl(fname) as f:
+    yield from parse_lines(f, counters, _json_decoder(fast_json))
+  _log_parse_counters(counters)
+
+
+def _chunk_boundaries(fname: Text, num_chunks: int) -> List[int]:
+  """Splits a file into at most num_chunks byte ranges of whole lines.
+
+  Args:
+    fname: path to the file.
+    num_chunks: number of chunks to aim for.
+
+  Returns:
+    Sorted byte offsets starting with 0 and ending with the file size; each
+    consecutive pair delimits one chunk. Every offset but the last is the start
+    of a line.
+  """
+  size = os.path.getsize(fname)
+  boundaries = [0]
+  with open(fname, 'rb') as f:
+    for i in range(1, num_chunks):
+      position = size * i // num_chunks
+      if position <= boundaries[-1]:
+        continue
+      f.seek(position - 1)
+      f.readline()  # Moves to the start of the next line.
+      if f.tell() >= size:
+        break
+      if f.tell() > boundaries[-1]:
+        boundaries.append(f.tell())
+  boundaries.append(size)
+  return boundaries
+
+
+def _load_chunk(
+    fname: Text, start: int, end: int, fast_json: bool, normalize: bool,
+    check: bool) -> Tuple[List[QEDExample], Mapping[Text, int]]:
+  """Parses the lines in a byte range of a jsonl file in a worker process.
+
+  Args:
+    fname: path to the jsonl file.
+    start: byte offset of the first line of the chunk.
+    end: byte offset just past the last line of the chunk.
+    fast_json: whether to parse lines with orjson when it is installed.
+    normalize: passed on to load_single_line.
+    check: passed on to load_single_line.
+
+  Returns:
+    The single_sentence examples of the chunk in file order, and the counters
+    of parse_lines.
+  """
+  with open(fname, 'rb') as f:
+    f.seek(start)
+    data = f.read(end - start)
+  counters = collections.Counter()
+  # Decoded like open(fname) would, with universal newlines.
+  lines = io.TextIOWrapper(io.BytesIO(data))
+  examples = [
+      example
+      for example in parse_lines(lines, counters, _json_decoder(fast_json),
+                                 normalize, check)
+      if example is not None
+  ]
+  return examples, counters
+
+
+def _load_shard(
+    fname: Text, fast_json: bool, normalize: bool,
+    check: bool) -> Tuple[List[QEDExample], Mapping[Text, int]]:
+  """Parses a whole, possibly compressed, jsonl file in a worker process.
+
+  Args:
+    fname: path to the jsonl file.
+    fast_json: whether to parse lines with orjson when it is installed.
+    normalize: passed on to load_single_line.
+    check: passed on to load_single_line.
+
+  Returns:
+    The single_sentence examples of the file in file order, and the counters
+    of parse_lines.
+  """
+  counters = collections.Counter()
+  with open_jsonl(fname) as f:
+    examples = [
+        example
+        for example in parse_lines(f, counters, _json_decoder(fast_json),
+                                   normalize, check)
+        if example is not None
+    ]
+  return examples, counters
+
+
+def _process_pool(num_workers: int) -> 'concurrent.futures.Executor':
+  """Returns a process pool, importing concurrent.futures only when needed."""
+  import concurrent.futures  # pylint: disable=g-import-not-at-top
+  return concurrent.futures.ProcessPoolExecutor(num_workers)
+
+
+def _ordered_results(executor: 'concurrent.futures.Executor',
+                     tasks: Iterable[Callable[[], Any]],
+                     max_pending: int) -> Iterator[Any]:
+  """Runs tasks in executor and yields their results in order.
+
+  At most max_pending tasks are submitted whose results were not yet consumed,
+  so that no more than that many results are held in memory at once.
+
+  Args:
+    executor: the executor to run the tasks in.
+    tasks: picklable callables without arguments.
+    max_pending: maximum number of tasks in flight.
+
+  Yields:
+    The result of each task, in the order of tasks.
+  """
+  pending = collections.deque()
+  for task in tasks:
+    if len(pending) >= max_pending:
+      yield pending.popleft().result()
+    pending.append(executor.submit(task))
+  while pending:
+    yield pending.popleft().result()
+
+
+def _file_digest(fname: Text) -> bytes:
+  """Returns the sha256 digest of the contents of a file."""
+  import hashlib  # pylint: disable=g-import-not-at-top
+  digest = hashlib.sha256()
+  with open(fname, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.digest()
+
+
+def _padded(data: bytes) -> bytes:
+  """Pads data with zeros to a multiple of 8 bytes."""
+  return data + b'\0' * (-len(data) % 8)
+
+
+def write_cache(output_dict: Mapping[int, QEDExample], store: EntityStore,
+                fname: Text, digest: bytes) -> None:
+  """Writes compactly loaded examples to a binary cache file.
+
+  Args:
+    output_dict: examples whose entities all live in store.
+    store: the EntityStore holding the entities.
+    fname: path of the cache file.
+    digest: sha256 digest of the jsonl file the examples were loaded from.
+  """
+  records = array.array('q')
+  nq_ranges = array.array('q')
+  for example in output_dict.values():
+    records.extend([
+        example.example_id,
+        store.intern(example.title),
+        store.intern(example.question),
+        store.intern(example.explanation_type),
+        *example.answer.bounds,
+        len(nq_ranges) // 2, len(nq_ranges) // 2 + len(example.nq_answers),
+        *example.aligned_nps.bounds
+    ])
+    for nq_answer in example.nq_answers:
+      nq_ranges.extend(nq_answer.bounds)
+  string_offsets = array.array('q', [0])
+  for text in store.strings:
+    string_offsets.append(string_offsets[-1] + len(text))
+  string_blob = ''.join(store.strings).encode('utf-8', 'surrogatepass')
+  header = _CACHE_HEADER.pack(_CACHE_MAGIC, CACHE_VERSION, digest,
+                              sys.byteorder.encode(), len(store),
+                              len(store.strings), len(string_blob),
+                              len(output_dict), len(nq_ranges) // 2)
+  # Write to a temporary file first so that readers never see a partial cache.
+  tmp_fname = '%s.tmp%d' % (fname, os.getpid())
+  with open(tmp_fname, 'wb') as f:
+    f.write(header)
+    for column in (store.starts, store.ends, store.texts,
+                   store.normalized_texts, store.keys, string_offsets, records,
+                   nq_ranges):
+      f.write(column.tobytes())
+    f.write(_padded(store.types.tobytes()))
+    f.write(_padded(string_blob))
+  os.replace(tmp_fname, fname)
+
+
+def read_cache(fname: Text,
+               digest: bytes) -> Optional[Mapping[int, QEDExample]]:
+  """Memory-maps a cache written by write_cache.
+
+  Args:
+    fname: path of the cache file.
+    digest: sha256 digest of the jsonl file the cache should belong to.
+
+  Returns:
+    The cached examples, whose entities are read from the mapped file, or None
+    if the cache was written for different contents, by a different loader
+    version or on a machine with a different byte order, or if its size does
+    not match its header (e.g. a truncated file).
+  """
+  import mmap  # pylint: disable=g-import-not-at-top
+  with open(fname, 'rb') as f:
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  (magic, version, cache_digest, byteorder, num_entities, num_strings,
+   blob_size, num_examples, num_nq_answers) = _CACHE_HEADER.unpack_from(mapped)
+  if (magic, version, cache_digest, byteorder.rstrip(b'\0')) != (
+      _CACHE_MAGIC, CACHE_VERSION, digest, sys.byteorder.encode()):
+    return None
+  counts = (num_entities, num_strings, blob_size, num_examples, num_nq_answers)
+  int64_columns = (5 * num_entities + num_strings + 1 + 10 * num_examples +
+                   2 * num_nq_answers)
+  expected_size = (
+      _CACHE_HEADER.size + 8 * int64_columns + num_entities +
+      (-num_entities % 8) + blob_size + (-blob_size % 8))
+  if min(counts) < 0 or len(mapped) != expected_size:
+    logging.warning('Cache %s has %d bytes, expected %d.', fname, len(mapped),
+                    expected_size)
+    return None
+  view = memoryview(mapped)
+  offset = _CACHE_HEADER.size
+
+  def take(typecode, count):
+    nonlocal offset
+    size = count * array.array(typecode).itemsize
+    column = view[offset:offset + size].cast(typecode)
+    offset += size + (-size % 8)
+    return column
+
+  store = EntityStore()
+  store.starts = take('q', num_entities)
+  store.ends = take('q', num_entities)
+  store.texts = take('q', num_entities)
+  store.normalized_texts = take('q', num_entities)
+  store.keys = take('q', num_entities)
+  string_offsets = take('q', num_strings + 1)
+  records = take('q', num_examples * 10)
+  nq_ranges = take('q', num_nq_answers * 2)
+  store.types = take('b', num_entities)
+  all_strings = bytes(take('B', blob_size)).decode('utf-8', 'surrogatepass')
+  store.strings = [
+      all_strings[string_offsets[i]:string_offsets[i + 1]]
+      for i in range(num_strings)
+  ]
+  # The mapped store is read-only.
+  store._string_ids = None  # pylint: disable=protected-access
+
+  output_dict = {}
+  for i in range(0, len(records), 10):
+    (example_id, title, question, explanation_type, answer_start, answer_stop,
+     nq_start, nq_stop, aligned_start, aligned_stop) = records[i:i + 10]
+    output_dict[example_id] = QEDExample(
+        example_id=example_id,
+        title=store.strings[title],
+        question=store.strings[question],
+        answer=EntityList(store, answer_start, answer_stop),
+        nq_answers=[
+            EntityList(store, nq_ranges[2 * j], nq_ranges[2 * j + 1])
+            for j in range(nq_start, nq_stop)
+        ],
+        aligned_nps=AlignedEntityList(store, aligned_start, aligned_stop),
+        explanation_type=store.strings[explanation_type])
+  return output_dict
+
+
+def build_index(fname: Text,
+                fast_json: bool = False) -> Mapping[int, Tuple[int, int]]:
+  """Maps the example_id of each line of a jsonl file to its byte range.
+
+  Args:
+    fname: path to the jsonl file.
+    fast_json: whether to parse lines with orjson when it is installed.
+
+  Returns:
+    A dict from example_id to the (byte offset, length) of its line. Later
+    duplicates win, as in load_data. Lines that are not JSON objects with an
+    integer example_id are left out.
+  """
+  loads = _json_decoder(fast_json)
+  index = {}
+  offset = 0
+  with open(fname, 'rb') as f:
+    for line in f:
+      try:
+        example_id = loads(line)['example_id']
+      except (ValueError, KeyError, TypeError):
+        example_id = None
+      if isinstance(example_id, int):
+        index[example_id] = (offset, len(line))
+      offset += len(line)
+  return index
+
+
+def _index_key(fname: Text) -> Tuple[int, int]:
+  """The size and modification time an index of fname is valid for."""
+  stat = os.stat(fname)
+  return stat.st_size, stat.st_mtime_ns
+
+
+def write_index(index: Mapping[int, Tuple[int, int]], fname: Text,
+                key: Tuple[int, int]) -> None:
+  """Writes an index of build_index to a binary file.
+
+  Args:
+    index: the index to write.
+    fname: path of the index file.
+    key: _index_key of the indexed jsonl file.
+  """
+  columns = array.array('q')
+  for example_id, (offset, length) in index.items():
+    columns.extend((example_id, offset, length))
+  header = _INDEX_HEADER.pack(_INDEX_MAGIC, INDEX_VERSION,
+                              sys.byteorder.encode(), *key, len(index))
+  # Write to a temporary file first so that readers never see a partial index.
+  tmp_fname = '%s.tmp%d' % (fname, os.getpid())
+  with open(tmp_fname, 'wb') as f:
+    f.write(header)
+    f.write(columns.tobytes())
+  os.replace(tmp_fname, fname)
+
+
+def read_index(fname: Text,
+               key: Tuple[int, int]) -> Optional[Mapping[int, Tuple[int, int]]]:
+  """Reads an index written by write_index.
+
+  Args:
+    fname: path of the index file.
+    key: _index_key of the jsonl file the index should belong to.
+
+  Returns:
+    The index, or None if it was written for a file of a different size or
+    modification time, by a different version or on a machine with a different
+    byte order, or if its size does not match its header.
+  """
+  with open(fname, 'rb') as f:
+    data = f.read()
+  magic, version, byteorder, size, mtime_ns, num_lines = (
+      _INDEX_HEADER.unpack_from(data))
+  if (magic, version, byteorder.rstrip(b'\0'), (size, mtime_ns)) != (
+      _INDEX_MAGIC, INDEX_VERSION, sys.byteorder.encode(), key):
+    return None
+  if num_lines < 0 or len(data) != _INDEX_HEADER.size + 24 * num_lines:
+    logging.warning('Index %s has %d bytes for %d lines.', fname, len(data),
+                    num_lines)
+    return None
+  columns = array.array('q', data[_INDEX_HEADER.size:])
+  return {
+      columns[i]: (columns[i + 1], columns[i + 2])
+      for i in range(0, len(columns), 3)
+  }
+
+
+def load_index(fname: Text,
+               fast_json: bool = False) -> Mapping[int, Tuple[int, int]]:
+  """Returns the build_index of a jsonl file, kept in a file next to it.
+
+  The index is rebuilt whenever the size or modification time of the jsonl
+  file changes.
+
+  Args:
+    fname: path to the jsonl file.
+    fast_json: whether to parse lines with orjson when it is installed.
+
+  Returns:
+    A dict from example_id to the (byte offset, length) of its line.
+  """
+  key = _index_key(fname)
+  index_fname = fname + INDEX_SUFFIX
+  if os.path.exists(index_fname):
+    try:
+      index = read_index(index_fname, key)
+    except (ValueError, struct.error) as e:
+      logging.warning('Ignoring corrupt index %s: %s', index_fname, e)
+      index = None
+    if index is not None:
+      return index
+  index = build_index(fname, fast_json)
+  try:
+    write_index(index, index_fname, key)
+  except OSError as e:
+    logging.warning('Could not write index %s: %s', index_fname, e)
+  return index
+
+
+def load_examples_by_id(
+    fname: Text,
+    example_ids: Iterable[int],
+    fast_json: bool = False,
+    store: Optional[EntityStore] = None,
+    check: bool = True) -> Mapping[int, QEDExample]:
+  """Loads only the lines of some examples of a jsonl file.
+
+  The lines are located with load_index and read from the memory-mapped file,
+  so the rest of the file is neither read nor parsed.
+
+  Args:
+    fname: path to the jsonl file.
+    example_ids: ids of the examples to load.
+    fast_json: whether to parse lines with orjson when it is installed.
+    store: if given, the entities are moved into this EntityStore, as in
+      load_data with compact=True.
+    check: passed on to load_single_line.
+
+  Returns:
+    A dict mapping example_id to QEDExample, like load_data, for the requested
+    ids whose lines are single_sentence examples.
+  """
+  index = load_index(fname, fast_json)
+  ranges = sorted(index[example_id] for example_id in set(example_ids)
+                  if example_id in index)
+  output_dict = {}
+  if not ranges:
+    return output_dict
+  import mmap  # pylint: disable=g-import-not-at-top
+  counters = collections.Counter()
+  with open(fname, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+      lines = [
+          mapped[offset:offset + length].decode('utf-8')
+          for offset, length in ranges
+      ]
+  for example in parse_lines(lines, counters, _json_decoder(fast_json),
+                             store is None, check):
+    if example is not None:
+      if store is not None:
+        example = store.add_example(example)
+      output_dict[example.example_id] = example
+  _log_parse_counters(counters)
+  if store is not None:
+    store.normalize_texts()
+  return output_dict
+
+
+def _check_span(errors: List[Tuple[Text, Text]], field: Text, span: Any,
+                text: Text, text_name: Text, bridged: bool = False) -> None:
+  """Appends the errors of a span dict pointing into text to errors."""
+  if not isinstance(span, Mapping):
+    errors.append((field, 'missing or not an object'))
+    return
+  start, end, span_text = span.get('start'), span.get('end'), span.get('string')
+  if not (isinstance(start, int) and isinstance(end, int) and
+          isinstance(span_text, str)):
+    errors.append((field, 'needs integer start and end and a string'))
+    return
+  if bridged and start == -1:
+    return
+  if not 0 <= start <= end <= min(len(text), MAX_OFFSET - 1):
+    errors.append((field, 'offsets [%d, %d) out of range of %s of length %d' %
+                   (start, end, text_name, len(text))))
+  elif text[start:end] != span_text:
+    errors.append((field, 'string %r does not match %s[%d:%d] %r' %
+                   (span_text, text_name, start, end, text[start:end])))
+
+
+def validate_example(elem: Any) -> List[Tuple[Text, Text]]:
+  """Finds every format and offset error of a parsed jsonl line.
+
+  Besides what load_single_line rejects, the strings of answers and NQ answers
+  are also checked against the paragraph.
+
+  Args:
+    elem: the parsed json line.
+
+  Returns:
+    A (field, message) pair per error, where field is a path like
+    'annotation.referential_equalities[1].question_reference'. Empty if the
+    line is valid.
+  """
+  if not isinstance(elem, Mapping):
+    return [('', 'not a JSON object')]
+  errors = []
+  for field, kind in (('example_id', int), ('title_text', str),
+                      ('question_text', str), ('paragraph_text', str),
+                      ('original_nq_answers', list), ('annotation', Mapping)):
+    if not isinstance(elem.get(field), kind):
+      errors.append((field, 'missing or not of type %s' % kind.__name__))
+  if errors:
+    return errors
+  annotation = elem['annotation']
+  question, paragraph = elem['question_text'], elem['paragraph_text']
+  if not isinstance(annotation.get('explanation_type'), str):
+    errors.append(('annotation.explanation_type', 'missing or not a string'))
+  for i, equality in enumerate(annotation.get('referential_equalities', [])):
+    field = 'annotation.referential_equalities[%d]' % i
+    if not isinstance(equality, Mapping):
+      errors.append((field, 'not an object'))
+      continue
+    _check_span(errors, field + '.question_reference',
+                equality.get('question_reference'), question, 'question_text')
+    _check_span(errors, field + '.sentence_reference',
+                equality.get('sentence_reference'), paragraph,
+                'paragraph_text', bridged=True)
+  for i, answer in enumerate(annotation.get('answer', [])):
+    _check_span(errors, 'annotation.answer[%d].paragraph_reference' % i,
+                answer.get('paragraph_reference') if isinstance(
+                    answer, Mapping) else None, paragraph, 'paragraph_text')
+  for i, nq_answer in enumerate(elem['original_nq_answers']):
+    if not isinstance(nq_answer, list):
+      errors.append(('original_nq_answers[%d]' % i, 'not a list'))
+      continue
+    for j, span in enumerate(nq_answer):
+      _check_span(errors, 'original_nq_answers[%d][%d]' % (i, j), span,
+                  paragraph, 'paragraph_text')
+  return errors
+
+
+def validate_file(fname: Text, fast_json: bool = False) -> Dict[Text, Any]:
+  """Validates every line of a jsonl file in a single pass.
+
+  Args:
+    fname: path to the jsonl file, which may be compressed.
+    fast_json: whether to parse lines with orjson when it is installed.
+
+  Returns:
+    A report with the file name, the size and modification time of the file
+    when it was validated, the number of lines and of invalid lines and an
+    'errors' list with the 1-based 'line', 'example_id' (None if unknown),
+    'field' and 'message' of every error found by validate_example.
+  """
+  size, mtime_ns = _index_key(fname)
+  loads = _json_decoder(fast_json)
+  errors = []
+  num_lines = invalid_lines = 0
+  with open_jsonl(fname) as f:
+    for line_number, line in enumerate(f, 1):
+      num_lines += 1
+      try:
+        elem = loads(line)
+      except ValueError as e:
+        elem, line_errors = None, [('', 'invalid JSON: %s' % e)]
+      else:
+        line_errors = validate_example(elem)
+      if not line_errors:
+        continue
+      invalid_lines += 1
+      example_id = elem.get('example_id') if isinstance(elem, Mapping) else None
+      for field, message in line_errors:
+        errors.append({
+            'line': line_number,
+            'example_id': example_id if isinstance(example_id, int) else None,
+            'field': field,
+            'message': message,
+        })
+  return {
+      'file': fname,
+      'version': VALIDATION_VERSION,
+      'size': size,
+      'mtime_ns': mtime_ns,
+      'lines': num_lines,
+      'invalid_lines': invalid_lines,
+      'errors': errors,
+  }
+
+
+def write_validation_report(report: Mapping[Text, Any]) -> Text:
+  """Writes a report of validate_file next to its file and returns its path."""
+  report_fname = report['file'] + VALIDATION_SUFFIX
+  # Write to a temporary file first so that readers never see a partial report.
+  tmp_fname = '%s.tmp%d' % (report_fname, os.getpid())
+  with open(tmp_fname, 'w') as f:
+    json.dump(report, f, indent=1)
+  os.replace(tmp_fname, report_fname)
+  return report_fname
+
+
+def is_validated(fname: Text) -> bool:
+  """Whether fname passed validate_file without errors since it last changed.
+
+  Args:
+    fname: path to the jsonl file.
+
+  Returns:
+    True if the report written next to fname has no errors and was written
+    for the current size and modification time of fname, by the current
+    VALIDATION_VERSION.
+  """
+  try:
+    with open(fname + VALIDATION_SUFFIX) as f:
+      report = json.load(f)
+    return (report['version'] == VALIDATION_VERSION and not report['errors'] and
+            (report['size'], report['mtime_ns']) == _index_key(fname))
+  except (OSError, ValueError, KeyError, TypeError):
+    return False
+
+
+def load_data(fname: Text,
+              compact: bool = False,
+              use_cache: bool = False,
+              num_workers: int = 1,
+              fast_json: bool = False,
+              example_ids: Optional[Iterable[int]] = None,
+              trusted: bool = False) -> Mapping[int, QEDExample]:
+  """Loads jsonl data and outputs a dict mapping example_id to QEDExample.
+
+  Args:
+    fname: path to the jsonl file, or a glob pattern of shards that are loaded
+      in sorted order, as if they were one file. Files ending in a suffix of
+      COMPRESSION_MODULES are decompressed.
+    compact: whether to keep all entities in a single EntityStore, with the
+      examples holding views into it, instead of one Entity object per mention.
+    use_cache: whether to load the examples from a binary cache next to the
+      file, written on the first load and keyed by the file contents and
+      CACHE_VERSION. Cached examples are always compact.
+    num_workers: number of processes to parse the file in. With more than one
+      worker a single uncompressed file is split into chunks of whole lines,
+      otherwise each shard is a chunk. Chunks are parsed in parallel, at most
+      two per worker at a time, and merged in order, so later duplicates still
+      win.
+    fast_json: whether to parse lines with orjson when it is installed.
+    example_ids: if given, only the examples with these ids are loaded, with
+      load_examples_by_id. Needs a single uncompressed file and cannot be
+      combined with use_cache; num_workers is not used since only the
+      requested lines are parsed.
+    trusted: whether to skip checking mention strings against their offsets
+      if every file passed validate_file since it last changed, see
+      is_validated. Files that did not are checked as usual.
+
+  Returns:
+    A dict mapping example_id to QEDExample.
+  """
+  fnames = expand_paths([fname])
+  check = True
+  if trusted:
+    check = not all(is_validated(f) for f in fnames)
+    if check:
+      logging.warning('%s did not pass validation, checking its offsets.',
+                      fname)
+  if example_ids is not None:
+    if use_cache or len(fnames) > 1 or _is_compressed(fnames[0]):
+      raise ValueError(
+          'example_ids needs a single uncompressed file and cannot be '
+          'combined with use_cache.')
+    return load_examples_by_id(fnames[0], example_ids, fast_json,
+                               EntityStore() if compact else None, check)
+  if use_cache and len(fnames) > 1:
+    raise ValueError('Cannot cache the %d shards of %s.' % (len(fnames), fname))
+  if use_cache:
+    fname = fnames[0]
+    digest = _file_digest(fname)
+    cache_fname = fname + CACHE_SUFFIX
+    if os.path.exists(cache_fname):
+      try:
+        output_dict = read_cache(cache_fname, digest)
+      except (ValueError, struct.error) as e:
+        logging.warning('Ignoring corrupt cache %s: %s', cache_fname, e)
+        output_dict = None
+      if output_dict is not None:
+        logging.info('Loaded %d examples from cache %s.', len(output_dict),
+                     cache_fname)
+        return output_dict
+    store = EntityStore()
+    output_dict = _load_examples(fnames, store, num_workers, fast_json, check)
+    try:
+      write_cache(output_dict, store, cache_fname, digest)
+    except OSError as e:
+      logging.warning('Could not write cache %s: %s', cache_fname, e)
+    return output_dict
+  return _load_examples(fnames,
+                        EntityStore() if compact else None, num_workers,
+                        fast_json, check)
+
+
+def _load_examples(fnames: Sequence[Text], store: Optional[EntityStore],
+                   num_workers: int, fast_json: bool,
+                   check: bool) -> Mapping[int, QEDExample]:
+  """Loads jsonl shards, moving the entities into store unless it is None."""
+  output_dict = _parse_examples(fnames, store, num_workers, fast_json, check)
+  if store is not None:
+    # The entity texts were not normalized while parsing.
+    store.normalize_texts()
+  return output_dict
+
+
+def _parse_examples(fnames: Sequence[Text], store: Optional[EntityStore],
+                    num_workers: int, fast_json: bool,
+                    check: bool) -> Mapping[int, QEDExample]:
+  """Parses jsonl shards for _load_examples."""
+  # Texts moved into a store are normalized in one batch afterwards.
+  normalize = store is None
+  if num_workers > 1:
+    if len(fnames) == 1 and not _is_compressed(fnames[0]):
+      boundaries = _chunk_boundaries(fnames[0],
+                                     num_workers * SHARDS_PER_WORKER)
+      tasks = [
+          functools.partial(_load_chunk, fnames[0], start, end, fast_json,
+                            normalize, check)
+          for start, end in zip(boundaries[:-1], boundaries[1:])
+      ]
+    else:
+      tasks = [
+          functools.partial(_load_shard, fname, fast_json, normalize, check)
+          for fname in fnames
+      ]
+    counters = collections.Counter()
+    output_dict = {}
+    with _process_pool(num_workers) as executor:
+      for examples, chunk_counters in _ordered_results(
+          executor, tasks, 2 * num_workers):
+        counters.update(chunk_counters)
+        for example in examples:
+          if store is not None:
+            example = store.add_example(example)
+          output_dict[example.example_id] = example
+    _log_parse_counters(counters)
+    return output_dict
+
+  output_dict = {}
+  counters = collections.Counter()
+  for fname in fnames:
+    with open_jsonl(fname) as f:
+      for example in parse_lines(f, counters, _json_decoder(fast_json),
+                                 normalize, check):
+        if example is not None:
+          if store is not None:
+            example = store.add_example(example)
+          output_dict[example.example_id] = example
+  _log_parse_counters(counters)
+  return output_dict
+
+
+def _log_parse_counters(counters: Mapping[Text, int]) -> None:
+  """Logs the counters of parse_lines and adds them to the instrumentation."""
+  logging.info('%d examples not correctly formatted and skipped.',
+               counters['incorrectly_formatted'])
+  if _instrumentation is not None:
+    _instrumentation.counters.update(counters)
+
+
+def strict_keys(entities: Collection[Entity]) -> List[Tuple[int, Text, Text]]:
+  """Returns the strict_key of each entity.
+
+  EntityLists are read column-wise from their store instead of through one
+  EntityView per entity.
+
+  Args:
+    entities: Entities or EntityViews.
+
+  Returns:
+    The strict keys, in order.
+  """
+  if type(entities) is EntityList:  # pylint: disable=unidiomatic-typecheck
+    return entities._store.strict_keys(*entities.bounds)  # pylint: disable=protected-access
+  return [entity.strict_key for entity in entities]
+
+
+def aligned_strict_keys(
+    aligned_nps: Collection[Tuple[Entity, Entity]]
+) -> List[Tuple[Tuple[int, Text, Text], Tuple[int, Text, Text]]]:
+  """Returns the (question, context) strict_key pair of each alignment."""
+  if isinstance(aligned_nps, AlignedEntityList):
+    keys = aligned_nps._store.strict_keys(*aligned_nps.bounds)  # pylint: disable=protected-access
+    return list(zip(keys[0::2], keys[1::2]))
+  return [(q.strict_key, c.strict_key) for q, c in aligned_nps]
+
+
+def _strict_counts(annot_keys: Set[Any],
+                   pred_keys: Set[Any]) -> Tuple[int, int, int]:
+  """Returns tp, tn and fn of two sets of strict keys."""
+  tp = len(annot_keys & pred_keys)
+  return tp, len(annot_keys) - tp, len(pred_keys) - tp
+
+
+def _strict_mentions(keys: Iterable[Tuple[int, Text, Text]]) -> Set[Any]:
+  """Strict keys of the mentions that are scored, i.e. not bridged."""
+  return {key for key in keys if _has_start(key[0])}
+
+
+def overlap(ent1: Entity, ent2: Entity) -> bool:
+  """Returns whether two entities overlap at least with 90% F1."""
+  if (ent1.start_offset == -1 or ent1.end_offset == -1 or
+      ent2.start_offset == -1 or ent2.end_offset == -1):
+    return (ent1.start_offset, ent1.end_offset, ent2.start_offset,
+            ent2.end_offset) == (-1, -1, -1, -1)
+
+  # Compute F1 as follows:
+  #   F1 = tp / (tp + (fp + fn) / 2)
+  #   [------ ent1 --------]
+  #             [------- ent2 -----]
+  #   [-- fn --][--- tp ---][- fp -]
+  tp = abs(ent1.end_offset - ent2.start_offset)
+  fn = abs(ent2.start_offset - ent1.start_offset)
+  fp = abs(ent2.end_offset - ent1.end_offset)
+  f1 = tp / (tp + (fp + fn) / 2) if tp else 0.0
+  return f1 >= MIN_F1_FOR_NON_STRICT_OVERLAP
+
+
+def _overlap_window(entity: Entity) -> int:
+  """Bound on the start offset distance of entities that overlap entity.
+
+  overlap(other, entity) needs tp >= 4.5 * (fp + fn), and tp is at most
+  fp + |entity length|, so fp and fn = |other start - entity start| are both
+  at most |entity length| / 3.5. The same bound holds for overlap(entity,
+  other), where tp is at most fn + |entity length|. A third of the length
+  plus one leaves room for rounding.
+
+  Args:
+    entity: an entity without -1 offsets.
+
+  Returns:
+    The maximum |other.start_offset - entity.start_offset| of the entities
+    other for which overlap(other, entity) can be true.
+  """
+  return abs(entity.end_offset - entity.start_offset) // 3 + 1
+
+
+def _non_strict_mention_tp(annotation: Collection[Entity],
+                           prediction: Collection[Entity]) -> int:
+  """Number of annotated entities that some predicted entity matches.
+
+  An annotated entity matches a predicted one if their normalized texts are
+  equal and they overlap. Instead of comparing all pairs, the predicted
+  entities are bucketed by normalized text and sorted by start offset within
+  each bucket, and overlap() is only called on the ones of the annotated
+  entity's bucket that start within its _overlap_window. Entities with -1
+  offsets only ever overlap entities whose offsets are all -1, which is a set
+  lookup.
+
+  Args:
+    annotation: annotated entities.
+    prediction: predicted entities.
+
+  Returns:
+    The number of annotated entities with a match, as the nested loops of
+    compare-all-pairs scoring would count them.
+  """
+  tp = 0
+  if len(annotation) * len(prediction) <= MAX_PAIRS_WITHOUT_INDEX:
+    for annot_entity in annotation:
+      for pred_entity in prediction:
+        if pred_entity.normalized_text == annot_entity.normalized_text:
+          if overlap(pred_entity, annot_entity):
+            tp += 1
+            break
+    return tp
+  bridged_texts = set()
+  buckets = collections.defaultdict(list)
+  for entity in prediction:
+    if entity.start_offset == -1 or entity.end_offset == -1:
+      if entity.start_offset == entity.end_offset:
+        bridged_texts.add(entity.normalized_text)
+    else:
+      buckets[entity.normalized_text].append(entity)
+  index = {}
+  for text, spans in buckets.items():
+    spans.sort(key=lambda entity: entity.start_offset)
+    index[text] = spans, [entity.start_offset for entity in spans]
+  for annot_entity in annotation:
+    start = annot_entity.start_offset
+    if start == -1 or annot_entity.end_offset == -1:
+      if (start == annot_entity.end_offset and
+          annot_entity.normalized_text in bridged_texts):
+        tp += 1
+      continue
+    bucket = index.get(annot_entity.normalized_text)
+    if bucket is None:
+      continue
+    spans, starts = bucket
+    window = _overlap_window(annot_entity)
+    for i in range(
+        bisect.bisect_left(starts, start - window),
+        bisect.bisect_right(starts, start + window)):
+      if overlap(spans[i], annot_entity):
+        tp += 1
+        break
+  return tp
+
+
+def _non_strict_alignment_tp(
+    annotation: Collection[Tuple[Entity, Entity]],
+    prediction: Collection[Tuple[Entity, Entity]]) -> int:
+  """Number of annotated alignments that some predicted alignment matches.
+
+  An annotated alignment matches a predicted one if the normalized texts of
+  both their question and context entities are equal and both entities
+  overlap. The predicted alignments are bucketed by the normalized texts of
+  their entities, so that overlap() is only called on the ones of the
+  annotated alignment's bucket.
+
+  Args:
+    annotation: annotated (question, context) entity pairs.
+    prediction: predicted (question, context) entity pairs.
+
+  Returns:
+    The number of annotated alignments with a match, as the nested loops of
+    compare-all-pairs scoring would count them.
+  """
+  tp = 0
+  if len(annotation) * len(prediction) <= MAX_PAIRS_WITHOUT_INDEX:
+    for annot_q_ent, annot_doc_ent in annotation:
+      for pred_q_ent, pred_doc_ent in prediction:
+        if pred_q_ent.normalized_text == annot_q_ent.normalized_text:
+          if annot_doc_ent.normalized_text == pred_doc_ent.normalized_text:
+            if overlap(pred_q_ent, annot_q_ent):
+              if overlap(pred_doc_ent, annot_doc_ent):
+                tp += 1
+                break
+    return tp
+  buckets = collections.defaultdict(list)
+  for pred_q_ent, pred_doc_ent in prediction:
+    buckets[pred_q_ent.normalized_text, pred_doc_ent.normalized_text].append(
+        (pred_q_ent, pred_doc_ent))
+  for annot_q_ent, annot_doc_ent in annotation:
+    for pred_q_ent, pred_doc_ent in buckets.get(
+        (annot_q_ent.normalized_text, annot_doc_ent.normalized_text), ()):
+      if overlap(pred_q_ent, annot_q_ent):
+        if overlap(pred_doc_ent, annot_doc_ent):
+          tp += 1
+          break
+  return tp
+
+
+def compute_mention_score(annotation: Collection[Entity],
+                          prediction: Collection[Entity],
+                          strict: bool) -> Tuple[float, float, float]:
+  """Computes mention identification performance."""
+  if strict:
+    tp, tn, fn = _strict_counts(
+        _strict_mentions(strict_keys(annotation)),
+        _strict_mentions(strict_keys(prediction)))
+  else:
+    tp = _non_strict_mention_tp(annotation, prediction)
+    tn = len(annotation) - tp
+    fn = len(prediction) - tp
+  return tp, tn, fn
+
+
+def compute_alignment_score(annotation: QEDExample, prediction: QEDExample,
+                            strict: bool) -> Tuple[float, float, float]:
+  """Computes the alignment match score."""
+  if strict:
+    tp, tn, fn = _strict_counts(
+        set(aligned_strict_keys(annotation.aligned_nps)),
+        set(aligned_strict_keys(prediction.aligned_nps)))
+  else:
+    tp = _non_strict_alignment_tp(annotation.aligned_nps,
+                                  prediction.aligned_nps)
+    tn = len(annotation.aligned_nps) - tp
+    fn = len(prediction.aligned_nps) - tp
+  return tp, tn, fn
+
+
+def compute_prf1(tp, tn, fn) -> Tuple[float, float, float]:
+  """Computes precistion, recall and f1 from true/false positives/negatives."""
+  if tp > 0:
+    p, r = tp / (tp + fn), tp / (tp + tn)
+    f1 = 2 * p * r / (p + r)
+  else:
+    p, r, f1 = 0.0, 0.0, 0.0
+  return p, r, f1
+
+
+def is_permutation_matrix(matrix: List[List[bool]]) -> bool:
+  """Returns whether the given boolean matrix is a permutation matrix."""
+  return (all(sum(v) == 1 for v in matrix) and
+          sum(any(v) for v in matrix) == len(matrix))
+
+
+@dataclasses.dataclass(frozen=True)
+class AnswerIndex:
+  """The distinct annotated answers of an example, indexed for matching.
+
+  A predicted answer matches an annotated one if each annotated span matches
+  exactly one predicted span, which is what is_permutation_matrix checks on
+  their match matrix. Only the set of annotated spans matters for that, so
+  answers with the same spans, such as NQ answers that repeat the QED answer,
+  are kept once.
+  """
+  # Strict keys of the spans of each distinct answer.
+  strict_answers: Tuple[FrozenSet[Tuple[int, Text, Text]], ...]
+  # Spans of each distinct answer, one entity per distinct (start_offset,
+  # end_offset), which is all that non-strict matching compares.
+  answer_spans: Tuple[Tuple[Entity, ...], ...]
+
+
+def answer_index(annotation: QEDExample) -> AnswerIndex:
+  """Returns the AnswerIndex of annotation, building it on first use.
+
+  The index is kept on the annotation, so that it is built once however many
+  predictions are scored against it.
+
+  Args:
+    annotation: an annotated QEDExample.
+
+  Returns:
+    The index of annotation.answer and annotation.nq_answers, in that order.
+  """
+  index = annotation.answer_index
+  if index is None:
+    answers = [annotation.answer] + annotation.nq_answers
+    index = AnswerIndex(
+        strict_answers=tuple(
+            dict.fromkeys(
+                frozenset(strict_keys(answer)) for answer in answers)),
+        answer_spans=tuple(
+            dict.fromkeys(
+                tuple({(entity.start_offset, entity.end_offset): entity
+                       for entity in answer}.values())
+                for answer in answers)))
+    annotation.answer_index = index
+  return index
+
+
+def compute_answer_accuracy(annotation: QEDExample, prediction: QEDExample,
+                            strict: bool) -> float:
+  """Checks whether the predicted answer matches any of the annotated ones."""
+  index = answer_index(annotation)
+  if strict:
+    return _strict_answer_accuracy(index.strict_answers, prediction)
+  return _non_strict_answer_accuracy(index.answer_spans, prediction)
+
+
+def _strict_answer_accuracy(
+    annot_answers: Sequence[FrozenSet[Tuple[int, Text, Text]]],
+    prediction: QEDExample) -> float:
+  """compute_answer_accuracy(strict=True) given AnswerIndex.strict_answers."""
+  # Strict matching compares strict keys, which is what Entity.__eq__ does.
+  # An annotated span matches exactly one predicted span if its key occurs
+  # once in the prediction.
+  keys = strict_keys(prediction.answer)
+  unique_keys = set(keys)
+  if len(unique_keys) < len(keys):
+    unique_keys = {key for key in unique_keys if keys.count(key) == 1}
+  for annot_keys in annot_answers:
+    if annot_keys <= unique_keys:
+      return 1.0
+  return 0.0
+
+
+def _non_strict_answer_accuracy(annot_answers: Sequence[Sequence[Entity]],
+                                prediction: QEDExample) -> float:
+  """compute_answer_accuracy(strict=False) given AnswerIndex.answer_spans.
+
+  The predicted spans are sorted by start offset, so that the ones an
+  annotated span can overlap are found by bisecting its _overlap_window.
+
+  Args:
+    annot_answers: the spans of each distinct annotated answer.
+    prediction: the predicted QEDExample.
+
+  Returns:
+    1.0 if every span of some annotated answer overlaps exactly one predicted
+    span, else 0.0.
+  """
+  num_bridged = 0
+  spans = []
+  for entity in prediction.answer:
+    if entity.start_offset == -1 or entity.end_offset == -1:
+      if entity.start_offset == entity.end_offset:
+        num_bridged += 1
+    else:
+      spans.append(entity)
+  spans.sort(key=lambda entity: entity.start_offset)
+  starts = [entity.start_offset for entity in spans]
+  for annot_answer in annot_answers:
+    for annot_entity in annot_answer:
+      start = annot_entity.start_offset
+      if start == -1 or annot_entity.end_offset == -1:
+        # Only overlaps predicted spans whose offsets are all -1 as well.
+        matches = num_bridged if start == annot_entity.end_offset else 0
+      else:
+        matches = 0
+        window = _overlap_window(annot_entity)
+        for i in range(
+            bisect.bisect_left(starts, start - window),
+            bisect.bisect_right(starts, start + window)):
+          if overlap(annot_entity, spans[i]):
+            matches += 1
+            if matches > 1:
+              break
+      if matches != 1:
+        break
+    else:
+      return 1.0
+  return 0.0
+
+
+@dataclasses.dataclass
+class ScoreCounts:
+  """Mention, alignment and answer counts accumulated over scored examples."""
+  q_tp: int = 0
+  q_tn: int = 0
+  q_fn: int = 0
+  c_tp: int = 0
+  c_tn: int = 0
+  c_fn: int = 0
+  pair_tp: int = 0
+  pair_tn: int = 0
+  pair_fn: int = 0
+  completely_correct: float = 0.0
+  correct_answers: float = 0.0
+  answers: int = 0
+
+  def add(self, other: 'ScoreCounts') -> 'ScoreCounts':
+    """Adds the counts of other to this one in place and returns self."""
+    # Spelled out since this runs once per scored example.
+    self.q_tp += other.q_tp
+    self.q_tn += other.q_tn
+    self.q_fn += other.q_fn
+    self.c_tp += other.c_tp
+    self.c_tn += other.c_tn
+    self.c_fn += other.c_fn
+    self.pair_tp += other.pair_tp
+    self.pair_tn += other.pair_tn
+    self.pair_fn += other.pair_fn
+    self.completely_correct += other.completely_correct
+    self.correct_answers += other.correct_answers
+    self.answers += other.answers
+    return self
+
+  def subtract(self, other: 'ScoreCounts') -> 'ScoreCounts':
+    """Subtracts the counts of other from this one in place and returns self."""
+    for field in dataclasses.fields(ScoreCounts):
+      setattr(self, field.name,
+              getattr(self, field.name) - getattr(other, field.name))
+    return self
+
+
+def score_example(annotation: QEDExample, prediction: QEDExample,
+                  strict: bool) -> ScoreCounts:
+  """Scores a single prediction against its annotation."""
+  if strict:
+    return _score_example_strict(annotation, prediction)
+  q_tp, q_tn, q_fn = compute_mention_score(
+      [nps[0] for nps in annotation.aligned_nps],
+      [nps[0] for nps in prediction.aligned_nps], strict)
+  c_tp, c_tn, c_fn = compute_mention_score(
+      [nps[1] for nps in annotation.aligned_nps],
+      [nps[1] for nps in prediction.aligned_nps], strict)
+  pair_tp, pair_tn, pair_fn = compute_alignment_score(
+      annotation, prediction, strict)
+  return ScoreCounts(
+      q_tp=q_tp, q_tn=q_tn, q_fn=q_fn,
+      c_tp=c_tp, c_tn=c_tn, c_fn=c_fn,
+      pair_tp=pair_tp, pair_tn=pair_tn, pair_fn=pair_fn,
+      completely_correct=1.0 if pair_tn + pair_fn == 0 else 0.0,
+      correct_answers=compute_answer_accuracy(annotation, prediction, strict),
+      answers=1)
+
+
+def _score_example_strict(annotation: QEDExample,
+                          prediction: QEDExample) -> ScoreCounts:
+  """score_example(strict=True), reading each entity's strict key once."""
+  return _score_strict_keys(_strict_annotation_keys(annotation), prediction)
+
+
+def _strict_annotation_keys(annotation: QEDExample) -> Tuple[Any, ...]:
+  """The strict keys that predictions of annotation are compared against.
+
+  Args:
+    annotation: an annotated QEDExample.
+
+  Returns:
+    The question mention, context mention and alignment strict key sets, and
+    the AnswerIndex.strict_answers of annotation.
+  """
+  annot_pairs = aligned_strict_keys(annotation.aligned_nps)
+  return (_strict_mentions(q for q, _ in annot_pairs),
+          _strict_mentions(c for _, c in annot_pairs), set(annot_pairs),
+          answer_index(annotation).strict_answers)
+
+
+def _score_strict_keys(annotation_keys: Tuple[Any, ...],
+                       prediction: QEDExample) -> ScoreCounts:
+  """Strictly scores prediction against _strict_annotation_keys."""
+  annot_q, annot_c, annot_pairs, annot_answers = annotation_keys
+  pred_pairs = aligned_strict_keys(prediction.aligned_nps)
+  q_tp, q_tn, q_fn = _strict_counts(
+      annot_q, _strict_mentions(q for q, _ in pred_pairs))
+  c_tp, c_tn, c_fn = _strict_counts(
+      annot_c, _strict_mentions(c for _, c in pred_pairs))
+  pair_tp, pair_tn, pair_fn = _strict_counts(annot_pairs, set(pred_pairs))
+  return ScoreCounts(
+      q_tp=q_tp, q_tn=q_tn, q_fn=q_fn,
+      c_tp=c_tp, c_tn=c_tn, c_fn=c_fn,
+      pair_tp=pair_tp, pair_tn=pair_tn, pair_fn=pair_fn,
+      completely_correct=1.0 if pair_tn + pair_fn == 0 else 0.0,
+      correct_answers=_strict_answer_accuracy(annot_answers, prediction),
+      answers=1)
+
+
+def scores_from_counts(
+    counts: ScoreCounts,
+    num_annotations: int) -> Mapping[Text, Union[float, Tuple[float, float,
+                                                                float]]]:
+  """Turns accumulated counts into the score dict returned by compute_scores.
+
+  Args:
+    counts: counts summed over all examples that have a prediction.
+    num_annotations: number of annotated examples, including the ones without
+      a prediction. Used as the denominator of exact_match_accuracy.
+
+  Returns:
+    The score dict described in the qed_eval module docstring.
+  """
+  question_mention_p, question_mention_r, question_mention_f1 = compute_prf1(
+      counts.q_tp, counts.q_tn, counts.q_fn)
+  context_mention_p, context_mention_r, context_mention_f1 = compute_prf1(
+      counts.c_tp, counts.c_tn, counts.c_fn)
+  mention_p, mention_r, mention_f1 = compute_prf1(counts.q_tp + counts.c_tp,
+                                                  counts.q_tn + counts.c_tn,
+                                                  counts.q_fn + counts.c_fn)
+  pair_p, pair_r, pair_f1 = compute_prf1(counts.pair_tp, counts.pair_tn,
+                                         counts.pair_fn)
+  logging.info('# of examples completely correct: %d',
+               counts.completely_correct)
+  score_dict = {
+      'exact_match_accuracy':
+          counts.completely_correct / num_annotations,
+      'question_mention':
+          (question_mention_p, question_mention_r, question_mention_f1),
+      'context_mention':
+          (context_mention_p, context_mention_r, context_mention_f1),
+      'all_mention': (mention_p, mention_r, mention_f1),
+      'pair': (pair_p, pair_r, pair_f1),
+      'answer_accuracy':
+          (counts.correct_answers / counts.answers if counts.answers else 0.0)
+  }
+  logging.info('Question mention P/R/F1 %.4f %.4f %.4f', question_mention_p,
+               question_mention_r, question_mention_f1)
+  logging.info('Context mention P/R/F1 %.4f %.4f %.4f', context_mention_p,
+               context_mention_r, context_mention_f1)
+  logging.info('Both Mention P/R/F1 %.4f %.4f %.4f', mention_p, mention_r,
+               mention_f1)
+  logging.info('Pair P/R/F1 %.4f %.4f %.4f', pair_p, pair_r, pair_f1)
+  return score_dict
+
+
+def _counts_from_array(
+    counts_array, shard: List[Tuple[QEDExample, QEDExample]]) -> ScoreCounts:
+  """Builds the ScoreCounts of a shard from its per-pair count array.
+
+  Args:
+    counts_array: [len(shard), 9] NumPy array of question mention, context
+      mention and pair tp/tn/fn counts, as returned by
+      qed_vectorized.mention_and_alignment_counts.
+    shard: the (annotation, prediction) pairs counts_array was computed for.
+
+  Returns:
+    The ScoreCounts summed over the shard, equal to summing score_example over
+    it non-strictly.
+  """
+  counts = ScoreCounts(answers=len(shard))
+  (counts.q_tp, counts.q_tn, counts.q_fn, counts.c_tp, counts.c_tn,
+   counts.c_fn, counts.pair_tp, counts.pair_tn,
+   counts.pair_fn) = (int(value) for value in counts_array.sum(axis=0))
+  # Completely correct examples have no pair tn or fn.
+  counts.completely_correct = float(
+      (counts_array[:, 7:9].sum(axis=1) == 0).sum())
+  for annotation, prediction in shard:
+    counts.correct_answers += compute_answer_accuracy(
+        annotation, prediction, strict=False)
+  return counts
+
+
+def _score_shard(shard: List[Tuple[QEDExample, QEDExample]],
+                 strict: bool) -> ScoreCounts:
+  """Scores a list of (annotation, prediction) pairs.
+
+  Non-strict scoring goes through the vectorized engine in qed_vectorized when
+  NumPy is available, which gives the same counts as score_example.
+
+  Args:
+    shard: (annotation, prediction) pairs to score.
+    strict: whether to enforce strict match.
+
+  Returns:
+    The ScoreCounts summed over the shard.
+  """
+  if not strict and shard:
+    try:
+      import qed_vectorized  # pylint: disable=g-import-not-at-top
+    except ImportError:  # NumPy is not installed.
+      pass
+    else:
+      return _counts_from_array(
+          qed_vectorized.mention_and_alignment_counts(
+              shard, MIN_F1_FOR_NON_STRICT_OVERLAP,
+              _instrumentation_counters()), shard)
+  counts = ScoreCounts()
+  for annotation, prediction in shard:
+    counts.add(score_example(annotation, prediction, strict))
+  return counts
+
+
+def _shards(pairs: List[Tuple[QEDExample, QEDExample]],
+            num_workers: int) -> List[List[Tuple[QEDExample, QEDExample]]]:
+  """Splits pairs into consecutive shards for num_workers processes."""
+  # A few shards per worker so that a slow shard does not hold up the rest.
+  shard_size = -(-len(pairs) // (num_workers * SHARDS_PER_WORKER))
+  return [pairs[i:i + shard_size] for i in range(0, len(pairs), shard_size)]
+
+
+def _score_examples(shard: List[Tuple[QEDExample, QEDExample]],
+                    strict: bool) -> List[ScoreCounts]:
+  """Like _score_shard, but returns the ScoreCounts of each pair."""
+  if not strict and shard:
+    try:
+      import qed_vectorized  # pylint: disable=g-import-not-at-top
+    except ImportError:  # NumPy is not installed.
+      pass
+    else:
+      counts_array = qed_vectorized.mention_and_alignment_counts(
+          shard, MIN_F1_FOR_NON_STRICT_OVERLAP, _instrumentation_counters())
+      return [
+          ScoreCounts(
+              *row,
+              completely_correct=1.0 if row[7] + row[8] == 0 else 0.0,
+              correct_answers=compute_answer_accuracy(
+                  annotation, prediction, strict=False),
+              answers=1)
+          for row, (annotation, prediction) in zip(counts_array.tolist(), shard)
+      ]
+  return [
+      score_example(annotation, prediction, strict)
+      for annotation, prediction in shard
+  ]
+
+
+def compute_scores(
+    annotation_dict: Mapping[int,
+                             QEDExample], prediction_dict: Mapping[int,
+                                                                   QEDExample],
+    strict: bool,
+    num_workers: int = 1,
+    example_counts: Optional[List[ScoreCounts]] = None
+) -> Mapping[Text, Union[float, Tuple[float, float, float]]]:
+  """Compute scores.
+
+  Args:
+    annotation_dict: annotated examples keyed by example id.
+    prediction_dict: predicted examples keyed by example id.
+    strict: whether to enforce strict match.
+    num_workers: number of processes to score examples in. With more than one
+      worker the examples are split into shards whose ScoreCounts are summed
+      up, which gives the same scores as scoring them in this process.
+    example_counts: if given, this list is extended with the ScoreCounts of
+      every annotated example, in the order of annotation_dict. Examples
+      without prediction get all-zero counts. These are the per-example count
+      vectors that qed_stats resamples for confidence intervals and
+      significance tests.
+
+  Returns:
+    The score dict described in the qed_eval module docstring.
+  """
+  if example_counts is not None:
+    return _compute_scores_per_example(annotation_dict, prediction_dict,
+                                       strict, num_workers, example_counts)
+  pairs = []
+  for example_id in annotation_dict:
+    if example_id not in prediction_dict:
+      logging.info('Missing prediction for id %d', example_id)
+    else:
+      pairs.append((annotation_dict[example_id], prediction_dict[example_id]))
+  if num_workers > 1 and pairs:
+    with _process_pool(num_workers) as executor:
+      counts = functools.reduce(
+          ScoreCounts.add,
+          executor.map(_score_shard, _shards(pairs, num_workers),
+                       itertools.repeat(strict)), ScoreCounts())
+  else:
+    counts = _score_shard(pairs, strict)
+  return scores_from_counts(counts, len(annotation_dict))
+
+
+def _compute_scores_per_example(
+    annotation_dict: Mapping[int, QEDExample],
+    prediction_dict: Mapping[int, QEDExample], strict: bool, num_workers: int,
+    example_counts: List[ScoreCounts]
+) -> Mapping[Text, Union[float, Tuple[float, float, float]]]:
+  """compute_scores that also reports the counts of each annotated example."""
+  pairs = [(annotation, prediction_dict[example_id])
+           for example_id, annotation in annotation_dict.items()
+           if example_id in prediction_dict]
+  if num_workers > 1 and pairs:
+    with _process_pool(num_workers) as executor:
+      scored = list(
+          itertools.chain.from_iterable(
+              executor.map(_score_examples, _shards(pairs, num_workers),
+                           itertools.repeat(strict))))
+  else:
+    scored = _score_examples(pairs, strict)
+  scored = iter(scored)
+  counts = ScoreCounts()
+  for example_id in annotation_dict:
+    if example_id not in prediction_dict:
+      logging.info('Missing prediction for id %d', example_id)
+      example_counts.append(ScoreCounts())
+    else:
+      example_count = next(scored)
+      counts.add(example_count)
+      example_counts.append(example_count)
+  return scores_from_counts(counts, len(annotation_dict))
+
+
+def _score_systems_shard(
+    shard: List[Tuple[QEDExample, List[Optional[QEDExample]]]], strict: bool,
+    num_systems: int) -> List[ScoreCounts]:
+  """Scores the predictions of several systems, one annotation at a time.
+
+  Whatever scoring needs from an annotation, i.e. its strict keys or, through
+  qed_vectorized, the arrays of its spans and normalized texts, is computed
+  once and compared against the predictions of all systems.
+
+  Args:
+    shard: (annotation, predictions) pairs, where predictions holds the
+      prediction of each system, or None where a system has none.
+    strict: whether to enforce strict match.
+    num_systems: number of systems.
+
+  Returns:
+    The ScoreCounts of each system summed over the shard.
+  """
+  counts = [ScoreCounts() for _ in range(num_systems)]
+  if not strict and shard:
+    try:
+      import qed_vectorized  # pylint: disable=g-import-not-at-top
+    except ImportError:  # NumPy is not installed.
+      pass
+    else:
+      counts_arrays = qed_vectorized.multi_system_counts(
+          [annotation for annotation, _ in shard],
+          [[predictions[i] for _, predictions in shard]
+           for i in range(num_systems)], MIN_F1_FOR_NON_STRICT_OVERLAP,
+          _instrumentation_counters())
+      for i, (system_counts,
+              counts_array) in enumerate(zip(counts, counts_arrays)):
+        rows = [
+            row for row, (_, predictions) in enumerate(shard)
+            if predictions[i] is not None
+        ]
+        system_counts.add(
+            _counts_from_array(counts_array[rows],
+                               [(shard[row][0], shard[row][1][i])
+                                for row in rows]))
+      return counts
+  for annotation, predictions in shard:
+    if strict:
+      annotation_keys = _strict_annotation_keys(annotation)
+    for system_counts, prediction in zip(counts, predictions):
+      if prediction is None:
+        continue
+      if strict:
+        system_counts.add(_score_strict_keys(annotation_keys, prediction))
+      else:
+        system_counts.add(score_example(annotation, prediction, strict))
+  return counts
+
+
+def compute_multi_scores(
+    annotation_dict: Mapping[int, QEDExample],
+    prediction_dicts: Mapping[Text, Mapping[int, QEDExample]],
+    strict: bool,
+    num_workers: int = 1
+) -> Mapping[Text, Mapping[Text, Union[float, Tuple[float, float, float]]]]:
+  """Scores several systems against the same annotations in a single pass.
+
+  Gives the same scores as calling compute_scores once per system, but walks
+  annotation_dict only once and scores all systems' predictions of an example
+  together, so that the annotation side of the comparison is shared.
+
+  Args:
+    annotation_dict: annotated examples keyed by example id.
+    prediction_dicts: the predicted examples of each system keyed by example
+      id, keyed by system name.
+    strict: whether to enforce strict match.
+    num_workers: number of processes to score examples in, as in
+      compute_scores.
+
+  Returns:
+    The score dict of each system, keyed by system name.
+  """
+  names = list(prediction_dicts)
+  rows = []
+  for example_id, annotation in annotation_dict.items():
+    predictions = [prediction_dicts[name].get(example_id) for name in names]
+    for name, prediction in zip(names, predictions):
+      if prediction is None:
+        logging.info('Missing prediction for id %d in %s', example_id, name)
+    if any(prediction is not None for prediction in predictions):
+      rows.append((annotation, predictions))
+  if num_workers > 1 and rows:
+    with _process_pool(num_workers) as executor:
+      counts = [ScoreCounts() for _ in names]
+      for shard_counts in executor.map(_score_systems_shard,
+                                       _shards(rows, num_workers),
+                                       itertools.repeat(strict),
+                                       itertools.repeat(len(names))):
+        for system_counts, other in zip(counts, shard_counts):
+          system_counts.add(other)
+  else:
+    counts = _score_systems_shard(rows, strict, len(names))
+  return {
+      name: scores_from_counts(system_counts, len(annotation_dict))
+      for name, system_counts in zip(names, counts)
+  }
+
+
+def format_score_table(
+    score_dicts: Mapping[Text, Mapping[Text, Union[float, Tuple[float, float,
+                                                                  float]]]]
+) -> Text:
+  """Formats score dicts as a table with one column per system.
+
+  Args:
+    score_dicts: score dicts keyed by system name, as returned by
+      compute_multi_scores.
+
+  Returns:
+    The table, with one row per score and P/R/F1 scores split into three rows.
+  """
+  rows = [['score'] + list(score_dicts)]
+  for metric in SCORE_NAMES:
+    values = [score_dict[metric] for score_dict in score_dicts.values()]
+    if isinstance(values[0], tuple):
+      for i, suffix in enumerate(('p', 'r', 'f1')):
+        rows.append(['%s_%s' % (metric, suffix)] +
+                    ['%.4f' % value[i] for value in values])
+    else:
+      rows.append([metric] + ['%.4f' % value for value in values])
+  widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+  return '\n'.join(
+      '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+      for row in rows)
+
+
+def expand_paths(patterns: Iterable[Text]) -> List[Text]:
+  """Expands glob patterns into sorted paths; other paths are kept as is."""
+  paths = []
+  for pattern in patterns:
+    matches = [pattern]
+    if any(c in pattern for c in '*?['):
+      import glob  # pylint: disable=g-import-not-at-top
+      matches = sorted(glob.glob(pattern)) or matches
+    for path in matches:
+      if path not in paths:
+        paths.append(path)
+  return paths
+
+
+def _unique_sorted_examples(examples: Iterable[Optional[QEDExample]],
+                            name: Text) -> Iterator[QEDExample]:
+  """Yields examples that are sorted by example_id, without duplicates.
+
+  Consecutive examples with the same example_id are collapsed into the last
+  one, as load_data would do.
+
+  Args:
+    examples: the examples, sorted by example_id. None values are skipped.
+    name: name of the file the examples come from, for error messages.
+
+  Yields:
+    The examples by increasing example_id.
+
+  Raises:
+    ValueError: if the examples are not sorted by example_id.
+  """
+  previous = None
+  for example in examples:
+    if example is None:
+      continue
+    if previous is not None:
+      if example.example_id < previous.example_id:
+        raise ValueError(
+            '%s is not sorted by example_id: %d comes after %d.' %
+            (name, example.example_id, previous.example_id))
+      if example.example_id != previous.example_id:
+        yield previous
+    previous = example
+  if previous is not None:
+    yield previous
+
+
+def _iter_sorted_examples(fname: Text,
+                          fast_json: bool = False) -> Iterator[QEDExample]:
+  """Yields the single_sentence examples of a jsonl file sorted by example_id.
+
+  See _unique_sorted_examples.
+  """
+  return _unique_sorted_examples(iter_examples(fname, fast_json), fname)
+
+
+def _write_run(records: Iterable[Tuple[int, Text]], fname: Text) -> None:
+  """Writes (example_id, line) records to a run file of an external sort."""
+  with open(fname, 'w', encoding='utf-8') as f:
+    for example_id, line in records:
+      f.write('%d\t%s' % (example_id, line))
+
+
+def _read_run(fname: Text) -> Iterator[Tuple[int, Text]]:
+  """Yields the (example_id, line) records of a run file."""
+  with open(fname, encoding='utf-8') as f:
+    for record in f:
+      example_id, line = record.split('\t', 1)
+      yield int(example_id), line
+
+
+def _sorted_runs(fnames: Sequence[Text], memory_budget: int, run_dir: Text,
+                 loads: Callable[[Text], Any],
+                 counters: MutableMapping[Text, int]) -> List[Text]:
+  """Splits jsonl files into runs of lines sorted by example_id.
+
+  Args:
+    fnames: paths to the jsonl files, which may be compressed.
+    memory_budget: number of characters of lines to sort in memory at once.
+    run_dir: directory to write the runs to.
+    loads: the json decoder to read example_ids with.
+    counters: incremented at 'examples_read' and 'incorrectly_formatted' for
+      every line that is not valid json, which is skipped like in
+      parse_lines.
+
+  Returns:
+    Paths of the run files, in input order. Lines with the same example_id
+    keep their input order, within and across runs.
+  """
+  runs = []
+  records = []
+  size = 0
+
+  def spill():
+    records.sort(key=lambda record: record[0])  # Stable, keeps line order.
+    runs.append(os.path.join(run_dir, 'run-%06d' % len(runs)))
+    _write_run(records, runs[-1])
+    records.clear()
+
+  for fname in fnames:
+    with open_jsonl(fname) as f:
+      for line in f:
+        try:
+          example_id = loads(line)['example_id']
+        except ValueError:
+          counters['examples_read'] += 1
+          counters['incorrectly_formatted'] += 1
+          continue
+        if not line.endswith('\n'):
+          line += '\n'
+        records.append((example_id, line))
+        size += len(line)
+        if size >= memory_budget:
+          spill()
+          size = 0
+  if records:
+    spill()
+  return runs
+
+
+def _merge_runs(runs: List[Text], run_dir: Text) -> Iterator[Tuple[int, Text]]:
+  """Merges sorted runs, keeping the order of equal example_ids across runs.
+
+  Args:
+    runs: paths of the runs, in input order.
+    run_dir: directory to write intermediate runs to.
+
+  Yields:
+    The (example_id, line) records of all runs, sorted by example_id.
+  """
+  while len(runs) > MAX_MERGE_RUNS:
+    merged = []
+    for i in range(0, len(runs), MAX_MERGE_RUNS):
+      group = runs[i:i + MAX_MERGE_RUNS]
+      merged.append('%s-%d' % (group[0], len(group)))
+      _write_run(
+          heapq.merge(*map(_read_run, group), key=lambda record: record[0]),
+          merged[-1])
+      for run in group:
+        os.remove(run)
+    runs = merged
+  yield from heapq.merge(*map(_read_run, runs), key=lambda record: record[0])
+
+
+def _iter_externally_sorted_examples(
+    pattern: Text, memory_budget: int, tmpdir: Optional[Text],
+    fast_json: bool) -> Iterator[QEDExample]:
+  """Yields the examples of jsonl files in any order, sorted by example_id.
+
+  The lines are sorted with an external merge sort: runs of at most about
+  memory_budget characters are sorted in memory and written to temporary
+  files, which are then merged while being read. Of several lines with the
+  same example_id the last one in input order wins, as in load_data.
+
+  Args:
+    pattern: path or glob pattern of the jsonl files, which may be
+      compressed.
+    memory_budget: number of characters of lines to sort in memory at once.
+    tmpdir: directory for the runs, or None for the default temporary
+      directory.
+    fast_json: whether to parse lines with orjson when it is installed.
+
+  Yields:
+    The single_sentence examples, by increasing example_id.
+  """
+  import tempfile  # pylint: disable=g-import-not-at-top
+  loads = _json_decoder(fast_json)
+  counters = collections.Counter()
+  with tempfile.TemporaryDirectory(dir=tmpdir) as run_dir:
+    runs = _sorted_runs(
+        expand_paths([pattern]), memory_budget, run_dir, loads, counters)
+    lines = (line for _, line in _merge_runs(runs, run_dir))
+    yield from _unique_sorted_examples(
+        parse_lines(lines, counters, loads), pattern)
+  _log_parse_counters(counters)
+
+
+def stream_scores(
+    annotation_fname: Text,
+    prediction_fname: Text,
+    strict: bool,
+    fast_json: bool = False,
+    memory_budget: Optional[int] = None,
+    tmpdir: Optional[Text] = None
+) -> Mapping[Text, Union[float, Tuple[float, float, float]]]:
+  """Computes the same scores as compute_scores without loading either file.
+
+  Both files must be sorted by increasing example_id, unless memory_budget is
+  set. They are merge-joined while being read line by line: each example is
+  scored as soon as its annotation and prediction are both available and
+  neither is kept afterwards, so memory stays flat whatever the size of the
+  files. As in load_data, the last of several lines with the same example_id
+  wins.
+
+  With memory_budget, the files may be in any order, sharded and compressed:
+  each is sorted first with an external merge sort that holds at most about
+  memory_budget characters of lines in memory, and spills sorted runs to
+  temporary files in tmpdir.
+
+  Args:
+    annotation_fname: path to the annotation jsonl file, or with
+      memory_budget a glob pattern of its shards.
+    prediction_fname: path to the prediction jsonl file, or with
+      memory_budget a glob pattern of its shards.
+    strict: whether to enforce strict match.
+    fast_json: whether to parse lines with orjson when it is installed.
+    memory_budget: number of characters of lines to sort in memory at once,
+      or None if the files are sorted.
+    tmpdir: directory for the sorted runs, or None for the default temporary
+      directory.
+
+  Returns:
+    The score dict described in the qed_eval module docstring.
+
+  Raises:
+    ValueError: if memory_budget is None and either file is not sorted by
+      example_id.
+  """
+  if memory_budget is None:
+    annotations = _iter_sorted_examples(annotation_fname, fast_json)
+    predictions = _iter_sorted_examples(prediction_fname, fast_json)
+  else:
+    annotations = _iter_externally_sorted_examples(
+        annotation_fname, memory_budget, tmpdir, fast_json)
+    predictions = _iter_externally_sorted_examples(
+        prediction_fname, memory_budget, tmpdir, fast_json)
+  counts = ScoreCounts()
+  num_annotations = 0
+  prediction = next(predictions, None)
+  for annotation in annotations:
+    num_annotations += 1
+    while (prediction is not None and
+           prediction.example_id < annotation.example_id):
+      prediction = next(predictions, None)
+    if (prediction is not None and
+        prediction.example_id == annotation.example_id):
+      counts.add(score_example(annotation, prediction, strict))
+    else:
+      logging.info('Missing prediction for id %d', annotation.example_id)
+  # Reads the remaining predictions to check that they are sorted as well.
+  for _ in predictions:
+    pass
+  return scores_from_counts(counts, num_annotations)
+
+
+class Evaluator:
+  """Scores predictions held in memory against preloaded annotations.
+
+  update() takes batches of predictions, either QEDExamples or dicts in the
+  jsonl format parsed with load_single_line, and result() returns the score
+  dict that compute_scores would return for all predictions seen so far.
+  Nothing is read from or written to disk, and prediction objects are not
+  kept: only the ScoreCounts contributed by each predicted example, so that
+  a later prediction with the same example_id replaces it like it would
+  replace it in load_data.
+  """
+
+  def __init__(self,
+               annotation_dict: Mapping[int, QEDExample],
+               strict: bool = False):
+    self._annotation_dict = annotation_dict
+    self._strict = strict
+    self.reset()
+
+  def reset(self) -> None:
+    """Forgets all predictions seen so far."""
+    self._counts = ScoreCounts()
+    self._contributions = {}
+    self._counters = collections.Counter()
+
+  @property
+  def num_predictions(self) -> int:
+    """Number of annotated examples that have a prediction so far."""
+    return len(self._contributions)
+
+  @property
+  def num_incorrectly_formatted(self) -> int:
+    """Number of prediction dicts that load_single_line rejected."""
+    return self._counters['incorrectly_formatted']
+
+  def update(self, predictions: Iterable[Union[QEDExample,
+                                               Mapping[Text, Any]]]) -> None:
+    """Scores a batch of predictions.
+
+    Args:
+      predictions: QEDExamples, or dicts in the jsonl format. Dicts that are
+        not correctly formatted are counted and skipped, like lines in
+        load_data. Examples whose explanation is not single_sentence and
+        examples without annotation are skipped too.
+    """
+    for prediction in predictions:
+      if not isinstance(prediction, QEDExample):
+        try:
+          prediction = load_single_line(prediction)
+        except ValueError:
+          self._counters['incorrectly_formatted'] += 1
+          continue
+      if (prediction.explanation_type != 'single_sentence' or
+          prediction.example_id not in self._annotation_dict):
+        continue
+      contribution = score_example(
+          self._annotation_dict[prediction.example_id], prediction,
+          self._strict)
+      previous = self._contributions.get(prediction.example_id)
+      if previous is not None:
+        self._counts.subtract(previous)
+      self._counts.add(contribution)
+      self._contributions[prediction.example_id] = contribution
+
+  def result(self) -> Mapping[Text, Union[float, Tuple[float, float, float]]]:
+    """Returns the score dict of all predictions seen so far."""
+    return scores_from_counts(self._counts, len(self._annotation_dict))
+
+
+class IncrementalEvaluator:
+  """Scores a prediction file that keeps growing while it is being scored.
+
+  Each call to refresh() parses only the complete lines appended since the
+  previous call and feeds them to an Evaluator. Each refresh returns the same
+  score dict as running compute_scores on the whole file.
+  """
+
+  def __init__(self, annotation_dict: Mapping[int, QEDExample],
+               prediction_fname: Text, strict: bool):
+    self._annotation_dict = annotation_dict
+    self._prediction_fname = prediction_fname
+    self._evaluator = Evaluator(annotation_dict, strict)
+    self._reset()
+
+  def _reset(self):
+    self._offset = 0
+    self._evaluator.reset()
+    self._counters = collections.Counter()
+
+  @property
+  def num_predictions(self) -> int:
+    """Number of annotated examples that have a prediction so far."""
+    return self._evaluator.num_predictions
+
+  def refresh(self) -> Mapping[Text, Union[float, Tuple[float, float, float]]]:
+    """Scores newly appended lines and returns the current score dict."""
+    with open(self._prediction_fname, 'rb') as f:
+      if os.fstat(f.fileno()).st_size < self._offset:
+        logging.warning('%s was truncated, scoring it from scratch.',
+                        self._prediction_fname)
+        self._reset()
+      f.seek(self._offset)
+      data = f.read()
+    # A trailing line without newline may still be being written.
+    data = data[:data.rfind(b'\n') + 1]
+    self._offset += len(data)
+    self._evaluator.update(
+        prediction
+        for prediction in parse_lines(
+            io.TextIOWrapper(io.BytesIO(data)), self._counters)
+        if prediction is not None)
+    logging.info('%d of %d examples predicted, %d lines not correctly '
+                 'formatted.', self._evaluator.num_predictions,
+                 len(self._annotation_dict),
+                 self._counters['incorrectly_formatted'])
+    return self._evaluator.result()
+
+
+# Number of prediction batches that AsyncEvaluator queues before update()
+# blocks.
+MAX_QUEUED_BATCHES = 8
+
+
+class AsyncEvaluator:
+  """Scores batches of predictions on a background thread.
+
+  update() only puts a batch on a bounded queue, so that a training loop does
+  not wait for scoring. The batches of each step are scored by an Evaluator
+  on a background thread, and result(step) returns a Future of the score dict
+  of all batches of that step once they are scored. When scoring falls
+  behind by max_queued_batches batches, update() blocks until there is room,
+  so that memory stays bounded.
+
+  Batches are scored in the order they were queued. Each step is scored
+  independently, and a later prediction for the same example_id replaces an
+  earlier one of the same step, as in Evaluator.
+  """
+
+  def __init__(self,
+               annotation_dict: Mapping[int, QEDExample],
+               strict: bool = False,
+               max_queued_batches: int = MAX_QUEUED_BATCHES):
+    import concurrent.futures  # pylint: disable=g-import-not-at-top
+    import queue  # pylint: disable=g-import-not-at-top
+    import threading  # pylint: disable=g-import-not-at-top
+    self._future_type = concurrent.futures.Future
+    self._annotation_dict = annotation_dict
+    self._strict = strict
+    self._queue = queue.Queue(max_queued_batches)
+    self._futures = {}
+    self._closed = False
+    self._thread = threading.Thread(
+        target=self._run, name='AsyncEvaluator', daemon=True)
+    self._thread.start()
+
+  @property
+  def futures(self) -> Mapping[int, 'concurrent.futures.Future']:
+    """The futures that result() returned, by step."""
+    return self._futures
+
+  def update(self, step: int,
+             predictions: Iterable[Union[QEDExample, Mapping[Text,
+                                                             Any]]]) -> None:
+    """Queues a batch of predictions, blocking while the queue is full.
+
+    Args:
+      step: the step the predictions belong to.
+      predictions: QEDExamples, or dicts in the jsonl format, as taken by
+        Evaluator.update. Iterators are read into a list first, the batch is
+        not copied otherwise and must not be changed until it is scored.
+
+    Raises:
+      ValueError: if the evaluator is closed or result(step) was called.
+    """
+    if self._closed:
+      raise ValueError('The AsyncEvaluator is closed.')
+    if step in self._futures:
+      raise ValueError('The predictions of step %d were already finished.' %
+                       step)
+    if not isinstance(predictions, collections.abc.Sequence):
+      predictions = list(predictions)
+    self._queue.put((step, predictions, None))
+
+  def result(self, step: int) -> 'concurrent.futures.Future':
+    """Finishes a step and returns the Future of its score dict.
+
+    Args:
+      step: the step, whose batches were all passed to update(). A step
+        without batches scores no predictions.
+
+    Returns:
+      A Future of the score dict that Evaluator.result would return for all
+      batches of the step. It holds the exception instead if scoring a batch
+      raised one.
+
+    Raises:
+      ValueError: if the evaluator is closed.
+    """
+    if step in self._futures:
+      return self._futures[step]
+    if self._closed:
+      raise ValueError('The AsyncEvaluator is closed.')
+    future = self._future_type()
+    self._futures[step] = future
+    self._queue.put((step, None, future))
+    return future
+
+  def close(self) -> None:
+    """Scores the queued batches and stops the background thread."""
+    if not self._closed:
+      self._closed = True
+      self._queue.put(None)
+      self._thread.join()
+
+  def __enter__(self) -> 'AsyncEvaluator':
+    return self
+
+  def __exit__(self, *exc_info) -> None:
+    self.close()
+
+  def _run(self) -> None:
+    """Scores queued batches until close() is called."""
+    evaluators = {}
+    errors = {}
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      step, predictions, future = item
+      if future is None:
+        if step in errors:
+          continue
+        if step not in evaluators:
+          evaluators[step] = Evaluator(self._annotation_dict, self._strict)
+        try:
+          evaluators[step].update(predictions)
+        except Exception as e:  # pylint: disable=broad-except
+          errors[step] = e
+        continue
+      evaluator = evaluators.pop(step, None)
+      error = errors.pop(step, None)
+      if not future.set_running_or_notify_cancel():
+        continue
+      if error is not None:
+        future.set_exception(error)
+        continue
+      try:
+        if evaluator is None:
+          evaluator = Evaluator(self._annotation_dict, self._strict)
+        future.set_result(evaluator.result())
+      except Exception as e:  # pylint: disable=broad-except
+        future.set_exception(e)
@@ -0,0 +1,90 @@
+# Lint as: python3
+"""Tests for qed_core."""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import qed_core
+import qed_eval
+import qed_eval_test
+from absl.testing import absltest
+
+# Generous upper bound on the time a fresh interpreter takes to import
+# qed_core, which is about 30ms on a single slow core.
+IMPORT_BUDGET_SECONDS = 0.5
+
+# Modules that qed_core must not import up front.
+HEAVY_MODULES = ("absl", "attr", "numpy", "concurrent", "multiprocessing",
+                 "mmap", "hashlib", "tracemalloc", "glob", "gzip", "bz2",
+                 "lzma")
+
+# Loads and scores a shard in a fresh interpreter, like a spawned worker.
+_WORKER = """
+import json, sys, time
+start = time.perf_counter()
+import qed_core
+imported = time.perf_counter()
+examples = qed_core.load_data(sys.argv[1])
+pairs = [(example, example) for example in examples.values()]
+counts = qed_core._score_shard(pairs, strict=True)
+print(json.dumps({
+    "import_seconds": imported - start,
+    "answers": counts.answers,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+
+class QedCoreTest(absltest.TestCase):
+
+  def run_worker(self, path):
+    output = subprocess.run(
+        [sys.executable, "-c", _WORKER, path],
+        cwd=os.path.dirname(os.path.abspath(qed_core.__file__)),
+        check=True,
+        stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+  def test_worker_cold_start(self):
+    tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    path = os.path.join(tmpdir, "shard.jsonl")
+    with open(path, "w") as f:
+      for example in (qed_eval_test.example_1, qed_eval_test.example_2):
+        f.write(json.dumps(json.loads(example)) + "\n")
+    worker = self.run_worker(path)
+    self.assertEqual(worker["answers"], 2)
+    self.assertLess(worker["import_seconds"], IMPORT_BUDGET_SECONDS)
+    self.assertEmpty([
+        module for module in worker["modules"]
+        if module.split(".")[0] in HEAVY_MODULES
+    ])
+
+  def test_qed_eval_reexports_core(self):
+    self.assertIs(qed_eval.load_data, qed_core.load_data)
+    self.assertIs(qed_eval.QEDExample, qed_core.QEDExample)
+    self.assertIn("compute_scores", dir(qed_eval))
+    with self.assertRaises(AttributeError):
+      qed_eval.no_such_name  # pylint: disable=pointless-statement
+    load_data = qed_core.load_data
+    with qed_core.instrumented():
+      # Calls through qed_eval see the instrumented functions.
+      self.assertIsNot(qed_eval.load_data, load_data)
+      self.assertIs(qed_eval.load_data, qed_core.load_data)
+    self.assertIs(qed_eval.load_data, load_data)
+
+  def test_entity_offsets_are_checked(self):
+    entity = qed_core.Entity(
+        start_offset=-1, end_offset=3, type="context", text="a",
+        normalized_text="a")
+    self.assertEqual(entity.end_offset, 3)
+    for offsets in ((-2, 3), (0, qed_core.MAX_OFFSET)):
+      with self.assertRaises(ValueError):
+        qed_core.Entity(*offsets, type="context", text="a",
+                        normalized_text="a")
+
+
+if __name__ == "__main__":
+  absltest.main()
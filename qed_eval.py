@@ -1,5 +1,9 @@
 r"""Methods for evaluating QED annotations.
 
+This module is the command line interface. The loading and scoring functions
+live in qed_core, which imports only the standard library and registers no
+flags; all of its names are also available from this module.
+
 This script is meant to be run in python3. All offsets are unicode char offsets.
 All start char offsets are inclusive and end char offsets are exclusive.
 All strings being operated on are assumed to be of type Text.
@@ -66,396 +70,301 @@ All strings being operated on are assumed to be of type Text.
   }
 """
 
-import json
-import re
-import string
-from typing import Any, Collection, List, Mapping, Text, Tuple, Union
+from typing import Any, List, Mapping, Optional
 
 from absl import app
 from absl import flags
 from absl import logging
-import attr
+import qed_core
 
 FLAGS = flags.FLAGS
 
-flags.DEFINE_string(
-    'prediction', 'qed-dev.jsonlines',
-    'Path to prediction jsonl file.')
+flags.DEFINE_list(
+    'prediction', ['qed-dev.jsonlines'],
+    'Comma-separated prediction jsonl files. Each one may be a glob pattern of '
+    'shards, optionally compressed with gzip, bz2 or xz. With more than one '
+    'prediction, the annotation is loaded once, all predictions are scored '
+    'against it in a single pass and their scores are logged side by side.')
 flags.DEFINE_string(
     'annotation', 'qed-dev.jsonlines',
-    'Path to annotation jsonl file.')
+    'Path to annotation jsonl file, or a glob pattern of shards, optionally '
+    'compressed with gzip, bz2 or xz.')
 flags.DEFINE_bool(
     'strict', False, 'Whether to enforce strict match'
     'if false, entity mentions are considered equal'
     'if their mention span overlap AND their mention'
     'span matches after normalization')
+flags.DEFINE_integer(
+    'num_workers', 1,
+    'Number of processes to load and score examples in. Scores do not depend '
+    'on it.')
+flags.DEFINE_bool(
+    'fast_json', False,
+    'Whether to parse jsonl files with orjson when it is installed.')
+flags.DEFINE_bool(
+    'compact', False,
+    'Whether to keep loaded entities in a compact array-backed store.')
+flags.DEFINE_bool(
+    'cache_annotation', False,
+    'Whether to cache the parsed annotation file in a binary file next to it '
+    'and load it from there on later runs.')
+flags.DEFINE_bool(
+    'validate', False,
+    'Whether to validate the --annotation and --prediction files instead of '
+    'scoring them. Every offset and format error is written to a report next '
+    'to each file; files without errors can then be loaded with --trusted.')
+flags.DEFINE_bool(
+    'trusted', False,
+    'Whether to skip checking mention strings against their offsets when '
+    'loading files that passed --validate since they last changed.')
+flags.DEFINE_list(
+    'example_ids', None,
+    'If set, only these comma-separated example ids are loaded from both files '
+    'and scored. Their lines are located with an index kept next to each file '
+    'instead of parsing the whole files.')
+flags.DEFINE_string(
+    'serve_socket', None,
+    'If set, keep the annotation loaded and serve scoring requests on this '
+    'unix socket instead of scoring --prediction. See qed_server.py.')
+flags.DEFINE_integer(
+    'serve_port', None,
+    'If set, keep the annotation loaded and serve scoring requests on this '
+    'localhost port instead of scoring --prediction. See qed_server.py.')
+flags.DEFINE_integer(
+    'bootstrap_samples', 0,
+    'If positive, also log 95% bootstrap confidence intervals of all scores, '
+    'computed from this many resamples of the annotated examples. Needs '
+    'NumPy.')
+flags.DEFINE_string(
+    'compare_prediction', None,
+    'If set, also score this prediction file and log the paired bootstrap and '
+    'permutation test p-values of its differences to --prediction, from '
+    '--bootstrap_samples (or 10000) samples. Needs NumPy.')
+flags.DEFINE_string(
+    'example_table', None,
+    'If set, also write the counts and properties of every annotated example '
+    'to this .npz file, which qed_slices scores slices of. Needs NumPy.')
+flags.DEFINE_bool(
+    'stream', False,
+    'Whether to score the files while reading them instead of loading both '
+    'into memory first. Both files must be sorted by example_id, unless '
+    '--sort_memory_mb is set. Scores are identical and memory stays flat.')
+flags.DEFINE_integer(
+    'sort_memory_mb', None,
+    'With --stream, sort the files by example_id first with an external merge '
+    'sort that holds about this many megabytes of lines in memory and spills '
+    'sorted runs to --sort_tmpdir. The files may then be in any order, '
+    'sharded and compressed.')
+flags.DEFINE_string(
+    'sort_tmpdir', None,
+    'Directory for the sorted runs of --sort_memory_mb. Defaults to the '
+    'system temporary directory.')
+flags.DEFINE_bool(
+    'profile', False,
+    'Whether to time the phases of loading and scoring, count examples and '
+    'overlap comparisons, and log them with the scores.')
+flags.DEFINE_bool(
+    'profile_memory', False,
+    'Whether to also track peak memory with tracemalloc when --profile is '
+    'set. Slows down the run.')
 
-MIN_F1_FOR_NON_STRICT_OVERLAP = 0.9
-
-
-def normalize_text(text: Text) -> Text:
-  """Lowercases text and removes punctuation, articles and extra whitespace."""
-
-  def remove_articles(s):
-    return re.sub(r'\b(a|an|the)\b', ' ', s)
-
-  def replace_punctuation(s):
-    to_replace = set(string.punctuation)
-    return ''.join('' if ch in to_replace else ch for ch in s)
-
-  def white_space_fix(s):
-    return ' '.join(s.split())
-
-  text = text.lower()
-  text = replace_punctuation(text)
-  text = remove_articles(text)
-  text = white_space_fix(text)
-  return text
-
-
-@attr.s(frozen=True)
-class Entity:
-  """Entity in either document or query."""
-
-  # Inclusive start char offset of this entity mention. -1 refers to the start
-  # of the answering sentence. The answering sentence is given in the data
-  # as example["annotation"]["selected_sentence"].
-  start_offset = attr.ib(type=int)
-
-  # Exclusive end char offset of this entity mention. -1 refers to the entire
-  # answering sentence.
-  end_offset = attr.ib(type=int)
-  # type must be either context or query.
-  type = attr.ib(type=Text)
-  # entity mention text.
-  text = attr.ib(type=Text)
-  normalized_text = attr.ib(type=Text)
-
-  def __hash__(self):
-    return hash((self.start_offset, self.end_offset, self.type))
-
-  def __eq__(self, other):
-    return (self.start_offset == other.start_offset and
-            self.end_offset == other.end_offset and self.type == other.type)
-
-
-@attr.s
-class QEDExample:
-  """A single training/test example."""
-  example_id = attr.ib(type=int)
-  title = attr.ib(type=Text)
-  question = attr.ib(type=Text)
-  answer = attr.ib(type=List[Entity])
-  nq_answers = attr.ib(type=List[List[Entity]])
-  # the first entity is query entity, the second is document entity.
-  aligned_nps = attr.ib(type=List[Tuple[Entity, Entity]])
-  # either single_sentence or multi_sentence.
-  explanation_type = attr.ib(type=Text)
-
-
-def load_answer(answer: List[Mapping[Text, Any]]) -> List[Entity]:
-  """Loads annotated QED answer, potentially composed of multiple spans."""
-  output_answer = []
-  for a in answer:
-    output_answer.append(
-        Entity(
-            text=a['paragraph_reference']['string'],
-            normalized_text=normalize_text(a['paragraph_reference']['string']),
-            start_offset=a['paragraph_reference']['start'],
-            end_offset=a['paragraph_reference']['end'],
-            type='context'))
-  return output_answer
-
-
-def load_nq_answers(
-    answer_list: List[List[Mapping[Text, Any]]]) -> List[List[Entity]]:
-  """Loads annotated NQ answers, each potentially composed of multiple spans."""
-  output_answer_list = []
-  for answer in answer_list:
-    output_answer = []
-    for a in answer:
-      output_answer.append(
-          Entity(
-              text=a['string'],
-              normalized_text=normalize_text(a['string']),
-              start_offset=a['start'],
-              end_offset=a['end'],
-              type='context'))
-    output_answer_list.append(output_answer)
-  return output_answer_list
-
-
-def load_aligned_entities(alignment_dict: List[Mapping[Text, Any]],
-                          question_text: Text,
-                          context_text: Text) -> List[Tuple[Entity, Entity]]:
-  """Loads aligned entities from json."""
-  aligned_nps = []
-  for single_np_alignment in alignment_dict:
-    q_entity_text = single_np_alignment['question_reference']['string']
-    q_entity_offset = (single_np_alignment['question_reference']['start'],
-                       single_np_alignment['question_reference']['end'])
-    c_entity_text = single_np_alignment['sentence_reference']['string']
-    c_entity_offset = (single_np_alignment['sentence_reference']['start'],
-                       single_np_alignment['sentence_reference']['end'])
-    if q_entity_text != question_text[q_entity_offset[0]:q_entity_offset[1]]:
-      logging.error(
-          'Question entity offset not proper. from text: %s, from byte offset %s',
-          q_entity_text, question_text[q_entity_offset[0]:q_entity_offset[1]])
-      raise ValueError()
-
-    question_entity = Entity(
-        text=question_text[q_entity_offset[0]:q_entity_offset[1]],
-        normalized_text=normalize_text(q_entity_text),
-        start_offset=q_entity_offset[0],
-        end_offset=q_entity_offset[1],
-        type='question')
-    if c_entity_offset[0] != -1:
-      if c_entity_text != context_text[c_entity_offset[0]:c_entity_offset[1]]:
-        logging.error(
-            'Context entity offset not proper. from text: %s, from byte offset %s',
-            c_entity_text, context_text[c_entity_offset[0]:c_entity_offset[1]])
-        raise ValueError()
-      doc_entity = Entity(
-          text=context_text[c_entity_offset[0]:c_entity_offset[1]],
-          normalized_text=normalize_text(c_entity_text),
-          start_offset=c_entity_offset[0],
-          end_offset=c_entity_offset[1],
-          type='context')
-    else:  # this is a bridging linguistic context instance.
-      doc_entity = Entity(
-          text='',
-          start_offset=-1,
-          end_offset=-1,
-          type='context',
-          normalized_text='')
-    aligned_nps.append((question_entity, doc_entity))
-  return aligned_nps
-
-
-def load_single_line(elem: Mapping[Text, Any]) -> QEDExample:
-  """Loads a QEDExample from json."""
-  return QEDExample(
-      example_id=elem['example_id'],
-      title=elem['title_text'],
-      question=elem['question_text'],
-      answer=load_answer(elem['annotation'].get('answer', [])),
-      nq_answers=load_nq_answers(elem['original_nq_answers']),
-      aligned_nps=load_aligned_entities(
-          elem['annotation'].get('referential_equalities', []),
-          elem['question_text'],
-          elem['paragraph_text']),
-      explanation_type=elem['annotation']['explanation_type'])
-
-
-def load_data(fname: Text) -> Mapping[int, QEDExample]:
-  """Loads jsonl data and outputs a dict mapping example_id to QEDExample."""
-  output_dict = {}
-  incorrectly_formatted = 0
-  with open(fname) as f:
-    for line in f:
-      try:
-        elem = json.loads(line)
-        example = load_single_line(elem)
-        if example.explanation_type == 'single_sentence':
-          output_dict[example.example_id] = example
-      except ValueError:
-        incorrectly_formatted += 1
-  logging.info('%d examples not correctly formatted and skipped.',
-               incorrectly_formatted)
-  return output_dict
-
-
-def overlap(ent1: Entity, ent2: Entity) -> bool:
-  """Returns whether two entities overlap at least with 90% F1."""
-  if (ent1.start_offset == -1 or ent1.end_offset == -1 or
-      ent2.start_offset == -1 or ent2.end_offset == -1):
-    return (ent1.start_offset, ent1.end_offset, ent2.start_offset,
-            ent2.end_offset) == (-1, -1, -1, -1)
-
-  # Compute F1 as follows:
-  #   F1 = tp / (tp + (fp + fn) / 2)
-  #   [------ ent1 --------]
-  #             [------- ent2 -----]
-  #   [-- fn --][--- tp ---][- fp -]
-  tp = abs(ent1.end_offset - ent2.start_offset)
-  fn = abs(ent2.start_offset - ent1.start_offset)
-  fp = abs(ent2.end_offset - ent1.end_offset)
-  f1 = tp / (tp + (fp + fn) / 2) if tp else 0.0
-  return f1 >= MIN_F1_FOR_NON_STRICT_OVERLAP
-
-
-def compute_mention_score(annotation: Collection[Entity],
-                          prediction: Collection[Entity],
-                          strict: bool) -> Tuple[float, float, float]:
-  """Computes mention identification performance."""
-  if strict:
-    annot_entities = set([ent for ent in annotation if ent.start_offset != -1])
-    pred_entities = set([ent for ent in prediction if ent.start_offset != -1])
-    tp = len(annot_entities & pred_entities)
-    tn = len(annot_entities - pred_entities)
-    fn = len(pred_entities - annot_entities)
-  else:
-    tp, tn, fn = 0, 0, 0
-    for annot_entity in annotation:
-      found = False
-      for pred_entity in prediction:
-        if pred_entity.normalized_text == annot_entity.normalized_text:
-          if overlap(pred_entity, annot_entity):
-            found = True
-            break
-      if found:
-        tp += 1
-      else:
-        tn += 1
-    fn = len(prediction) - tp
-  return tp, tn, fn
-
-
-def compute_alignment_score(annotation: QEDExample, prediction: QEDExample,
-                            strict: bool) -> Tuple[float, float, float]:
-  """Computes the alignment match score."""
-  if strict:
-    annot_pairs = set(annotation.aligned_nps)
-    pred_pairs = set(prediction.aligned_nps)
-    tp = len(annot_pairs & pred_pairs)
-    tn = len(annot_pairs - pred_pairs)
-    fn = len(pred_pairs - annot_pairs)
-  else:
-    tp, tn, fn = 0, 0, 0
-    for annot_q_ent, annot_doc_ent in annotation.aligned_nps:
-      found = False
-      for pred_q_ent, pred_doc_ent in prediction.aligned_nps:
-        if pred_q_ent.normalized_text == annot_q_ent.normalized_text:
-          if annot_doc_ent.normalized_text == pred_doc_ent.normalized_text:
-            if overlap(pred_q_ent, annot_q_ent):
-              if overlap(pred_doc_ent, annot_doc_ent):
-                found = True
-                break
-      if found:
-        tp += 1
-      else:
-        tn += 1
-    fn = len(prediction.aligned_nps) - tp
-  return tp, tn, fn
 
+def __getattr__(name: str) -> Any:
+  """Re-exports the names of qed_core, which holds the library.
 
-def compute_prf1(tp, tn, fn) -> Tuple[float, float, float]:
-  """Computes precistion, recall and f1 from true/false positives/negatives."""
-  if tp > 0:
-    p, r = tp / (tp + fn), tp / (tp + tn)
-    f1 = 2 * p * r / (p + r)
-  else:
-    p, r, f1 = 0.0, 0.0, 0.0
-  return p, r, f1
+  Names are looked up on every access rather than copied at import time, so
+  that qed_core.instrumented also instruments calls made through this module.
 
+  Args:
+    name: the name to look up.
 
-def is_permutation_matrix(matrix: List[List[bool]]) -> bool:
-  """Returns whether the given boolean matrix is a permutation matrix."""
-  return (all(sum(v) == 1 for v in matrix) and
-          sum(any(v) for v in matrix) == len(matrix))
+  Returns:
+    The current value of qed_core.<name>.
+  """
+  try:
+    return getattr(qed_core, name)
+  except AttributeError:
+    raise AttributeError('module %r has no attribute %r' %
+                         (__name__, name)) from None
 
 
-def compute_answer_accuracy(annotation: QEDExample, prediction: QEDExample,
-                            strict: bool) -> float:
-  """Checks whether the predicted answer matches any of the annotated ones."""
-  for annot_answer in [annotation.answer] + annotation.nq_answers:
-    all_matches = []
-    for a in annot_answer:
-      all_matches.append([])
-      for p in prediction.answer:
-        if strict:
-          all_matches[-1].append(a == p)
-        else:
-          all_matches[-1].append(overlap(a, p))
+def __dir__() -> List[str]:
+  return sorted(set(globals()) | set(dir(qed_core)))
 
-    # The all_matches matrix should basically a permutation matrix.
-    if is_permutation_matrix(all_matches):
-      return 1.0
 
-  return 0.0
+def _log_statistics(annotation_dict: Mapping[int, qed_core.QEDExample],
+                    prediction_dict: Mapping[int, qed_core.QEDExample]) -> None:
+  """Logs scores with confidence intervals and/or significance tests.
 
+  Also writes the --example_table of the per-example counts.
 
-def compute_scores(
-    annotation_dict: Mapping[int,
-                             QEDExample], prediction_dict: Mapping[int,
-                                                                   QEDExample],
-    strict: bool) -> Mapping[Text, Union[float, Tuple[float, float, float]]]:
-  """Compute scores."""
-  score_dict = {}
-  total_q_tp, total_q_tn, total_q_fn = 0, 0, 0
-  total_c_tp, total_c_tn, total_c_fn = 0, 0, 0
-  total_pair_tp, total_pair_tn, total_pair_fn = 0, 0, 0
-  completely_correct_example_count = 0.0
-  total_correct_answers = 0
-  total_answers = 0
-  for example_id in annotation_dict:
-    if example_id not in prediction_dict:
-      logging.info('Missing prediction for id %d', example_id)
-    else:
-      prediction = prediction_dict[example_id]
-      annotation = annotation_dict[example_id]
-      q_tp, q_tn, q_fn = compute_mention_score(
-          [nps[0] for nps in annotation.aligned_nps],
-          [nps[0] for nps in prediction.aligned_nps], strict)
-      c_tp, c_tn, c_fn = compute_mention_score(
-          [nps[1] for nps in annotation.aligned_nps],
-          [nps[1] for nps in prediction.aligned_nps], strict)
-      pair_tp, pair_tn, pair_fn = compute_alignment_score(
-          annotation, prediction, strict)
-      total_correct_answers += compute_answer_accuracy(annotation, prediction,
-                                                       strict)
-      total_answers += 1
-      if pair_tn + pair_fn == 0:
-        completely_correct_example_count += 1
-      total_q_tp += q_tp
-      total_q_tn += q_tn
-      total_q_fn += q_fn
-      total_c_tp += c_tp
-      total_c_tn += c_tn
-      total_c_fn += c_fn
-      total_pair_tp += pair_tp
-      total_pair_tn += pair_tn
-      total_pair_fn += pair_fn
-  question_mention_p, question_mention_r, question_mention_f1 = compute_prf1(
-      total_q_tp, total_q_tn, total_q_fn)
-  context_mention_p, context_mention_r, context_mention_f1 = compute_prf1(
-      total_c_tp, total_c_tn, total_c_fn)
-  mention_p, mention_r, mention_f1 = compute_prf1(total_q_tp + total_c_tp,
-                                                  total_q_tn + total_c_tn,
-                                                  total_q_fn + total_c_fn)
-  pair_p, pair_r, pair_f1 = compute_prf1(total_pair_tp, total_pair_tn,
-                                         total_pair_fn)
-  logging.info('# of examples completely correct: %d',
-               completely_correct_example_count)
-  score_dict = {
-      'exact_match_accuracy':
-          completely_correct_example_count / len(annotation_dict),
-      'question_mention':
-          (question_mention_p, question_mention_r, question_mention_f1),
-      'context_mention':
-          (context_mention_p, context_mention_r, context_mention_f1),
-      'all_mention': (mention_p, mention_r, mention_f1),
-      'pair': (pair_p, pair_r, pair_f1),
-      'answer_accuracy': (total_correct_answers / total_answers)
-  }
-  logging.info('Question mention P/R/F1 %.4f %.4f %.4f', question_mention_p,
-               question_mention_r, question_mention_f1)
-  logging.info('Context mention P/R/F1 %.4f %.4f %.4f', context_mention_p,
-               context_mention_r, context_mention_f1)
-  logging.info('Both Mention P/R/F1 %.4f %.4f %.4f', mention_p, mention_r,
-               mention_f1)
-  logging.info('Pair P/R/F1 %.4f %.4f %.4f', pair_p, pair_r, pair_f1)
-  return score_dict
+  Args:
+    annotation_dict: annotated examples keyed by example id.
+    prediction_dict: predicted examples keyed by example id.
+  """
+  import qed_stats  # pylint: disable=g-import-not-at-top
+  example_ids = _example_ids()
+  example_counts = []
+  score_dict = qed_core.compute_scores(annotation_dict, prediction_dict,
+                                       FLAGS.strict, FLAGS.num_workers,
+                                       example_counts)
+  logging.info(score_dict)
+  if FLAGS.example_table:
+    import qed_slices  # pylint: disable=g-import-not-at-top
+    qed_slices.write_example_table(
+        FLAGS.example_table,
+        qed_slices.example_table(annotation_dict, prediction_dict,
+                                 example_counts))
+    logging.info('Wrote %d example rows to %s.', len(example_counts),
+                 FLAGS.example_table)
+  counts = qed_stats.count_array(example_counts)
+  if FLAGS.bootstrap_samples:
+    logging.info('95%% confidence intervals: %s',
+                 qed_stats.bootstrap(counts, FLAGS.bootstrap_samples))
+  if FLAGS.compare_prediction:
+    other_counts = []
+    other_dict = qed_core.load_data(
+        FLAGS.compare_prediction,
+        compact=FLAGS.compact,
+        num_workers=FLAGS.num_workers,
+        fast_json=FLAGS.fast_json,
+        example_ids=example_ids,
+        trusted=FLAGS.trusted)
+    logging.info(
+        '%s: %s', FLAGS.compare_prediction,
+        qed_core.compute_scores(annotation_dict, other_dict, FLAGS.strict,
+                                FLAGS.num_workers, other_counts))
+    other_counts = qed_stats.count_array(other_counts)
+    num_samples = FLAGS.bootstrap_samples or 10000
+    logging.info(
+        'Paired bootstrap (difference, p-value): %s',
+        qed_stats.paired_bootstrap(counts, other_counts, num_samples))
+    logging.info(
+        'Permutation test (difference, p-value): %s',
+        qed_stats.permutation_test(counts, other_counts, num_samples))
+
+
+def _validate(fnames: List[str]) -> None:
+  """Validates the shards of fnames and logs where their reports went."""
+  for fname in qed_core.expand_paths(fnames):
+    report = qed_core.validate_file(fname, FLAGS.fast_json)
+    report_fname = qed_core.write_validation_report(report)
+    logging.info('%s: %d of %d lines invalid, %d errors, report in %s.', fname,
+                 report['invalid_lines'], report['lines'],
+                 len(report['errors']), report_fname)
+    for error in report['errors'][:10]:
+      logging.info('  line %d, %s: %s', error['line'], error['field'],
+                   error['message'])
+
+
+def _example_ids() -> Optional[List[int]]:
+  """The ids of --example_ids, or None if it is not set."""
+  if FLAGS.example_ids is None:
+    return None
+  try:
+    return [int(example_id) for example_id in FLAGS.example_ids]
+  except ValueError as e:
+    raise app.UsageError('--example_ids must be integers: %s' % e)
 
 
 def main(argv):
   if len(argv) > 1:
     raise app.UsageError('Too many command-line arguments.')
-  annotation_dict = load_data(FLAGS.annotation)
+  if not FLAGS.profile:
+    _evaluate()
+    return
+  with qed_core.instrumented(FLAGS.profile_memory) as instrumentation:
+    _evaluate()
+  logging.info('Timings and counters: %s', instrumentation.report())
+
+
+def _evaluate() -> None:
+  """Runs the evaluation that the flags ask for."""
+  prediction_files = list(dict.fromkeys(FLAGS.prediction))
+  if FLAGS.validate:
+    _validate([FLAGS.annotation] + prediction_files)
+    return
+  if len(prediction_files) > 1 and (FLAGS.stream or FLAGS.bootstrap_samples or
+                                    FLAGS.compare_prediction or
+                                    FLAGS.example_table):
+    raise app.UsageError(
+        '--stream, --bootstrap_samples, --compare_prediction and '
+        '--example_table take a single --prediction file.')
+  if FLAGS.stream:
+    if (FLAGS.num_workers > 1 or FLAGS.compact or FLAGS.cache_annotation or
+        FLAGS.bootstrap_samples or FLAGS.compare_prediction or
+        FLAGS.example_table or FLAGS.example_ids is not None):
+      raise app.UsageError(
+          '--stream does not load the files, so it cannot be combined with '
+          '--num_workers, --compact, --cache_annotation, --bootstrap_samples, '
+          '--compare_prediction, --example_table or --example_ids.')
+    if FLAGS.sort_memory_mb is None and any(
+        len(qed_core.expand_paths([fname])) > 1
+        for fname in (FLAGS.annotation, prediction_files[0])):
+      raise app.UsageError(
+          '--stream reads single files, not shards, unless --sort_memory_mb '
+          'is set.')
+    score_dict = qed_core.stream_scores(
+        FLAGS.annotation,
+        prediction_files[0],
+        FLAGS.strict,
+        FLAGS.fast_json,
+        memory_budget=(None if FLAGS.sort_memory_mb is None else
+                       FLAGS.sort_memory_mb << 20),
+        tmpdir=FLAGS.sort_tmpdir)
+    logging.info(score_dict)
+    return
+  example_ids = _example_ids()
+  if example_ids is not None and FLAGS.cache_annotation:
+    raise app.UsageError(
+        '--example_ids only loads the requested lines, so it cannot be '
+        'combined with --cache_annotation.')
+  annotation_dict = qed_core.load_data(
+      FLAGS.annotation,
+      compact=FLAGS.compact,
+      use_cache=FLAGS.cache_annotation,
+      num_workers=FLAGS.num_workers,
+      fast_json=FLAGS.fast_json,
+      example_ids=example_ids,
+      trusted=FLAGS.trusted)
   logging.info('%d examples in annotation.', len(annotation_dict))
-  prediction_dict = load_data(FLAGS.prediction)
+  if FLAGS.serve_socket or FLAGS.serve_port is not None:
+    import qed_server  # pylint: disable=g-import-not-at-top
+    qed_server.serve(annotation_dict, FLAGS.serve_socket, FLAGS.serve_port or 0,
+                     FLAGS.strict)
+    return
+  if len(prediction_files) > 1:
+    prediction_dicts = {}
+    for fname in prediction_files:
+      prediction_dicts[fname] = qed_core.load_data(
+          fname,
+          compact=FLAGS.compact,
+          num_workers=FLAGS.num_workers,
+          fast_json=FLAGS.fast_json,
+          example_ids=example_ids,
+          trusted=FLAGS.trusted)
+      logging.info('%d examples in %s.', len(prediction_dicts[fname]), fname)
+    score_dicts = qed_core.compute_multi_scores(
+        annotation_dict, prediction_dicts, FLAGS.strict, FLAGS.num_workers)
+    for fname, score_dict in score_dicts.items():
+      logging.info('%s: %s', fname, score_dict)
+    logging.info('Scores of %d prediction files:\n%s', len(score_dicts),
+                 qed_core.format_score_table(score_dicts))
+    return
+  prediction_dict = qed_core.load_data(
+      prediction_files[0],
+      compact=FLAGS.compact,
+      num_workers=FLAGS.num_workers,
+      fast_json=FLAGS.fast_json,
+      example_ids=example_ids,
+      trusted=FLAGS.trusted)
   logging.info('%d examples in predicton.', len(prediction_dict))
-  score_dict = compute_scores(annotation_dict, prediction_dict, FLAGS.strict)
+  if (FLAGS.bootstrap_samples or FLAGS.compare_prediction or
+      FLAGS.example_table):
+    _log_statistics(annotation_dict, prediction_dict)
+    return
+  score_dict = qed_core.compute_scores(annotation_dict, prediction_dict,
+                                       FLAGS.strict, FLAGS.num_workers)
   logging.info(score_dict)
 
 
@@ -5,7 +5,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bz2
+import gzip
 import json
+import lzma
+import os
+import pickle
+import random
+import re
+import string
+import tempfile
+import threading
+from unittest import mock
 import qed_eval
 from absl.testing import absltest
 
@@ -167,6 +178,86 @@ example_2 = """
 }"""
 
 
+def reference_normalize_text(text):
+  """Original, unoptimized implementation of qed_eval.normalize_text."""
+  text = text.lower()
+  to_replace = set(string.punctuation)
+  text = "".join("" if ch in to_replace else ch for ch in text)
+  text = re.sub(r"\b(a|an|the)\b", " ", text)
+  return " ".join(text.split())
+
+
+def reference_mention_score(annotation, prediction):
+  """Original non-strict compute_mention_score, comparing all pairs."""
+  tp, tn = 0, 0
+  for annot_entity in annotation:
+    found = False
+    for pred_entity in prediction:
+      if pred_entity.normalized_text == annot_entity.normalized_text:
+        if qed_eval.overlap(pred_entity, annot_entity):
+          found = True
+          break
+    if found:
+      tp += 1
+    else:
+      tn += 1
+  return tp, tn, len(prediction) - tp
+
+
+def reference_alignment_score(annotation, prediction):
+  """Original non-strict compute_alignment_score, comparing all pairs."""
+  tp, tn = 0, 0
+  for annot_q_ent, annot_doc_ent in annotation:
+    found = False
+    for pred_q_ent, pred_doc_ent in prediction:
+      if pred_q_ent.normalized_text == annot_q_ent.normalized_text:
+        if annot_doc_ent.normalized_text == pred_doc_ent.normalized_text:
+          if qed_eval.overlap(pred_q_ent, annot_q_ent):
+            if qed_eval.overlap(pred_doc_ent, annot_doc_ent):
+              found = True
+              break
+    if found:
+      tp += 1
+    else:
+      tn += 1
+  return tp, tn, len(prediction) - tp
+
+
+def reference_answer_accuracy(annotation, prediction, strict):
+  """Original compute_answer_accuracy, building every match matrix."""
+  for annot_answer in [annotation.answer] + annotation.nq_answers:
+    all_matches = []
+    for a in annot_answer:
+      all_matches.append([])
+      for p in prediction.answer:
+        if strict:
+          all_matches[-1].append(a == p)
+        else:
+          all_matches[-1].append(qed_eval.overlap(a, p))
+    if qed_eval.is_permutation_matrix(all_matches):
+      return 1.0
+  return 0.0
+
+
+def random_entities(rng, num_entities, max_offset):
+  entities = []
+  for _ in range(num_entities):
+    if rng.random() < 0.1:
+      start, end = rng.choice([(-1, -1), (-1, 5), (5, -1)])
+    else:
+      start = rng.randrange(0, max_offset)
+      end = max(-1, start + rng.choice([rng.randrange(-3, 5),
+                                        rng.randrange(0, 300)]))
+    entities.append(
+        qed_eval.Entity(
+            start_offset=start,
+            end_offset=end,
+            type="context",
+            text="",
+            normalized_text=rng.choice(["a", "b", ""])))
+  return entities
+
+
 class QedEvalTest(absltest.TestCase):
 
   def setUp(self):
@@ -201,6 +292,23 @@ class QedEvalTest(absltest.TestCase):
               self.get_span(example["paragraph_text"], sentence_span)
       })
 
+  def partially_correct_predictions(self):
+    prediction_jsonlines = [json.loads(example_1), json.loads(example_2)]
+    self.set_answer(prediction_jsonlines[0], [(506, 520)])
+    self.set_refs(prediction_jsonlines[0], [((15, 27), (462, 479)),
+                                            ((28, 41), (-1, -1))])
+    self.set_answer(prediction_jsonlines[1], [(217, 243)])
+    self.set_refs(prediction_jsonlines[1], [((10, 12), (259, 261))])
+    return prediction_jsonlines
+
+  def write_jsonlines(self, elems):
+    tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    path = os.path.join(tmpdir, "data.jsonlines")
+    with open(path, "w") as f:
+      for elem in elems:
+        f.write(json.dumps(elem) + "\n")
+    return path
+
   def test_strict_accuracy_on_correct(self):
     prediction_jsonlines = [json.loads(example_1), json.loads(example_2)]
     self.set_answer(prediction_jsonlines[0], [(506, 520)])  # correct answer
@@ -373,6 +481,727 @@ class QedEvalTest(absltest.TestCase):
         self.annotation_dict, prediction_dict, strict=False)
     self.assertEqual(score_dict["answer_accuracy"], 1.0)
 
+  def test_non_strict_mention_score_matches_all_pairs(self):
+    rng = random.Random(0)
+    for _ in range(2000):
+      annotation = random_entities(rng, rng.randrange(0, 6), 400)
+      prediction = random_entities(rng, rng.randrange(0, 30), 400)
+      # Near misses and hits around the 0.9 F1 threshold.
+      for entity in annotation:
+        if entity.start_offset >= 0 and entity.end_offset >= 0:
+          length = entity.end_offset - entity.start_offset
+          for shift in range(-length // 3 - 2, length // 3 + 3, 3):
+            prediction.append(
+                qed_eval.Entity(
+                    start_offset=max(0, entity.start_offset + shift),
+                    end_offset=entity.end_offset + rng.randrange(-2, 3),
+                    type="context",
+                    text="",
+                    normalized_text=entity.normalized_text))
+      rng.shuffle(prediction)
+      self.assertEqual(
+          qed_eval.compute_mention_score(annotation, prediction, False),
+          reference_mention_score(annotation, prediction))
+
+  def test_non_strict_alignment_score_matches_all_pairs(self):
+    rng = random.Random(1)
+    for _ in range(1000):
+      num_annotated = rng.randrange(0, 6)
+      annotation = list(
+          zip(
+              random_entities(rng, num_annotated, 50),
+              random_entities(rng, num_annotated, 400)))
+      num_predicted = rng.randrange(0, 40)
+      prediction = list(
+          zip(
+              random_entities(rng, num_predicted, 50),
+              random_entities(rng, num_predicted, 400)))
+      prediction.extend(annotation[:rng.randrange(0, num_annotated + 1)])
+      rng.shuffle(prediction)
+      annotation_example = qed_eval.load_single_line(json.loads(example_1))
+      prediction_example = qed_eval.load_single_line(json.loads(example_1))
+      annotation_example.aligned_nps[:] = annotation
+      prediction_example.aligned_nps[:] = prediction
+      self.assertEqual(
+          qed_eval.compute_alignment_score(annotation_example,
+                                           prediction_example, False),
+          reference_alignment_score(annotation, prediction))
+
+  def test_answer_index(self):
+    annotation = self.annotation_dict[json.loads(example_1)["example_id"]]
+    index = qed_eval.answer_index(annotation)
+    self.assertIs(qed_eval.answer_index(annotation), index)
+    # The first NQ answer repeats the QED answer.
+    self.assertLen(annotation.nq_answers, 3)
+    self.assertLen(index.strict_answers, 3)
+    self.assertLen(index.answer_spans, 3)
+    self.assertEqual(index.strict_answers[0],
+                     frozenset(e.strict_key for e in annotation.answer))
+
+  def test_answer_accuracy_matches_match_matrices(self):
+    rng = random.Random(2)
+    for _ in range(300):
+      answers = [
+          random_entities(rng, rng.randrange(0, 3), 60)
+          for _ in range(rng.randrange(1, 4))
+      ]
+      answers.append(list(rng.choice(answers)))
+      annotation = qed_eval.load_single_line(json.loads(example_1))
+      annotation.answer = answers[0]
+      annotation.nq_answers = answers[1:]
+      # Many predictions per annotation, as for n-best lists.
+      for _ in range(10):
+        prediction = qed_eval.load_single_line(json.loads(example_1))
+        prediction.answer = random_entities(rng, rng.randrange(0, 4), 60)
+        if rng.random() < 0.5:
+          prediction.answer += rng.choice(answers)
+        rng.shuffle(prediction.answer)
+        for strict in (True, False):
+          self.assertEqual(
+              qed_eval.compute_answer_accuracy(annotation, prediction, strict),
+              reference_answer_accuracy(annotation, prediction, strict))
+
+  def test_compute_scores_with_workers(self):
+    prediction_jsonlines = self.partially_correct_predictions()
+
+    pred_elems = [qed_eval.load_single_line(l) for l in prediction_jsonlines]
+    prediction_dict = {elem.example_id: elem for elem in pred_elems}
+    for strict in (True, False):
+      self.assertEqual(
+          qed_eval.compute_scores(
+              self.annotation_dict, prediction_dict, strict, num_workers=2),
+          qed_eval.compute_scores(self.annotation_dict, prediction_dict,
+                                  strict))
+
+  def test_compute_multi_scores(self):
+    partial = {
+        elem.example_id: elem for elem in map(
+            qed_eval.load_single_line, self.partially_correct_predictions())
+    }
+    # Only predicts the second example.
+    second_id = json.loads(example_2)["example_id"]
+    missing = {second_id: partial[second_id]}
+    prediction_dicts = {
+        "correct": self.annotation_dict,
+        "partial": partial,
+        "missing": missing,
+        "empty": {},
+    }
+    for strict in (True, False):
+      expected = {
+          name: qed_eval.compute_scores(self.annotation_dict, prediction_dict,
+                                        strict)
+          for name, prediction_dict in prediction_dicts.items()
+      }
+      for num_workers in (1, 2):
+        self.assertEqual(
+            qed_eval.compute_multi_scores(self.annotation_dict,
+                                          prediction_dicts, strict,
+                                          num_workers), expected)
+
+  def test_format_score_table(self):
+    score_dicts = qed_eval.compute_multi_scores(
+        self.annotation_dict, {
+            "a": self.annotation_dict,
+            "longer_name": {}
+        },
+        strict=True)
+    lines = qed_eval.format_score_table(score_dicts).splitlines()
+    self.assertEqual(lines[0].split(), ["score", "a", "longer_name"])
+    self.assertLen(lines, 1 + 2 + 4 * 3)
+    self.assertEqual(lines[1].split(),
+                     ["exact_match_accuracy", "1.0000", "0.0000"])
+    self.assertEqual(lines[-1].split(), ["answer_accuracy", "1.0000", "0.0000"])
+
+  def test_expand_paths(self):
+    tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    for name in ("b.jsonl", "a.jsonl", "c.txt"):
+      open(os.path.join(tmpdir, name), "w").close()
+    pattern = os.path.join(tmpdir, "*.jsonl")
+    missing = os.path.join(tmpdir, "missing.jsonl")
+    self.assertEqual(
+        qed_eval.expand_paths([pattern, os.path.join(tmpdir, "a.jsonl"),
+                               missing]),
+        [os.path.join(tmpdir, "a.jsonl"),
+         os.path.join(tmpdir, "b.jsonl"), missing])
+
+  def test_compact_store_matches_entities(self):
+    store = qed_eval.EntityStore()
+    for example_id, annotation in self.annotation_dict.items():
+      compact = store.add_example(annotation)
+      self.assertEqual(compact.example_id, example_id)
+      self.assertLen(compact.aligned_nps, len(annotation.aligned_nps))
+      for (q, c), (compact_q, compact_c) in zip(annotation.aligned_nps,
+                                                compact.aligned_nps):
+        for entity, view in ((q, compact_q), (c, compact_c)):
+          self.assertEqual(view, entity)
+          self.assertEqual(entity, view)
+          self.assertEqual(hash(view), hash(entity))
+          self.assertLen({view, entity}, 1)
+          self.assertNotEqual(view, None)
+          self.assertNotEqual(entity, None)
+          self.assertEqual(
+              (view.start_offset, view.end_offset, view.type, view.text,
+               view.normalized_text),
+              (entity.start_offset, entity.end_offset, entity.type,
+               entity.text, entity.normalized_text))
+      self.assertEqual(list(compact.answer), annotation.answer)
+      self.assertEqual([list(a) for a in compact.nq_answers],
+                       annotation.nq_answers)
+      # Views pickle as plain entities.
+      self.assertEqual(pickle.loads(pickle.dumps(compact.aligned_nps)),
+                       annotation.aligned_nps)
+
+  def test_compact_scores(self):
+    prediction_jsonlines = self.partially_correct_predictions()
+    annotation_path = self.write_jsonlines(self._annotation_jsonlines)
+    prediction_path = self.write_jsonlines(prediction_jsonlines)
+
+    prediction_dict = qed_eval.load_data(prediction_path)
+    compact_annotation_dict = qed_eval.load_data(annotation_path, compact=True)
+    compact_prediction_dict = qed_eval.load_data(prediction_path, compact=True)
+    for strict in (True, False):
+      self.assertEqual(
+          qed_eval.compute_scores(compact_annotation_dict,
+                                  compact_prediction_dict, strict),
+          qed_eval.compute_scores(self.annotation_dict, prediction_dict,
+                                  strict))
+
+  def test_strict_match_compares_texts(self):
+    # Right offsets but a different string, as in an untrusted prediction.
+    prediction_jsonlines = [json.loads(example_1), json.loads(example_2)]
+    reference = prediction_jsonlines[0]["annotation"]["answer"][0][
+        "paragraph_reference"]
+    reference["string"] = reference["string"].upper()
+    annotation_path = self.write_jsonlines(self._annotation_jsonlines)
+    prediction_path = self.write_jsonlines(prediction_jsonlines)
+    prediction_dict = qed_eval.load_data(prediction_path)
+
+    strict_scores = qed_eval.compute_scores(
+        self.annotation_dict, prediction_dict, strict=True)
+    self.assertEqual(strict_scores["answer_accuracy"], 0.5)
+    self.assertEqual(strict_scores["pair"], (1.0, 1.0, 1.0))
+    self.assertEqual(
+        qed_eval.compute_scores(
+            self.annotation_dict, prediction_dict,
+            strict=False)["answer_accuracy"], 1.0)
+    evaluator = qed_eval.IncrementalEvaluator(
+        self.annotation_dict, prediction_path, strict=True)
+    for scores in (
+        qed_eval.compute_scores(
+            qed_eval.load_data(annotation_path, compact=True),
+            qed_eval.load_data(prediction_path, compact=True), strict=True),
+        qed_eval.compute_scores(
+            qed_eval.load_data(annotation_path, use_cache=True),
+            prediction_dict, strict=True),
+        qed_eval.compute_scores(
+            self.annotation_dict, prediction_dict, strict=True,
+            num_workers=2),
+        qed_eval.stream_scores(annotation_path, prediction_path, strict=True),
+        evaluator.refresh(),
+    ):
+      self.assertEqual(scores, strict_scores)
+
+  def test_out_of_range_offsets_are_incorrectly_formatted(self):
+    prediction = json.loads(example_1)
+    reference = prediction["annotation"]["answer"][0]["paragraph_reference"]
+    reference["end"] = -2
+    path = self.write_jsonlines([prediction, json.loads(example_2)])
+    self.assertEqual(list(qed_eval.load_data(path)),
+                     [json.loads(example_2)["example_id"]])
+    with self.assertRaises(ValueError):
+      qed_eval.Entity(0, qed_eval.MAX_OFFSET, "context", "", "")
+
+  def test_compact_load_normalizes_texts(self):
+    path = self.write_jsonlines(self._annotation_jsonlines)
+    for num_workers in (1, 2):
+      compact_dict = qed_eval.load_data(
+          path, compact=True, num_workers=num_workers)
+      for example_id, annotation in self.annotation_dict.items():
+        compact = compact_dict[example_id]
+        entities = list(annotation.answer) + [
+            entity for nps in annotation.aligned_nps for entity in nps
+        ]
+        views = list(compact.answer) + [
+            view for nps in compact.aligned_nps for view in nps
+        ]
+        self.assertEqual([view.normalized_text for view in views],
+                         [entity.normalized_text for entity in entities])
+
+  def test_normalize_text(self):
+    texts = [
+        "The Plane Crash", "a", "an apple", "the", "Grey's Anatomy", "",
+        "  multiple   spaces\tand\nnewlines ", "ΣΑΣ ΟΔΟΣ", "theatre an-a",
+        "A.N. the...", "Rӧntgen , of Germany", "x\x00the y"
+    ]
+    for line in self._annotation_jsonlines:
+      for ref in line["annotation"]["referential_equalities"]:
+        texts.append(ref["question_reference"]["string"])
+        texts.append(ref["sentence_reference"]["string"])
+      texts.append(line["title_text"])
+      texts.append(line["paragraph_text"])
+    expected = [reference_normalize_text(text) for text in texts]
+    self.assertEqual([qed_eval.normalize_text(text) for text in texts],
+                     expected)
+    self.assertEqual(qed_eval.normalize_batch(texts), expected)
+    self.assertEqual(qed_eval.normalize_batch(texts[:-1]), expected[:-1])
+
+  def test_load_data_with_cache(self):
+    annotation_path = self.write_jsonlines(self._annotation_jsonlines)
+    cache_path = annotation_path + qed_eval.CACHE_SUFFIX
+    self.assertFalse(os.path.exists(cache_path))
+    parsed = qed_eval.load_data(annotation_path, use_cache=True)
+    self.assertTrue(os.path.exists(cache_path))
+    cached = qed_eval.load_data(annotation_path, use_cache=True)
+
+    self.assertEqual(cached.keys(), self.annotation_dict.keys())
+    for example_id, annotation in self.annotation_dict.items():
+      for example in (parsed[example_id], cached[example_id]):
+        self.assertEqual(example.title, annotation.title)
+        self.assertEqual(example.question, annotation.question)
+        self.assertEqual(list(example.answer), annotation.answer)
+        self.assertEqual([list(a) for a in example.nq_answers],
+                         annotation.nq_answers)
+        self.assertEqual([(q.normalized_text, c.text)
+                          for q, c in example.aligned_nps],
+                         [(q.normalized_text, c.text)
+                          for q, c in annotation.aligned_nps])
+    for strict in (True, False):
+      self.assertEqual(
+          qed_eval.compute_scores(cached, self.annotation_dict, strict),
+          qed_eval.compute_scores(self.annotation_dict, self.annotation_dict,
+                                  strict))
+
+    # A truncated cache is a cache miss and gets rewritten.
+    digest = qed_eval._file_digest(annotation_path)
+    cache_size = os.path.getsize(cache_path)
+    for size in (cache_size - 8, qed_eval._CACHE_HEADER.size + 8):
+      with open(cache_path, "r+b") as f:
+        f.truncate(size)
+      self.assertIsNone(qed_eval.read_cache(cache_path, digest))
+      self.assertEqual(
+          qed_eval.load_data(annotation_path, use_cache=True).keys(),
+          self.annotation_dict.keys())
+      self.assertEqual(os.path.getsize(cache_path), cache_size)
+
+    # Changing the file invalidates the cache.
+    with open(annotation_path, "w") as f:
+      f.write(json.dumps(self._annotation_jsonlines[1]) + "\n")
+    self.assertEqual(
+        list(qed_eval.load_data(annotation_path, use_cache=True)),
+        [self._annotation_jsonlines[1]["example_id"]])
+
+  def test_load_data_by_example_ids(self):
+    duplicate = json.loads(example_2)
+    duplicate["title_text"] = "Duplicate"
+    path = self.write_jsonlines(self._annotation_jsonlines + [duplicate])
+    with open(path, "a") as f:
+      f.write("not json\n")
+    index_path = path + qed_eval.INDEX_SUFFIX
+    id_1, id_2 = [elem["example_id"] for elem in self._annotation_jsonlines]
+
+    loaded = qed_eval.load_data(path, example_ids=[id_2, 123])
+    self.assertTrue(os.path.exists(index_path))
+    self.assertEqual(list(loaded), [id_2])
+    self.assertEqual(loaded[id_2].title, "Duplicate")
+    self.assertEqual(
+        qed_eval.load_data(path, example_ids=[id_1, id_2]),
+        qed_eval.load_data(path))
+    compact = qed_eval.load_data(path, compact=True, example_ids=[id_1])
+    for strict in (True, False):
+      self.assertEqual(
+          qed_eval.compute_scores(compact, self.annotation_dict, strict),
+          qed_eval.compute_scores({id_1: self.annotation_dict[id_1]},
+                                  self.annotation_dict, strict))
+    with self.assertRaises(ValueError):
+      qed_eval.load_data(path, use_cache=True, example_ids=[id_1])
+
+    # The index is read back, and rebuilt once the file changes.
+    key = qed_eval._index_key(path)
+    index = qed_eval.read_index(index_path, key)
+    self.assertEqual(index, qed_eval.build_index(path))
+    self.assertIsNone(qed_eval.read_index(index_path, (key[0] + 1, key[1])))
+    with open(path, "w") as f:
+      f.write(json.dumps(self._annotation_jsonlines[1]) + "\n")
+    self.assertEqual(list(qed_eval.load_data(path, example_ids=[id_1, id_2])),
+                     [id_2])
+    self.assertEqual(list(qed_eval.read_index(index_path,
+                                              qed_eval._index_key(path))),
+                     [id_2])
+
+  def test_load_data_with_workers(self):
+    multi_sentence = json.loads(example_1)
+    multi_sentence["example_id"] = 1
+    multi_sentence["annotation"]["explanation_type"] = "multi_sentence"
+    duplicate = json.loads(example_2)
+    duplicate["title_text"] = "Duplicate"
+    elems = [multi_sentence] + self._annotation_jsonlines * 20 + [duplicate]
+    path = self.write_jsonlines(elems)
+    with open(path, "a") as f:
+      f.write("not json\n")
+
+    expected = qed_eval.load_data(path)
+    self.assertEqual(expected[duplicate["example_id"]].title, "Duplicate")
+    for num_workers in (2, 3):
+      loaded = qed_eval.load_data(path, num_workers=num_workers)
+      self.assertEqual(loaded, expected)
+      self.assertEqual(list(loaded), list(expected))
+
+  def test_validate_file(self):
+    bad_offsets = json.loads(example_1)
+    bad_offsets["example_id"] = 1
+    equality = bad_offsets["annotation"]["referential_equalities"][0]
+    equality["question_reference"]["start"] += 1
+    bad_offsets["original_nq_answers"][1][0]["end"] = 10000
+    missing_title = json.loads(example_2)
+    del missing_title["title_text"]
+    path = self.write_jsonlines(self._annotation_jsonlines +
+                                [bad_offsets, missing_title])
+    with open(path, "a") as f:
+      f.write("not json\n")
+
+    report = qed_eval.validate_file(path)
+    self.assertEqual((report["lines"], report["invalid_lines"]), (5, 3))
+    self.assertEqual(
+        [(error["line"], error["example_id"], error["field"])
+         for error in report["errors"]],
+        [(3, 1, "annotation.referential_equalities[0].question_reference"),
+         (3, 1, "original_nq_answers[1][0]"),
+         (4, missing_title["example_id"], "title_text"),
+         (5, None, "")])
+    self.assertIn("does not match question_text", report["errors"][0]["message"])
+    self.assertIn("out of range", report["errors"][1]["message"])
+    self.assertFalse(qed_eval.is_validated(path))
+    self.assertEqual(qed_eval.write_validation_report(report),
+                     path + qed_eval.VALIDATION_SUFFIX)
+    self.assertFalse(qed_eval.is_validated(path))
+
+    # Trusted loads skip the offset checks only for validated files.
+    good_path = self.write_jsonlines(self._annotation_jsonlines)
+    report = qed_eval.validate_file(good_path)
+    self.assertEmpty(report["errors"])
+    qed_eval.write_validation_report(report)
+    self.assertTrue(qed_eval.is_validated(good_path))
+    self.assertEqual(qed_eval.load_data(good_path, trusted=True),
+                     qed_eval.load_data(good_path))
+    with open(good_path, "a") as f:
+      f.write(json.dumps(bad_offsets) + "\n")
+    self.assertFalse(qed_eval.is_validated(good_path))
+    self.assertNotIn(1, qed_eval.load_data(good_path, trusted=True))
+    qed_eval.write_validation_report(
+        dict(qed_eval.validate_file(good_path), errors=[]))
+    self.assertIn(1, qed_eval.load_data(good_path, trusted=True))
+
+  def test_load_data_from_shards(self):
+    duplicate = json.loads(example_2)
+    duplicate["title_text"] = "Duplicate"
+    elems = self._annotation_jsonlines * 3 + [duplicate]
+    tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    shards = []
+    for i, (suffix, module) in enumerate(
+        [("", open), (".gz", gzip.open), (".bz2", bz2.open),
+         (".xz", lzma.open)]):
+      shards.append(os.path.join(tmpdir, "shard-%d.jsonl%s" % (i, suffix)))
+      with module(shards[-1], "wt") as f:
+        for elem in elems[2 * i:2 * i + 2]:
+          f.write(json.dumps(elem) + "\n")
+    expected = qed_eval.load_data(self.write_jsonlines(elems))
+    self.assertEqual(expected[duplicate["example_id"]].title, "Duplicate")
+
+    pattern = os.path.join(tmpdir, "shard-*")
+    for num_workers in (1, 2):
+      loaded = qed_eval.load_data(pattern, num_workers=num_workers)
+      self.assertEqual(loaded, expected)
+      self.assertEqual(list(loaded), list(expected))
+    self.assertEqual(
+        qed_eval.load_data(pattern, compact=True).keys(), expected.keys())
+    self.assertEqual(
+        [example.example_id for example in qed_eval.iter_examples(shards[1])],
+        [elem["example_id"] for elem in elems[2:4]])
+    with self.assertRaises(ValueError):
+      qed_eval.load_data(pattern, use_cache=True)
+    with self.assertRaises(ValueError):
+      qed_eval.load_data(shards[1], example_ids=[duplicate["example_id"]])
+
+  def test_chunk_boundaries(self):
+    path = self.write_jsonlines(self._annotation_jsonlines * 5)
+    with open(path, "rb") as f:
+      data = f.read()
+    line_starts = [0] + [i + 1 for i, c in enumerate(data) if c == ord("\n")]
+    for num_chunks in (1, 2, 4, 7, 100):
+      boundaries = qed_eval._chunk_boundaries(path, num_chunks)
+      self.assertEqual(boundaries[0], 0)
+      self.assertEqual(boundaries[-1], len(data))
+      self.assertLessEqual(len(boundaries) - 1, num_chunks)
+      self.assertEqual(boundaries, sorted(set(boundaries)))
+      self.assertContainsSubset(boundaries, line_starts)
+
+  def test_incremental_evaluator(self):
+    first_prediction = json.loads(example_1)
+    self.set_answer(first_prediction, [(506, 520)])
+    self.set_refs(first_prediction, [((15, 27), (462, 479))])
+    second_prediction = json.loads(example_2)
+    self.set_answer(second_prediction, [(217, 243)])
+    replaced_prediction = json.loads(example_1)
+    self.set_answer(replaced_prediction, [(500, 510)])
+    lines = [json.dumps(p) + "\n" for p in
+             (first_prediction, second_prediction, replaced_prediction)]
+    path = self.write_jsonlines([])
+
+    evaluator = qed_eval.IncrementalEvaluator(
+        self.annotation_dict, path, strict=False)
+    self.assertEqual(evaluator.refresh()["answer_accuracy"], 0.0)
+    written = ""
+    # The last chunk ends in the middle of a line, which must be ignored.
+    for chunk in (lines[0], lines[1] + lines[2][:10], lines[2][10:]):
+      with open(path, "a") as f:
+        f.write(chunk)
+      written += chunk
+      complete = written[:written.rfind("\n") + 1]
+      with open(path + ".complete", "w") as f:
+        f.write(complete)
+      self.assertEqual(
+          evaluator.refresh(),
+          qed_eval.compute_scores(self.annotation_dict,
+                                  qed_eval.load_data(path + ".complete"),
+                                  strict=False))
+    self.assertEqual(evaluator.num_predictions, 2)
+
+  def test_evaluator(self):
+    prediction_jsonlines = self.partially_correct_predictions()
+    replaced = json.loads(example_1)
+    self.set_answer(replaced, [(500, 510)])
+    # The mention string does not match its offsets.
+    malformed = json.loads(example_2)
+    malformed["annotation"]["referential_equalities"][0]["question_reference"][
+        "string"] = "not the question"
+
+    for strict in (True, False):
+      evaluator = qed_eval.Evaluator(self.annotation_dict, strict)
+      self.assertEqual(evaluator.result()["answer_accuracy"], 0.0)
+      evaluator.update([replaced, prediction_jsonlines[1], malformed])
+      self.assertEqual(evaluator.num_incorrectly_formatted, 1)
+      # A later prediction for the same example replaces the earlier one.
+      evaluator.update([qed_eval.load_single_line(prediction_jsonlines[0])])
+      self.assertEqual(evaluator.num_predictions, 2)
+      self.assertEqual(
+          evaluator.result(),
+          qed_eval.compute_scores(
+              self.annotation_dict, {
+                  p.example_id: p for p in map(qed_eval.load_single_line,
+                                               prediction_jsonlines)
+              }, strict))
+      evaluator.reset()
+      self.assertEqual(evaluator.num_predictions, 0)
+
+  def test_async_evaluator(self):
+    prediction_jsonlines = self.partially_correct_predictions()
+    replaced = json.loads(example_1)
+    self.set_answer(replaced, [(500, 510)])
+    expected = {
+        strict: qed_eval.compute_scores(
+            self.annotation_dict, {
+                p.example_id: p for p in map(qed_eval.load_single_line,
+                                             prediction_jsonlines)
+            }, strict) for strict in (True, False)
+    }
+    for strict in (True, False):
+      with qed_eval.AsyncEvaluator(self.annotation_dict, strict) as evaluator:
+        evaluator.update(1, [replaced])
+        evaluator.update(2, iter(prediction_jsonlines))
+        evaluator.update(1, prediction_jsonlines)
+        futures = [evaluator.result(step) for step in (1, 2, 3)]
+        self.assertEqual(futures[0].result(), expected[strict])
+        self.assertEqual(futures[1].result(), expected[strict])
+        self.assertEqual(futures[2].result()["answer_accuracy"], 0.0)
+        self.assertEqual(evaluator.futures, dict(zip((1, 2, 3), futures)))
+        with self.assertRaises(ValueError):
+          evaluator.update(1, prediction_jsonlines)
+      with self.assertRaises(ValueError):
+        evaluator.update(4, prediction_jsonlines)
+
+  def test_async_evaluator_errors_and_backpressure(self):
+    started = threading.Event()
+    release = threading.Event()
+    score_example = qed_eval.qed_core.score_example
+
+    def blocking_score_example(*args):
+      started.set()
+      release.wait()
+      return score_example(*args)
+
+    with mock.patch.object(qed_eval.qed_core, "score_example",
+                           blocking_score_example):
+      evaluator = qed_eval.AsyncEvaluator(
+          self.annotation_dict, max_queued_batches=1)
+      example_2_id = json.loads(example_2)["example_id"]
+      # The first batch is being scored and the second fills the queue.
+      evaluator.update(1, [json.loads(example_1)])
+      started.wait()
+      evaluator.update(1, [{"example_id": 0}])
+      blocked = threading.Thread(
+          target=evaluator.update, args=(2, [json.loads(example_2)]))
+      blocked.start()
+      blocked.join(0.1)
+      self.assertTrue(blocked.is_alive())
+      release.set()
+      blocked.join()
+      with self.assertRaises(KeyError):
+        evaluator.result(1).result()
+      self.assertEqual(
+          evaluator.result(2).result(),
+          qed_eval.compute_scores(
+              self.annotation_dict,
+              {example_2_id: qed_eval.load_single_line(json.loads(example_2))},
+              False))
+      evaluator.close()
+
+  def test_instrumented(self):
+    multi_sentence = json.loads(example_1)
+    multi_sentence["annotation"]["explanation_type"] = "multi_sentence"
+    malformed = json.loads(example_2)
+    malformed["annotation"]["referential_equalities"][0]["question_reference"][
+        "string"] = "not the question"
+    annotation_path = self.write_jsonlines(self._annotation_jsonlines)
+    prediction_path = self.write_jsonlines(self.partially_correct_predictions() +
+                                           [multi_sentence, malformed])
+    original_compute_scores = qed_eval.compute_scores
+
+    for strict in (True, False):
+      with qed_eval.instrumented(track_memory=True) as instrumentation:
+        with self.assertRaises(ValueError):
+          with qed_eval.instrumented():
+            pass
+        annotation_dict = qed_eval.load_data(annotation_path)
+        prediction_dict = qed_eval.load_data(prediction_path)
+        score_dict = qed_eval.compute_scores(annotation_dict, prediction_dict,
+                                             strict)
+      self.assertIs(qed_eval.compute_scores, original_compute_scores)
+      uninstrumented = qed_eval.compute_scores(annotation_dict, prediction_dict,
+                                               strict)
+      self.assertNotIn("timings", uninstrumented)
+      self.assertEqual(
+          {
+              metric: value
+              for metric, value in score_dict.items()
+              if metric in uninstrumented
+          }, uninstrumented)
+      for phase in ("load_data", "parse_json", "load_single_line",
+                    "load_aligned_entities", "normalize_text",
+                    "compute_scores"):
+        self.assertIn(phase, score_dict["timings"])
+        self.assertGreater(score_dict["timings"][phase]["wall_seconds"], 0)
+      counters = score_dict["counters"]
+      self.assertEqual(counters["examples_read"], 6)
+      self.assertEqual(counters["incorrectly_formatted"], 1)
+      self.assertEqual(counters["not_single_sentence"], 1)
+      if strict:
+        self.assertNotIn("overlap_comparisons", counters)
+      else:
+        self.assertGreater(counters["overlap_comparisons"], 0)
+      self.assertGreater(score_dict["peak_memory_bytes"], 0)
+      self.assertEqual(instrumentation.report()["counters"], counters)
+
+  def test_stream_scores_matches_compute_scores(self):
+    prediction_jsonlines = self.partially_correct_predictions()
+    annotation_path = self.write_jsonlines(self._annotation_jsonlines)
+    prediction_path = self.write_jsonlines(prediction_jsonlines)
+
+    prediction_dict = qed_eval.load_data(prediction_path)
+    for strict in (True, False):
+      self.assertEqual(
+          qed_eval.stream_scores(annotation_path, prediction_path, strict),
+          qed_eval.compute_scores(self.annotation_dict, prediction_dict,
+                                  strict))
+
+  def test_stream_scores_with_duplicate_ids(self):
+    wrong_prediction = json.loads(example_1)
+    self.set_answer(wrong_prediction, [(500, 510)])
+    self.set_refs(wrong_prediction, [((30, 45), (0, 0))])
+    prediction_jsonlines = [
+        wrong_prediction,
+        json.loads(example_1),
+        json.loads(example_2),
+    ]
+    # The last of the duplicate lines wins, as in load_data.
+    annotation_path = self.write_jsonlines([self._annotation_jsonlines[0]] +
+                                           self._annotation_jsonlines)
+    prediction_path = self.write_jsonlines(prediction_jsonlines)
+
+    annotation_dict = qed_eval.load_data(annotation_path)
+    prediction_dict = qed_eval.load_data(prediction_path)
+    for strict in (True, False):
+      score_dict = qed_eval.stream_scores(annotation_path, prediction_path,
+                                          strict)
+      self.assertEqual(
+          score_dict,
+          qed_eval.compute_scores(annotation_dict, prediction_dict, strict))
+      self.assertEqual(score_dict["exact_match_accuracy"], 1.0)
+      self.assertEqual(score_dict["pair"], (1.0, 1.0, 1.0))
+      self.assertEqual(score_dict["answer_accuracy"], 1.0)
+
+  def test_stream_scores_requires_sorted_files(self):
+    annotation_path = self.write_jsonlines(self._annotation_jsonlines)
+    prediction_path = self.write_jsonlines(self._annotation_jsonlines[::-1])
+    with self.assertRaisesRegex(ValueError, "not sorted by example_id"):
+      qed_eval.stream_scores(annotation_path, prediction_path, strict=True)
+
+  def test_stream_scores_with_missing_prediction(self):
+    prediction_jsonlines = [json.loads(example_2)]
+    self.set_answer(prediction_jsonlines[0], [(216, 243)])
+    annotation_path = self.write_jsonlines(self._annotation_jsonlines)
+    prediction_path = self.write_jsonlines(prediction_jsonlines)
+
+    score_dict = qed_eval.stream_scores(
+        annotation_path, prediction_path, strict=True)
+    self.assertEqual(
+        score_dict,
+        qed_eval.compute_scores(self.annotation_dict,
+                                qed_eval.load_data(prediction_path), True))
+    self.assertEqual(score_dict["exact_match_accuracy"], 0.5)
+
+  def test_stream_scores_with_external_sort(self):
+    prediction_jsonlines = self.partially_correct_predictions()
+    wrong_prediction = json.loads(example_1)
+    self.set_answer(wrong_prediction, [(500, 510)])
+    elems = []
+    for i in range(50):
+      for elem in (prediction_jsonlines + [wrong_prediction]
+                   if i % 3 else prediction_jsonlines):
+        elem = dict(elem, example_id=elem["example_id"] + i * 7919 % 23)
+        elems.append(elem)
+    random.Random(0).shuffle(elems)
+    # Duplicate ids, the last of which wins as in load_data.
+    elems += [dict(prediction_jsonlines[0], example_id=elems[0]["example_id"])]
+    annotations = [
+        dict(elem, example_id=elem["example_id"] + i * 7919 % 23)
+        for i in range(50)
+        for elem in map(json.loads, (example_1, example_2))
+    ]
+    annotation_path = self.write_jsonlines(annotations[::-1])
+    # Two shards of predictions, one of them compressed and with a line that
+    # is not correctly formatted.
+    prediction_path = self.write_jsonlines(elems[70:])
+    prediction_pattern = prediction_path[:-len(".jsonlines")] + "*"
+    with gzip.open(prediction_path + "-1.gz", "wt") as f:
+      for elem in elems[:70]:
+        f.write(json.dumps(elem) + "\n")
+      f.write("{\n")
+    annotation_dict = qed_eval.load_data(annotation_path)
+    prediction_dict = qed_eval.load_data(prediction_pattern)
+    self.assertLen(qed_eval.expand_paths([prediction_pattern]), 2)
+    with self.assertRaisesRegex(ValueError, "not sorted by example_id"):
+      qed_eval.stream_scores(annotation_path, prediction_path, strict=True)
+    for memory_budget in (1, 10000, 1 << 30):
+      with mock.patch.object(qed_eval.qed_core, "MAX_MERGE_RUNS", 3):
+        for strict in (True, False):
+          self.assertEqual(
+              qed_eval.stream_scores(annotation_path, prediction_pattern,
+                                     strict, memory_budget=memory_budget),
+              qed_eval.compute_scores(annotation_dict, prediction_dict,
+                                      strict))
+
+
 
 if __name__ == "__main__":
   absltest.main()
@@ -0,0 +1,385 @@
+r"""Model-ready features of QED examples in memory-mappable .npy shards.
+
+Converts QED jsonl files, of every explanation type, into fixed-width records
+that training jobs can memory-map instead of parsing json and deriving
+sentence indices per example:
+
+   python qed_features.py \
+     --input=qed-train.jsonlines \
+     --output_dir=/tmp/qed-features \
+     --feature_workers=8
+
+The input is split into byte ranges of at most --shard_bytes (compressed files
+are one range each), and every range is converted by a worker process that
+streams its lines and writes one output shard, so that memory use does not
+grow with the input. A shard PREFIX consists of three files:
+
+  PREFIX.examples.npy:   one EXAMPLE_DTYPE record per example.
+  PREFIX.sentences.npy:  one SENTENCE_DTYPE record per sentence of the
+                         paragraph of each example.
+  PREFIX.spans.npy:      one SPAN_DTYPE record per question mention, context
+                         mention, answer span and NQ answer span.
+
+Sentences and spans are stored in example order, and each example record holds
+the row ranges of its sentences and spans. Span offsets are character offsets
+into the question (question mentions) or paragraph (all other spans). Every
+paragraph span is mapped to the sentence its start falls into, by a binary
+search over sentence_starts, and to offsets relative to the start of that
+sentence. Bridged context mentions, which have no span, and question mentions
+have -1 as sentence and sentence-relative offsets.
+
+A training job reads a shard with
+
+  features = qed_features.load_shard(prefix)
+  example = features['examples'][i]
+  spans = features['spans'][example['first_span']:][:example['num_spans']]
+"""
+
+import bisect
+import collections
+import functools
+import glob
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Text, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+
+import numpy as np
+import qed_core
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('input', None,
+                  'Paths or glob patterns of the jsonl files to convert.')
+flags.DEFINE_string('output_dir', None,
+                    'Directory to write the feature shards to.')
+flags.DEFINE_string('shard_name', 'features',
+                    'Name the output shards start with.')
+flags.DEFINE_integer('feature_workers', os.cpu_count() or 1,
+                     'Number of processes converting shards in parallel.')
+flags.DEFINE_integer(
+    'shard_bytes', 64 << 20,
+    'Uncompressed input files are split into shards of at most about this '
+    'many bytes.')
+flags.DEFINE_bool('feature_fast_json', False,
+                  'Parse lines with orjson when it is installed.')
+
+# Explanation types, indexed by their codes in the explanation_type field.
+EXPLANATION_TYPES = ('single_sentence', 'multi_sentence', 'none')
+EXPLANATION_TYPE_CODES = {
+    explanation_type: i for i, explanation_type in enumerate(EXPLANATION_TYPES)
+}
+
+# Span kinds, indexed by their codes in the kind field of spans.
+SPAN_KINDS = ('question_mention', 'context_mention', 'answer', 'nq_answer')
+SPAN_KIND_CODES = {kind: i for i, kind in enumerate(SPAN_KINDS)}
+
+EXAMPLE_DTYPE = np.dtype([
+    ('example_id', '<i8'),
+    ('explanation_type', 'i1'),
+    # Index of the selected sentence, -1 unless single_sentence.
+    ('selected_sentence', '<i4'),
+    ('paragraph_length', '<i4'),
+    ('first_sentence', '<i4'),
+    ('num_sentences', '<i4'),
+    ('first_span', '<i4'),
+    ('num_spans', '<i4'),
+])
+
+SENTENCE_DTYPE = np.dtype([
+    ('example', '<i4'),
+    ('start', '<i4'),
+    ('end', '<i4'),
+])
+
+SPAN_DTYPE = np.dtype([
+    # Row of the example in the examples of the shard.
+    ('example', '<i4'),
+    ('kind', 'i1'),
+    # Index of the referential equality of mentions, of the NQ answer of NQ
+    # answer spans, and 0 for answer spans.
+    ('group', '<i4'),
+    ('start', '<i4'),
+    ('end', '<i4'),
+    # Index of the sentences that the first and last character fall into.
+    ('sentence', '<i4'),
+    ('last_sentence', '<i4'),
+    ('sentence_start', '<i4'),
+    ('sentence_end', '<i4'),
+])
+
+FEATURE_SUFFIXES = {
+    'examples': '.examples.npy',
+    'sentences': '.sentences.npy',
+    'spans': '.spans.npy',
+}
+
+
+def _check_range(name: Text, start: int, end: int, length: int) -> None:
+  if not 0 <= start <= end <= length:
+    raise ValueError('%s [%d, %d) is not within the %d characters of its text.'
+                     % (name, start, end, length))
+
+
+class _ShardBuilder:
+  """Collects the records of one output shard."""
+
+  def __init__(self, check: bool):
+    self.check = check
+    self.examples = []
+    self.sentences = []
+    self.spans = []
+
+  def add_example(self, elem: Mapping[Text, Any]) -> None:
+    """Adds the records of a parsed json line.
+
+    Args:
+      elem: the parsed json line.
+
+    Raises:
+      ValueError, KeyError or TypeError: if the line is not correctly
+        formatted. The records of the line are not added then.
+    """
+    annotation = elem['annotation']
+    explanation_type = annotation['explanation_type']
+    if explanation_type not in EXPLANATION_TYPE_CODES:
+      raise ValueError('Unknown explanation type %r.' % explanation_type)
+    paragraph_length = len(elem['paragraph_text'])
+    question_length = len(elem['question_text'])
+    starts = elem['sentence_starts']
+    if self.check and (not starts or starts[0] != 0 or
+                       any(a >= b for a, b in zip(starts, starts[1:])) or
+                       starts[-1] >= max(paragraph_length, 1)):
+      raise ValueError('sentence_starts %s do not split a paragraph of %d '
+                       'characters.' % (starts, paragraph_length))
+    row = len(self.examples)
+    spans = []
+
+    def add_span(kind, group, reference, in_paragraph=True):
+      start, end = reference['start'], reference['end']
+      if start == -1 or not in_paragraph:
+        if self.check and start != -1:
+          _check_range('Question mention', start, end, question_length)
+        spans.append((row, SPAN_KIND_CODES[kind], group, start, end, -1, -1,
+                      -1, -1))
+        return
+      if self.check:
+        _check_range(kind, start, end, paragraph_length)
+      sentence = bisect.bisect_right(starts, start) - 1
+      last_sentence = bisect.bisect_right(starts, max(end - 1, start)) - 1
+      sentence_start = starts[sentence]
+      spans.append((row, SPAN_KIND_CODES[kind], group, start, end, sentence,
+                    last_sentence, start - sentence_start,
+                    end - sentence_start))
+
+    for i, equality in enumerate(annotation.get('referential_equalities', [])):
+      add_span('question_mention', i, equality['question_reference'],
+               in_paragraph=False)
+      add_span('context_mention', i, equality['sentence_reference'])
+    for answer in annotation.get('answer', []):
+      add_span('answer', 0, answer['paragraph_reference'])
+    for i, nq_answer in enumerate(elem['original_nq_answers']):
+      for span in nq_answer:
+        add_span('nq_answer', i, span)
+
+    selected_sentence = -1
+    if explanation_type == 'single_sentence':
+      selected_start = annotation['selected_sentence']['start']
+      selected_sentence = bisect.bisect_right(starts, selected_start) - 1
+      if self.check and starts[selected_sentence] != selected_start:
+        raise ValueError('The selected sentence does not start at one of the '
+                         'sentence_starts.')
+
+    self.examples.append(
+        (elem['example_id'], EXPLANATION_TYPE_CODES[explanation_type],
+         selected_sentence, paragraph_length, len(self.sentences), len(starts),
+         len(self.spans), len(spans)))
+    ends = list(starts[1:]) + [paragraph_length]
+    self.sentences.extend(
+        (row, start, end) for start, end in zip(starts, ends))
+    self.spans.extend(spans)
+
+  def write(self, prefix: Text) -> None:
+    """Writes the collected records to the shard files of prefix."""
+    for name, records, dtype in (('examples', self.examples, EXAMPLE_DTYPE),
+                                 ('sentences', self.sentences, SENTENCE_DTYPE),
+                                 ('spans', self.spans, SPAN_DTYPE)):
+      fname = prefix + FEATURE_SUFFIXES[name]
+      # Write to a temporary file first so that readers never see a partial
+      # shard.
+      tmp_fname = '%s.tmp%d' % (fname, os.getpid())
+      with open(tmp_fname, 'wb') as f:
+        np.save(f, np.array(records, dtype=dtype))
+      os.replace(tmp_fname, fname)
+
+
+def _byte_range_lines(fname: Text, start: int, end: int) -> Iterator[bytes]:
+  """Yields the lines of a byte range of a file, reading them one by one."""
+  with open(fname, 'rb') as f:
+    f.seek(start)
+    position = start
+    while position < end:
+      line = f.readline()
+      if not line:
+        break
+      position += len(line)
+      yield line
+
+
+def convert_lines(lines: Iterable[Any],
+                  prefix: Text,
+                  fast_json: bool = False,
+                  check: bool = True) -> Mapping[Text, int]:
+  """Converts jsonl lines into one feature shard.
+
+  Args:
+    lines: the jsonl lines, as text or bytes.
+    prefix: path prefix of the shard files to write.
+    fast_json: whether to parse lines with orjson when it is installed.
+    check: whether to check that sentence_starts split the paragraph and that
+      span offsets are within their texts.
+
+  Returns:
+    Counters of the examples read, of the incorrectly formatted lines that
+    were skipped, of the examples of each explanation type and of the spans.
+  """
+  loads = qed_core._json_decoder(fast_json)  # pylint: disable=protected-access
+  builder = _ShardBuilder(check)
+  counters = collections.Counter()
+  for line in lines:
+    if not line.strip():
+      continue
+    counters['examples_read'] += 1
+    try:
+      elem = loads(line)
+      builder.add_example(elem)
+    except (ValueError, KeyError, TypeError, IndexError):
+      counters['incorrectly_formatted'] += 1
+      continue
+    counters[elem['annotation']['explanation_type']] += 1
+  counters['spans'] = len(builder.spans)
+  builder.write(prefix)
+  return counters
+
+
+def _convert_range(fname: Text, start: int, end: int, prefix: Text,
+                   fast_json: bool, check: bool) -> Mapping[Text, int]:
+  """Converts a byte range of an uncompressed jsonl file in a worker."""
+  return convert_lines(_byte_range_lines(fname, start, end), prefix,
+                       fast_json, check)
+
+
+def _convert_file(fname: Text, prefix: Text, fast_json: bool,
+                  check: bool) -> Mapping[Text, int]:
+  """Converts a whole, possibly compressed, jsonl file in a worker."""
+  with qed_core.open_jsonl(fname) as f:
+    return convert_lines(f, prefix, fast_json, check)
+
+
+def _shard_ranges(fname: Text, shard_bytes: int) -> List[Tuple[int, int]]:
+  """Byte ranges of whole lines of about shard_bytes each."""
+  num_chunks = max(1, -(-os.path.getsize(fname) // shard_bytes))
+  boundaries = qed_core._chunk_boundaries(  # pylint: disable=protected-access
+      fname, num_chunks)
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def write_features(fnames: Iterable[Text],
+                   output_dir: Text,
+                   shard_name: Text = 'features',
+                   num_workers: int = 1,
+                   shard_bytes: int = 64 << 20,
+                   fast_json: bool = False,
+                   check: bool = True) -> List[Text]:
+  """Converts jsonl files into feature shards, see the module docstring.
+
+  Args:
+    fnames: paths or glob patterns of the jsonl files, which may be compressed.
+    output_dir: directory to write the shards to. It is created if needed.
+    shard_name: name the shard prefixes start with.
+    num_workers: number of processes converting shards in parallel.
+    shard_bytes: uncompressed files are split into shards of at most about
+      this many bytes.
+    fast_json: whether to parse lines with orjson when it is installed.
+    check: whether to check that sentence_starts split the paragraph and that
+      span offsets are within their texts.
+
+  Returns:
+    The prefixes of the written shards, in input order.
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  tasks = []
+  for fname in qed_core.expand_paths(fnames):
+    if qed_core._is_compressed(fname):  # pylint: disable=protected-access
+      tasks.append(functools.partial(_convert_file, fname))
+    else:
+      tasks.extend(
+          functools.partial(_convert_range, fname, start, end)
+          for start, end in _shard_ranges(fname, shard_bytes))
+  prefixes = [
+      os.path.join(output_dir, '%s-%05d-of-%05d' % (shard_name, i, len(tasks)))
+      for i in range(len(tasks))
+  ]
+  tasks = [
+      functools.partial(task, prefix, fast_json, check)
+      for task, prefix in zip(tasks, prefixes)
+  ]
+  counters = collections.Counter()
+  if num_workers > 1 and len(tasks) > 1:
+    # pylint: disable=protected-access
+    with qed_core._process_pool(num_workers) as executor:
+      for shard_counters in qed_core._ordered_results(
+          executor, tasks, 2 * num_workers):
+        counters.update(shard_counters)
+    # pylint: enable=protected-access
+  else:
+    for task in tasks:
+      counters.update(task())
+  logging.info('Wrote %d shards with %d examples and %d spans to %s.',
+               len(prefixes), counters['examples_read'] -
+               counters['incorrectly_formatted'], counters['spans'], output_dir)
+  logging.info('%d examples not correctly formatted and skipped.',
+               counters['incorrectly_formatted'])
+  for explanation_type in EXPLANATION_TYPES:
+    logging.info('%d %s examples.', counters[explanation_type],
+                 explanation_type)
+  return prefixes
+
+
+def load_shard(prefix: Text, mmap: bool = True) -> Dict[Text, np.ndarray]:
+  """Reads the examples, sentences and spans of a shard.
+
+  Args:
+    prefix: the shard prefix, as returned by write_features.
+    mmap: whether to memory-map the files rather than read them.
+
+  Returns:
+    Dict from 'examples', 'sentences' and 'spans' to their record arrays.
+  """
+  return {
+      name: np.load(prefix + suffix, mmap_mode='r' if mmap else None)
+      for name, suffix in FEATURE_SUFFIXES.items()
+  }
+
+
+def list_shards(output_dir: Text) -> List[Text]:
+  """Sorted prefixes of the shards written to output_dir."""
+  suffix = FEATURE_SUFFIXES['examples']
+  return sorted(
+      fname[:-len(suffix)]
+      for fname in glob.glob(os.path.join(output_dir, '*' + suffix)))
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  write_features(FLAGS.input, FLAGS.output_dir, FLAGS.shard_name,
+                 FLAGS.feature_workers, FLAGS.shard_bytes,
+                 FLAGS.feature_fast_json)
+
+
+if __name__ == '__main__':
+  flags.mark_flags_as_required(['input', 'output_dir'])
+  app.run(main)
@@ -0,0 +1,123 @@
+# Lint as: python3
+"""Tests for qed_features."""
+
+import gzip
+import json
+import os
+import tempfile
+
+import numpy as np
+import qed_eval_test
+import qed_features
+from absl.testing import absltest
+
+
+def _multi_sentence_example(example_id):
+  elem = json.loads(qed_eval_test.example_2)
+  elem["example_id"] = example_id
+  elem["annotation"] = {"explanation_type": "multi_sentence"}
+  return elem
+
+
+class QedFeaturesTest(absltest.TestCase):
+
+  def setUp(self):
+    super(QedFeaturesTest, self).setUp()
+    self.tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    self.elems = [
+        json.loads(qed_eval_test.example_1),
+        json.loads(qed_eval_test.example_2),
+        _multi_sentence_example(1),
+    ]
+    self.fname = os.path.join(self.tmpdir, "input.jsonl")
+    with open(self.fname, "w") as f:
+      for elem in self.elems * 4:
+        f.write(json.dumps(elem) + "\n")
+      # Not correctly formatted.
+      f.write(json.dumps(dict(self.elems[0], sentence_starts=[5])) + "\n")
+      f.write("{\n")
+
+  def write_features(self, fnames, name, **kwargs):
+    return qed_features.write_features(
+        fnames, os.path.join(self.tmpdir, name), **kwargs)
+
+  def test_features(self):
+    prefixes = self.write_features([self.fname], "features")
+    self.assertLen(prefixes, 1)
+    features = qed_features.load_shard(prefixes[0])
+    self.assertIsInstance(features["spans"], np.memmap)
+    examples = features["examples"]
+    self.assertLen(examples, 12)
+    for row, elem in enumerate(self.elems * 4):
+      example = examples[row]
+      self.assertEqual(example["example_id"], elem["example_id"])
+      explanation_type = elem["annotation"]["explanation_type"]
+      self.assertEqual(qed_features.EXPLANATION_TYPES[
+          example["explanation_type"]], explanation_type)
+      paragraph = elem["paragraph_text"]
+      starts = elem["sentence_starts"]
+      sentences = features["sentences"][
+          example["first_sentence"]:][:example["num_sentences"]]
+      self.assertEqual(list(sentences["start"]), starts)
+      self.assertEqual(sentences["end"][-1], len(paragraph))
+      self.assertTrue(np.all(sentences["example"] == row))
+      if explanation_type == "single_sentence":
+        self.assertEqual(starts[example["selected_sentence"]],
+                         elem["annotation"]["selected_sentence"]["start"])
+      else:
+        self.assertEqual(example["selected_sentence"], -1)
+
+      spans = features["spans"][example["first_span"]:][:example["num_spans"]]
+      self.assertTrue(np.all(spans["example"] == row))
+      kinds = [qed_features.SPAN_KINDS[kind] for kind in spans["kind"]]
+      equalities = elem["annotation"].get("referential_equalities", [])
+      self.assertEqual(kinds.count("question_mention"), len(equalities))
+      self.assertEqual(kinds.count("nq_answer"),
+                       sum(map(len, elem["original_nq_answers"])))
+      for kind, span in zip(kinds, spans):
+        if kind == "question_mention" or span["start"] == -1:
+          self.assertEqual(span["sentence"], -1)
+          continue
+        # Sentence-relative offsets give the same text as paragraph offsets.
+        sentence = sentences[span["sentence"]]
+        self.assertBetween(span["start"], sentence["start"],
+                           sentence["end"] - 1)
+        sentence_text = paragraph[sentence["start"]:]
+        self.assertEqual(
+            sentence_text[span["sentence_start"]:span["sentence_end"]],
+            paragraph[span["start"]:span["end"]])
+        self.assertGreaterEqual(span["last_sentence"], span["sentence"])
+      for i, equality in enumerate(equalities):
+        context = spans[(spans["kind"] == 1) & (spans["group"] == i)]
+        self.assertEqual(context["start"],
+                         equality["sentence_reference"]["start"])
+
+  def test_sharded_and_parallel(self):
+    compressed = os.path.join(self.tmpdir, "input.jsonl.gz")
+    with open(self.fname, "rb") as f, gzip.open(compressed, "wb") as g:
+      g.write(f.read())
+    expected = qed_features.load_shard(
+        self.write_features([self.fname], "one")[0], mmap=False)
+    prefixes = self.write_features([self.fname, compressed],
+                                   "sharded",
+                                   shard_name="part",
+                                   num_workers=2,
+                                   shard_bytes=4096)
+    self.assertGreater(len(prefixes), 2)
+    self.assertEqual(
+        qed_features.list_shards(os.path.join(self.tmpdir, "sharded")),
+        prefixes)
+    shards = [qed_features.load_shard(prefix) for prefix in prefixes]
+    example_ids = np.concatenate([shard["examples"]["example_id"]
+                                  for shard in shards])
+    np.testing.assert_array_equal(
+        example_ids, np.tile(expected["examples"]["example_id"], 2))
+    # The compressed file is one shard, and row ranges are local to each shard.
+    for name in ("examples", "sentences", "spans"):
+      np.testing.assert_array_equal(shards[-1][name], expected[name])
+    num_spans = sum(len(shard["spans"]) for shard in shards)
+    self.assertEqual(num_spans, 2 * len(expected["spans"]))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,287 @@
+r"""Long-lived QED evaluation server with preloaded annotations.
+
+The server keeps the annotation dict in memory and scores predictions sent to
+it over a minimal HTTP/1.1 interface, on either a unix socket or a localhost
+TCP port. It is started from qed_eval:
+
+   qed_eval \
+     --annotation=qed-dev.jsonlines \
+     --serve_socket=/tmp/qed_eval.sock
+
+Requests:
+  GET /health
+      Returns {"num_annotations": <number of loaded annotated examples>}.
+  POST /score[?strict=true|false]
+      The body is either a JSON object {"prediction": "<path to jsonl file>"}
+      sent with Content-Type: application/json, or the prediction jsonl lines
+      themselves, streamed with Content-Length or chunked transfer encoding.
+      Returns the score dict of compute_scores as JSON.
+
+Parsing and scoring run in a thread pool so that concurrent requests do not
+block the event loop; all requests share the same annotation dict.
+"""
+
+import asyncio
+import collections
+import functools
+import json
+from typing import Any, AsyncIterator, Mapping, Optional, Text, Tuple
+import urllib.parse
+
+from absl import logging
+
+# Streamed bodies are read and parsed in blocks of about this many bytes.
+BLOCK_SIZE = 1 << 16
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+  """Error reported to the client with the given status code."""
+
+  def __init__(self, status: int, message: Text):
+    super().__init__(message)
+    self.status = status
+
+
+async def _read_body_blocks(
+    reader: asyncio.StreamReader,
+    headers: Mapping[Text, Text]) -> AsyncIterator[bytes]:
+  """Yields the raw request body in blocks of at most BLOCK_SIZE bytes."""
+  try:
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if not size:
+          await reader.readline()  # Final CRLF, trailers are not supported.
+          return
+        for offset in range(0, size, BLOCK_SIZE):
+          yield await reader.readexactly(min(BLOCK_SIZE, size - offset))
+        await reader.readexactly(2)
+    else:
+      remaining = int(headers.get('content-length', 0))
+      if remaining < 0:
+        raise ValueError('negative Content-Length')
+      while remaining > 0:
+        block = await reader.readexactly(min(BLOCK_SIZE, remaining))
+        remaining -= len(block)
+        yield block
+  except asyncio.IncompleteReadError:
+    raise HTTPError(400, 'Body shorter than announced.')
+  except ValueError as e:
+    raise HTTPError(400, 'Malformed body framing: %s' % e)
+
+
+async def _read_body_lines(
+    reader: asyncio.StreamReader,
+    headers: Mapping[Text, Text]) -> AsyncIterator[bytes]:
+  """Yields the request body in runs of whole lines, as they arrive.
+
+  Lines are split here rather than with StreamReader.readline, so they are
+  not limited to the reader's buffer size and a last line without a newline
+  does not wait for more input.
+
+  Args:
+    reader: the connection's reader, positioned at the start of the body.
+    headers: the request headers, with lowercase names.
+
+  Yields:
+    Non-empty byte strings that each end at a newline, except possibly the last
+    one.
+  """
+  pending = bytearray()
+  async for block in _read_body_blocks(reader, headers):
+    pending += block
+    end = pending.rfind(b'\n') + 1
+    if end:
+      yield bytes(pending[:end])
+      del pending[:end]
+  if pending:
+    yield bytes(pending)
+
+
+class EvaluationServer:
+  """Scores predictions against annotations that are loaded only once."""
+
+  def __init__(self,
+               annotation_dict: Mapping[int, Any],
+               strict: bool = False,
+               evaluator: Any = None):
+    """Creates a server for annotation_dict.
+
+    Args:
+      annotation_dict: annotated QEDExamples keyed by example id.
+      strict: whether to enforce strict match unless a request says otherwise.
+      evaluator: the module to parse and score with, qed_core by default.
+    """
+    if evaluator is None:
+      import qed_core as evaluator  # pylint: disable=g-import-not-at-top
+    self._annotation_dict = annotation_dict
+    self._strict = strict
+    self._evaluator = evaluator
+
+  def _parse(self, data: bytes,
+             counters: collections.Counter) -> Mapping[int, Any]:
+    """Parses a run of jsonl lines into predicted examples by id."""
+    try:
+      text = data.decode('utf-8')
+    except UnicodeDecodeError as e:
+      raise HTTPError(400, 'Body is not valid UTF-8: %s' % e)
+    return {
+        example.example_id: example
+        for example in self._evaluator.parse_lines(
+            text.splitlines(), counters)
+        if example is not None
+    }
+
+  def _score(self, prediction_dict: Mapping[int, Any],
+             strict: bool) -> Mapping[Text, Any]:
+    return self._evaluator.compute_scores(self._annotation_dict,
+                                          prediction_dict, strict)
+
+  async def _handle_score(self, reader: asyncio.StreamReader,
+                          headers: Mapping[Text, Text],
+                          query: Mapping[Text, Text]) -> Mapping[Text, Any]:
+    strict = self._strict
+    if 'strict' in query:
+      strict = query['strict'].lower() in ('1', 'true')
+    loop = asyncio.get_running_loop()
+    if headers.get('content-type', '').startswith('application/json'):
+      body = b''.join([block async for block in _read_body_blocks(
+          reader, headers)])
+      try:
+        request = json.loads(body)
+        prediction_fname = request['prediction']
+      except (ValueError, KeyError, TypeError):
+        raise HTTPError(400, 'Expected {"prediction": "<path>"}.')
+      strict = request.get('strict', strict)
+      try:
+        prediction_dict = await loop.run_in_executor(
+            None, self._evaluator.load_data, prediction_fname)
+      except OSError as e:
+        raise HTTPError(400, str(e))
+    else:
+      prediction_dict = {}
+      counters = collections.Counter()
+      async for lines in _read_body_lines(reader, headers):
+        # Later lines win, as in load_data.
+        prediction_dict.update(await loop.run_in_executor(
+            None, self._parse, lines, counters))
+      logging.info('%d examples not correctly formatted and skipped.',
+                   counters['incorrectly_formatted'])
+    return await loop.run_in_executor(
+        None, functools.partial(self._score, prediction_dict, strict))
+
+  async def _handle(self, reader: asyncio.StreamReader,
+                    writer: asyncio.StreamWriter) -> None:
+    """Serves a single request on a connection and closes it."""
+    try:
+      try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+          line = (await reader.readline()).decode('latin-1').strip()
+          if not line:
+            break
+          name, _, value = line.partition(':')
+          headers[name.strip().lower()] = value.strip()
+      except ValueError:  # A line longer than the reader's limit.
+        raise HTTPError(400, 'Request head too long.')
+      if len(request_line) != 3:
+        raise HTTPError(400, 'Malformed request line.')
+      method, target, _ = request_line
+      url = urllib.parse.urlsplit(target)
+      query = dict(urllib.parse.parse_qsl(url.query))
+      if url.path == '/health':
+        status, response = 200, {'num_annotations': len(self._annotation_dict)}
+      elif url.path == '/score':
+        if method != 'POST':
+          raise HTTPError(405, 'Use POST to score predictions.')
+        status, response = 200, await self._handle_score(
+            reader, headers, query)
+      else:
+        raise HTTPError(404, 'Unknown path %s.' % url.path)
+    except HTTPError as e:
+      status, response = e.status, {'error': str(e)}
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('Failed to serve request.')
+      status, response = 500, {'error': str(e)}
+    body = json.dumps(response).encode('utf-8')
+    writer.write(b'HTTP/1.1 %d %s\r\n'
+                 b'Content-Type: application/json\r\n'
+                 b'Content-Length: %d\r\n'
+                 b'Connection: close\r\n\r\n' %
+                 (status, _REASONS[status].encode(), len(body)) + body)
+    try:
+      await writer.drain()
+    finally:
+      writer.close()
+
+  async def start(self,
+                  unix_socket: Optional[Text] = None,
+                  port: int = 0) -> asyncio.AbstractServer:
+    """Starts listening on unix_socket if given, else on localhost:port."""
+    if unix_socket:
+      return await asyncio.start_unix_server(self._handle, path=unix_socket)
+    return await asyncio.start_server(self._handle, host='127.0.0.1', port=port)
+
+
+def serve(annotation_dict: Mapping[int, Any],
+          unix_socket: Optional[Text] = None,
+          port: int = 0,
+          strict: bool = False,
+          evaluator: Any = None) -> None:
+  """Serves scoring requests until interrupted, see EvaluationServer."""
+
+  async def run():
+    server = await EvaluationServer(annotation_dict, strict, evaluator).start(
+        unix_socket, port)
+    for sock in server.sockets:
+      logging.info('Serving %d annotated examples on %s.',
+                   len(annotation_dict), sock.getsockname())
+    async with server:
+      await server.serve_forever()
+
+  asyncio.run(run())
+
+
+async def request(path: Text,
+                  body: bytes = b'',
+                  content_type: Text = 'application/x-ndjson',
+                  unix_socket: Optional[Text] = None,
+                  port: int = 0) -> Tuple[int, Mapping[Text, Any]]:
+  """Minimal client: sends one request and returns (status, decoded JSON).
+
+  Args:
+    path: request path, including the query string.
+    body: POST body; a GET request is sent if empty.
+    content_type: content type of the body.
+    unix_socket: path of the server's unix socket, if it listens on one.
+    port: the server's localhost port otherwise.
+
+  Returns:
+    The HTTP status code and the decoded JSON response.
+  """
+  method = 'POST' if body else 'GET'
+  head = ('%s %s HTTP/1.1\r\nHost: localhost\r\n'
+          'Content-Type: %s\r\nContent-Length: %d\r\n\r\n' %
+          (method, path, content_type, len(body))).encode('latin-1')
+  return await raw_request(head + body, unix_socket, port)
+
+
+async def raw_request(data: bytes,
+                      unix_socket: Optional[Text] = None,
+                      port: int = 0) -> Tuple[int, Mapping[Text, Any]]:
+  """Sends data as is and returns (status, decoded JSON) of the response."""
+  if unix_socket:
+    reader, writer = await asyncio.open_unix_connection(unix_socket)
+  else:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  writer.write(data)
+  await writer.drain()
+  response = await reader.read()
+  writer.close()
+  head, _, response_body = response.partition(b'\r\n\r\n')
+  status = int(head.split()[1])
+  return status, json.loads(response_body)
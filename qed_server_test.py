@@ -0,0 +1,119 @@
+# Lint as: python3
+"""Tests for qed_server."""
+
+import asyncio
+import json
+import os
+import tempfile
+
+import qed_eval
+import qed_eval_test
+import qed_server
+from absl.testing import absltest
+
+
+class QedServerTest(absltest.TestCase):
+
+  def setUp(self):
+    super(QedServerTest, self).setUp()
+    self.tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    annotation_jsonlines = [
+        json.loads(qed_eval_test.example_1),
+        json.loads(qed_eval_test.example_2)
+    ]
+    self.annotation_dict = {
+        elem.example_id: elem for elem in
+        (qed_eval.load_single_line(l) for l in annotation_jsonlines)
+    }
+    prediction = annotation_jsonlines[1]
+    prediction["annotation"]["answer"][0]["paragraph_reference"]["start"] = 217
+    self.prediction_body = "".join(
+        json.dumps(l) + "\n" for l in annotation_jsonlines).encode("utf-8")
+    self.prediction_path = os.path.join(self.tmpdir, "prediction.jsonlines")
+    with open(self.prediction_path, "wb") as f:
+      f.write(self.prediction_body)
+    prediction_dict = qed_eval.load_data(self.prediction_path)
+    self.expected = {
+        strict: json.loads(json.dumps(qed_eval.compute_scores(
+            self.annotation_dict, prediction_dict, strict)))
+        for strict in (True, False)
+    }
+
+  def test_concurrent_requests_on_unix_socket(self):
+    socket_path = os.path.join(self.tmpdir, "qed.sock")
+
+    async def run():
+      server = await qed_server.EvaluationServer(self.annotation_dict).start(
+          unix_socket=socket_path)
+      async with server:
+        return await asyncio.gather(
+            qed_server.request("/health", unix_socket=socket_path),
+            qed_server.request(
+                "/score", self.prediction_body, unix_socket=socket_path),
+            qed_server.request(
+                "/score?strict=true", self.prediction_body,
+                unix_socket=socket_path),
+            qed_server.request(
+                "/score",
+                json.dumps({"prediction": self.prediction_path}).encode(),
+                content_type="application/json",
+                unix_socket=socket_path),
+            qed_server.request("/missing", unix_socket=socket_path))
+
+    health, streamed, strict, from_file, missing = asyncio.run(run())
+    self.assertEqual(health, (200, {"num_annotations": 2}))
+    self.assertEqual(streamed, (200, self.expected[False]))
+    self.assertEqual(strict, (200, self.expected[True]))
+    self.assertEqual(from_file, (200, self.expected[False]))
+    self.assertEqual(missing[0], 404)
+
+  def test_body_framing(self):
+    socket_path = os.path.join(self.tmpdir, "qed.sock")
+    padded = json.loads(self.prediction_body.splitlines()[0])
+    padded["padding"] = "x" * (3 * qed_server.BLOCK_SIZE)
+    long_line_body = (json.dumps(padded) + "\n").encode() + (
+        self.prediction_body.splitlines()[1])
+    chunks = [self.prediction_body[:10], self.prediction_body[10:]]
+    chunked = (b"POST /score HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" +
+               b"".join(b"%x\r\n%s\r\n" % (len(c), c) for c in chunks) +
+               b"0\r\n\r\n")
+
+    async def run():
+      server = await qed_server.EvaluationServer(self.annotation_dict).start(
+          unix_socket=socket_path)
+      async with server:
+        return await asyncio.gather(
+            qed_server.request(
+                "/score", self.prediction_body.rstrip(b"\n"),
+                unix_socket=socket_path),
+            qed_server.request(
+                "/score", long_line_body, unix_socket=socket_path),
+            qed_server.raw_request(chunked, unix_socket=socket_path),
+            qed_server.request(
+                "/score", b"\xff\xfe\n", unix_socket=socket_path),
+            qed_server.raw_request(
+                b"POST /score HTTP/1.1\r\nContent-Length: ten\r\n\r\n",
+                unix_socket=socket_path))
+
+    no_newline, long_line, chunked, bad_utf8, bad_length = asyncio.run(run())
+    self.assertEqual(no_newline, (200, self.expected[False]))
+    self.assertEqual(long_line, (200, self.expected[False]))
+    self.assertEqual(chunked, (200, self.expected[False]))
+    self.assertEqual(bad_utf8[0], 400)
+    self.assertEqual(bad_length[0], 400)
+
+  def test_tcp_port(self):
+
+    async def run():
+      server = await qed_server.EvaluationServer(
+          self.annotation_dict, strict=True).start(port=0)
+      port = server.sockets[0].getsockname()[1]
+      async with server:
+        return await qed_server.request(
+            "/score", self.prediction_body, port=port)
+
+    self.assertEqual(asyncio.run(run()), (200, self.expected[True]))
+
+
+if __name__ == "__main__":
+  absltest.main()
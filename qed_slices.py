@@ -0,0 +1,159 @@
+r"""Per-example QED results in columnar files and scores over slices of them.
+
+compute_scores(..., example_counts=[]) reports the ScoreCounts of every
+annotated example. example_table lays them out as columns, one row per
+annotated example, together with properties of the example that results are
+commonly sliced by:
+
+  example_id:      int64 id of the example.
+  counts:          [num_examples, 12] float64 counts, in qed_stats.COUNT_FIELDS
+                   order.
+  predicted:       whether the prediction file has the example.
+  answer_correct:  whether the predicted answer is correct.
+  num_aligned:     number of annotated referential equalities.
+  num_bridging:    number of those whose context mention is bridged.
+  title_hash:      uint64 title_hash of the Wikipedia page title.
+
+The table is written to an .npz file with write_example_table, e.g. by
+qed_eval --example_table. Since every QED metric is a function of counts
+summed over examples, the metrics of any subset of rows follow from the sums
+of their count vectors, without scoring again:
+
+  table = qed_slices.load_example_table('dev.npz')
+  slice_scores(table, table['num_bridging'] > 0)
+  group_scores(table, table['num_aligned'])
+  group_scores(table, table['title_hash'])[title_hash('Nobel Prize')]
+
+Like qed_stats, this module only depends on NumPy.
+"""
+
+import hashlib
+from typing import Any, Dict, Hashable, Mapping, Sequence, Text
+
+import numpy as np
+import qed_stats
+
+COLUMNS = ('example_id', 'counts', 'predicted', 'answer_correct',
+           'num_aligned', 'num_bridging', 'title_hash')
+
+_CORRECT_ANSWERS = qed_stats.COUNT_FIELDS.index('correct_answers')
+
+
+def title_hash(title: Text) -> int:
+  """Stable 64 bit hash of a title, as stored in the title_hash column."""
+  return int.from_bytes(
+      hashlib.blake2b(title.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def example_table(annotation_dict: Mapping[int, Any],
+                  prediction_dict: Mapping[int, Any],
+                  example_counts: Sequence[Any]) -> Dict[Text, np.ndarray]:
+  """Columns of per-example results, see the module docstring.
+
+  Args:
+    annotation_dict: annotated QEDExamples keyed by example id.
+    prediction_dict: the predicted QEDExamples they were scored against.
+    example_counts: the ScoreCounts that compute_scores reported for
+      annotation_dict and prediction_dict.
+
+  Returns:
+    Dict from each of COLUMNS to an array with one row per annotated example,
+    in the order of annotation_dict.
+  """
+  if len(example_counts) != len(annotation_dict):
+    raise ValueError(
+        '%d example counts for %d annotated examples; pass the example_counts '
+        'of compute_scores(annotation_dict, ...).' %
+        (len(example_counts), len(annotation_dict)))
+  counts = qed_stats.count_array(example_counts)
+  annotations = list(annotation_dict.values())
+  return {
+      'example_id':
+          np.array(list(annotation_dict), dtype=np.int64),
+      'counts':
+          counts,
+      'predicted':
+          np.array([example_id in prediction_dict
+                    for example_id in annotation_dict], dtype=bool),
+      'answer_correct':
+          counts[:, _CORRECT_ANSWERS] > 0,
+      'num_aligned':
+          np.array([len(a.aligned_nps) for a in annotations], dtype=np.int32),
+      'num_bridging':
+          np.array([
+              sum(1 for _, c in a.aligned_nps if c.start_offset == -1)
+              for a in annotations
+          ], dtype=np.int32),
+      'title_hash':
+          np.array([title_hash(a.title) for a in annotations],
+                   dtype=np.uint64),
+  }
+
+
+def write_example_table(fname: Text, table: Mapping[Text,
+                                                    np.ndarray]) -> None:
+  """Writes an example_table to a compressed .npz file."""
+  with open(fname, 'wb') as f:
+    np.savez_compressed(f, **{name: table[name] for name in COLUMNS})
+
+
+def load_example_table(fname: Text) -> Dict[Text, np.ndarray]:
+  """Reads a table written by write_example_table."""
+  with np.load(fname) as data:
+    missing = [name for name in COLUMNS if name not in data.files]
+    if missing:
+      raise ValueError('%s is missing the columns %s.' % (fname, missing))
+    return {name: data[name] for name in COLUMNS}
+
+
+def _score_dict(scores: Mapping[Text, np.ndarray], row: Any) -> Dict[Text, Any]:
+  """The score dict of one row of scores_from_sums."""
+  result = {}
+  for metric in qed_stats.METRICS:
+    value = scores[metric][row]
+    result[metric] = (tuple(float(v) for v in value) if value.ndim else
+                      float(value))
+  return result
+
+
+def slice_scores(table: Mapping[Text, np.ndarray],
+                 mask: np.ndarray) -> Dict[Text, Any]:
+  """Score dict of the examples selected by mask, as compute_scores gives it.
+
+  Args:
+    table: an example_table.
+    mask: boolean array with one entry per row, or an array of row indices.
+
+  Returns:
+    The score dict of the selected examples alone.
+  """
+  counts = table['counts'][mask]
+  if not len(counts):
+    raise ValueError('Cannot score a slice of zero examples.')
+  scores = qed_stats.scores_from_sums(counts.sum(axis=0)[np.newaxis],
+                                      len(counts))
+  return _score_dict(scores, 0)
+
+
+def group_scores(table: Mapping[Text, np.ndarray],
+                 keys: np.ndarray) -> Dict[Hashable, Dict[Text, Any]]:
+  """Score dicts of the examples grouped by key, all computed at once.
+
+  Args:
+    table: an example_table.
+    keys: array with the key of each row, e.g. one of the table's columns or
+      a boolean array.
+
+  Returns:
+    Dict from each distinct key to the score dict of the rows that have it.
+  """
+  keys = np.asarray(keys)
+  if len(keys) != len(table['counts']):
+    raise ValueError('%d keys for %d rows.' % (len(keys), len(table['counts'])))
+  groups, rows = np.unique(keys, return_inverse=True)
+  sums = np.zeros((len(groups), len(qed_stats.COUNT_FIELDS)))
+  np.add.at(sums, rows.reshape(-1), table['counts'])
+  scores = qed_stats.scores_from_sums(sums, np.bincount(rows.reshape(-1)))
+  return {
+      group.item(): _score_dict(scores, i) for i, group in enumerate(groups)
+  }
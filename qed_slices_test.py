@@ -0,0 +1,118 @@
+# Lint as: python3
+"""Tests for qed_slices."""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+import qed_eval
+import qed_eval_test
+import qed_slices
+from absl.testing import absltest
+
+
+class QedSlicesTest(absltest.TestCase):
+
+  def setUp(self):
+    super(QedSlicesTest, self).setUp()
+    annotations = [
+        qed_eval.load_single_line(json.loads(example))
+        for example in (qed_eval_test.example_1, qed_eval_test.example_2)
+    ]
+    # Ten copies of the two examples with distinct ids, some bridged, some with
+    # a predicted alignment missing and some without prediction.
+    self.annotation_dict = {}
+    self.prediction_dict = {}
+    for i in range(10):
+      for annotation in annotations:
+        copy = qed_eval.QEDExample(**vars(annotation))
+        copy.example_id = annotation.example_id + i
+        if i % 3 == 0:
+          question, _ = copy.aligned_nps[0]
+          bridged = qed_eval.Entity(
+              start_offset=-1, end_offset=-1, type="context", text="",
+              normalized_text="")
+          copy.aligned_nps = [(question, bridged)] + copy.aligned_nps[1:]
+        self.annotation_dict[copy.example_id] = copy
+        if i % 4:
+          prediction = qed_eval.QEDExample(**vars(copy))
+          if i % 2:
+            prediction.aligned_nps = copy.aligned_nps[1:]
+          self.prediction_dict[copy.example_id] = prediction
+    example_counts = []
+    self.score_dict = qed_eval.compute_scores(
+        self.annotation_dict, self.prediction_dict, False,
+        example_counts=example_counts)
+    self.table = qed_slices.example_table(self.annotation_dict,
+                                          self.prediction_dict, example_counts)
+
+  def subset_scores(self, example_ids):
+    annotation_dict = {
+        example_id: self.annotation_dict[example_id]
+        for example_id in example_ids
+    }
+    return qed_eval.compute_scores(annotation_dict, self.prediction_dict, False)
+
+  def assertScoresEqual(self, first, second):
+    self.assertSameElements(first, second)
+    for metric in first:
+      np.testing.assert_allclose(first[metric], second[metric])
+
+  def test_example_table(self):
+    self.assertEqual(list(self.table["example_id"]), list(self.annotation_dict))
+    self.assertEqual(self.table["counts"].shape, (20, 12))
+    self.assertEqual(self.table["predicted"].sum(), len(self.prediction_dict))
+    self.assertEqual(
+        list(self.table["num_bridging"]),
+        [sum(c.start_offset == -1 for _, c in a.aligned_nps)
+         for a in self.annotation_dict.values()])
+    self.assertEqual(set(self.table["num_bridging"]), {0, 1, 2})
+    self.assertEqual(
+        list(self.table["num_aligned"]),
+        [len(a.aligned_nps) for a in self.annotation_dict.values()])
+    self.assertLen(set(self.table["title_hash"]), 2)
+    annotation = next(iter(self.annotation_dict.values()))
+    self.assertEqual(self.table["title_hash"][0],
+                     qed_slices.title_hash(annotation.title))
+    with self.assertRaises(ValueError):
+      qed_slices.example_table(self.annotation_dict, self.prediction_dict, [])
+
+  def test_write_and_load(self):
+    tmpdir = self.enter_context(tempfile.TemporaryDirectory())
+    fname = os.path.join(tmpdir, "examples.npz")
+    qed_slices.write_example_table(fname, self.table)
+    loaded = qed_slices.load_example_table(fname)
+    for name in qed_slices.COLUMNS:
+      np.testing.assert_array_equal(loaded[name], self.table[name])
+      self.assertEqual(loaded[name].dtype, self.table[name].dtype)
+    np.savez(fname, counts=self.table["counts"])
+    with self.assertRaisesRegex(ValueError, "example_id"):
+      qed_slices.load_example_table(fname)
+
+  def test_slice_scores(self):
+    everything = np.ones(len(self.annotation_dict), dtype=bool)
+    self.assertScoresEqual(
+        qed_slices.slice_scores(self.table, everything), self.score_dict)
+    bridged = self.table["num_bridging"] > 0
+    self.assertScoresEqual(
+        qed_slices.slice_scores(self.table, bridged),
+        self.subset_scores(self.table["example_id"][bridged]))
+    with self.assertRaises(ValueError):
+      qed_slices.slice_scores(self.table, ~everything)
+
+  def test_group_scores(self):
+    for column in ("num_aligned", "title_hash", "answer_correct"):
+      groups = qed_slices.group_scores(self.table, self.table[column])
+      self.assertLen(groups, len(set(self.table[column])))
+      for key, score_dict in groups.items():
+        self.assertScoresEqual(
+            score_dict,
+            self.subset_scores(
+                self.table["example_id"][self.table[column] == key]))
+    with self.assertRaises(ValueError):
+      qed_slices.group_scores(self.table, self.table["num_aligned"][1:])
+
+
+if __name__ == "__main__":
+  absltest.main()
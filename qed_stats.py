@@ -0,0 +1,257 @@
+r"""Bootstrap confidence intervals and significance tests for QED scores.
+
+compute_scores(..., example_counts=[]) reports the ScoreCounts of every
+annotated example. Since every QED metric is a function of counts summed over
+examples, a resample of the examples is scored by summing its count vectors.
+This module does that for thousands of resamples at once: resamples are drawn
+as a [num_samples, num_examples] matrix of example weights and the count sums
+of all of them are a single matrix product, from which P/R/F1 and accuracies
+are computed as array operations, as in compute_prf1 and scores_from_counts.
+
+Paired tests compare two prediction files on the same annotation file. Their
+count vectors must be aligned, i.e. come from compute_scores calls with the
+same annotation_dict.
+
+Like qed_vectorized, this module only depends on NumPy; count vectors are
+read by field name from the ScoreCounts.
+"""
+
+from typing import Any, Dict, Sequence, Text, Tuple, Union
+
+import numpy as np
+
+# ScoreCounts fields, in the column order of count arrays.
+COUNT_FIELDS = ('q_tp', 'q_tn', 'q_fn', 'c_tp', 'c_tn', 'c_fn', 'pair_tp',
+                'pair_tn', 'pair_fn', 'completely_correct', 'correct_answers',
+                'answers')
+_COLUMNS = {name: i for i, name in enumerate(COUNT_FIELDS)}
+
+# Metrics of the score dict. The mention and pair metrics are (P, R, F1).
+METRICS = ('exact_match_accuracy', 'question_mention', 'context_mention',
+           'all_mention', 'pair', 'answer_accuracy')
+
+# Upper bound on the number of entries of the weight matrices drawn at once.
+_MAX_WEIGHTS = 1 << 22
+
+Score = Union[float, Tuple[float, float, float]]
+
+
+def count_array(example_counts: Sequence[Any]) -> np.ndarray:
+  """Stacks per-example ScoreCounts into a [num_examples, 12] float array."""
+  return np.array(
+      [[getattr(counts, name) for name in COUNT_FIELDS]
+       for counts in example_counts],
+      dtype=np.float64).reshape(-1, len(COUNT_FIELDS))
+
+
+def _prf1(tp: np.ndarray, tn: np.ndarray,
+          fn: np.ndarray) -> np.ndarray:
+  """Vectorized compute_prf1, returning an [..., 3] array of P, R and F1."""
+  with np.errstate(divide='ignore', invalid='ignore'):
+    p = np.where(tp > 0, tp / (tp + fn), 0.0)
+    r = np.where(tp > 0, tp / (tp + tn), 0.0)
+    f1 = np.where(tp > 0, 2 * p * r / (p + r), 0.0)
+  return np.stack([p, r, f1], axis=-1)
+
+
+def scores_from_sums(sums: np.ndarray,
+                     num_annotations: int) -> Dict[Text, np.ndarray]:
+  """Vectorized scores_from_counts over any number of count sums.
+
+  Args:
+    sums: [..., 12] array of counts summed over examples.
+    num_annotations: number of annotated examples the sums were taken over.
+
+  Returns:
+    Dict from each of METRICS to an array of shape [...] for accuracies and
+    [..., 3] for (P, R, F1) metrics.
+  """
+  column = lambda name: sums[..., _COLUMNS[name]]
+  answers = column('answers')
+  with np.errstate(divide='ignore', invalid='ignore'):
+    answer_accuracy = np.where(answers > 0,
+                               column('correct_answers') / answers, 0.0)
+  return {
+      'exact_match_accuracy':
+          column('completely_correct') / num_annotations,
+      'question_mention':
+          _prf1(column('q_tp'), column('q_tn'), column('q_fn')),
+      'context_mention':
+          _prf1(column('c_tp'), column('c_tn'), column('c_fn')),
+      'all_mention':
+          _prf1(
+              column('q_tp') + column('c_tp'),
+              column('q_tn') + column('c_tn'),
+              column('q_fn') + column('c_fn')),
+      'pair':
+          _prf1(column('pair_tp'), column('pair_tn'), column('pair_fn')),
+      'answer_accuracy':
+          answer_accuracy,
+  }
+
+
+def _as_score(value: np.ndarray) -> Score:
+  """Turns a metric array into a score dict value."""
+  if value.ndim:
+    return tuple(float(v) for v in value)
+  return float(value)
+
+
+def _batches(num_samples: int, num_examples: int):
+  """Yields batch sizes so that each weight matrix has few enough entries."""
+  batch_size = max(1, _MAX_WEIGHTS // max(1, num_examples))
+  for start in range(0, num_samples, batch_size):
+    yield min(batch_size, num_samples - start)
+
+
+def _resampled_sums(counts: Sequence[np.ndarray], num_samples: int,
+                    rng: np.random.Generator) -> Sequence[np.ndarray]:
+  """Count sums of num_samples bootstrap resamples of each count array.
+
+  All arrays are resampled with the same example weights, which pairs them.
+
+  Args:
+    counts: [num_examples, 12] count arrays with aligned rows.
+    num_samples: number of resamples.
+    rng: random generator.
+
+  Returns:
+    One [num_samples, 12] array of resampled sums per count array.
+  """
+  num_examples = len(counts[0])
+  sums = [[] for _ in counts]
+  for batch_size in _batches(num_samples, num_examples):
+    # How often each example is drawn when drawing num_examples with
+    # replacement.
+    weights = rng.multinomial(
+        num_examples, np.full(num_examples, 1.0 / num_examples),
+        size=batch_size).astype(np.float64)
+    for batch_sums, array in zip(sums, counts):
+      batch_sums.append(weights @ array)
+  return [np.concatenate(s).reshape(-1, len(COUNT_FIELDS)) for s in sums]
+
+
+def bootstrap(counts: np.ndarray,
+              num_samples: int = 10000,
+              confidence: float = 0.95,
+              seed: int = 0) -> Dict[Text, Tuple[Score, Score]]:
+  """Percentile bootstrap confidence intervals of all metrics.
+
+  Args:
+    counts: [num_examples, 12] array from count_array.
+    num_samples: number of bootstrap resamples.
+    confidence: coverage of the intervals.
+    seed: seed of the resampling.
+
+  Returns:
+    Dict from each of METRICS to its (lower, upper) bound, where bounds of
+    (P, R, F1) metrics are triples like in the score dict.
+  """
+  if not len(counts):
+    raise ValueError('Cannot bootstrap scores of zero examples.')
+  rng = np.random.default_rng(seed)
+  sums, = _resampled_sums([counts], num_samples, rng)
+  scores = scores_from_sums(sums, len(counts))
+  tail = (1 - confidence) / 2 * 100
+  return {
+      metric: (_as_score(np.percentile(scores[metric], tail, axis=0)),
+               _as_score(np.percentile(scores[metric], 100 - tail, axis=0)))
+      for metric in METRICS
+  }
+
+
+def _differences(sums_a: np.ndarray, sums_b: np.ndarray,
+                 num_annotations: int) -> Dict[Text, np.ndarray]:
+  """Metric differences between system a and system b."""
+  scores_a = scores_from_sums(sums_a, num_annotations)
+  scores_b = scores_from_sums(sums_b, num_annotations)
+  return {metric: scores_a[metric] - scores_b[metric] for metric in METRICS}
+
+
+def _check_paired(counts_a: np.ndarray, counts_b: np.ndarray) -> None:
+  if counts_a.shape != counts_b.shape:
+    raise ValueError(
+        'Count arrays of shapes %s and %s are not aligned; score both '
+        'systems against the same annotation_dict.' %
+        (counts_a.shape, counts_b.shape))
+  if not len(counts_a):
+    raise ValueError('Cannot compare scores of zero examples.')
+
+
+def paired_bootstrap(counts_a: np.ndarray,
+                     counts_b: np.ndarray,
+                     num_samples: int = 10000,
+                     seed: int = 0) -> Dict[Text, Tuple[Score, Score]]:
+  """Paired bootstrap test of the difference between two systems.
+
+  Both systems are resampled with the same examples. The bootstrap
+  distribution of the difference is shifted to the null hypothesis of no
+  difference, so the p-value is the fraction of resampled differences that
+  are at least as far from the observed difference as it is from zero.
+
+  Args:
+    counts_a: [num_examples, 12] counts of the first system.
+    counts_b: counts of the second system, with rows aligned to counts_a.
+    num_samples: number of bootstrap resamples.
+    seed: seed of the resampling.
+
+  Returns:
+    Dict from each of METRICS to (observed difference a - b, two-sided
+    p-value), both triples for (P, R, F1) metrics.
+  """
+  _check_paired(counts_a, counts_b)
+  num_annotations = len(counts_a)
+  observed = _differences(counts_a.sum(axis=0), counts_b.sum(axis=0),
+                          num_annotations)
+  rng = np.random.default_rng(seed)
+  sums_a, sums_b = _resampled_sums([counts_a, counts_b], num_samples, rng)
+  resampled = _differences(sums_a, sums_b, num_annotations)
+  result = {}
+  for metric in METRICS:
+    shifted = np.abs(resampled[metric] - observed[metric])
+    p_value = (np.sum(shifted >= np.abs(observed[metric]), axis=0) +
+               1) / (num_samples + 1)
+    result[metric] = (_as_score(observed[metric]), _as_score(p_value))
+  return result
+
+
+def permutation_test(counts_a: np.ndarray,
+                     counts_b: np.ndarray,
+                     num_samples: int = 10000,
+                     seed: int = 0) -> Dict[Text, Tuple[Score, Score]]:
+  """Paired approximate randomization test between two systems.
+
+  Each sample swaps the outputs of the two systems on a random half of the
+  examples. The p-value is the fraction of samples whose absolute difference
+  is at least the observed one.
+
+  Args:
+    counts_a: [num_examples, 12] counts of the first system.
+    counts_b: counts of the second system, with rows aligned to counts_a.
+    num_samples: number of random permutations.
+    seed: seed of the permutations.
+
+  Returns:
+    Dict from each of METRICS to (observed difference a - b, two-sided
+    p-value), both triples for (P, R, F1) metrics.
+  """
+  _check_paired(counts_a, counts_b)
+  num_annotations = len(counts_a)
+  total_a, total_b = counts_a.sum(axis=0), counts_b.sum(axis=0)
+  observed = _differences(total_a, total_b, num_annotations)
+  delta = counts_b - counts_a
+  rng = np.random.default_rng(seed)
+  exceed = {metric: 0 for metric in METRICS}
+  for batch_size in _batches(num_samples, num_annotations):
+    swaps = rng.integers(
+        0, 2, size=(batch_size, num_annotations)).astype(np.float64)
+    moved = swaps @ delta
+    permuted = _differences(total_a + moved, total_b - moved, num_annotations)
+    for metric in METRICS:
+      exceed[metric] = exceed[metric] + np.sum(
+          np.abs(permuted[metric]) >= np.abs(observed[metric]) - 1e-12, axis=0)
+  return {
+      metric: (_as_score(observed[metric]),
+               _as_score((np.asarray(exceed[metric]) + 1) / (num_samples + 1)))
+      for metric in METRICS
+  }
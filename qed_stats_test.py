@@ -0,0 +1,91 @@
+# Lint as: python3
+"""Tests for qed_stats."""
+
+import json
+
+import numpy as np
+import qed_eval
+import qed_eval_test
+import qed_stats
+from absl.testing import absltest
+
+
+class QedStatsTest(absltest.TestCase):
+
+  def setUp(self):
+    super(QedStatsTest, self).setUp()
+    annotations = [
+        qed_eval.load_single_line(json.loads(example))
+        for example in (qed_eval_test.example_1, qed_eval_test.example_2)
+    ]
+    # Fifty copies of the two examples, with distinct ids.
+    self.annotation_dict = {}
+    for i in range(50):
+      for annotation in annotations:
+        copy = qed_eval.QEDExample(**vars(annotation))
+        copy.example_id = annotation.example_id + i
+        self.annotation_dict[copy.example_id] = copy
+    # A weaker system that only predicts the answers of some examples.
+    self.prediction_dict = {}
+    for i, (example_id, annotation) in enumerate(self.annotation_dict.items()):
+      if i % 3:
+        prediction = qed_eval.QEDExample(**vars(annotation))
+        if i % 2:
+          prediction.aligned_nps = []
+        self.prediction_dict[example_id] = prediction
+
+  def counts(self, prediction_dict, strict=False):
+    example_counts = []
+    score_dict = qed_eval.compute_scores(
+        self.annotation_dict, prediction_dict, strict,
+        example_counts=example_counts)
+    return score_dict, qed_stats.count_array(example_counts)
+
+  def test_scores_from_sums_matches_compute_scores(self):
+    for strict in (True, False):
+      score_dict, counts = self.counts(self.prediction_dict, strict)
+      self.assertEqual(counts.shape, (len(self.annotation_dict), 12))
+      scores = qed_stats.scores_from_sums(counts.sum(axis=0), len(counts))
+      for metric in qed_stats.METRICS:
+        np.testing.assert_allclose(scores[metric], score_dict[metric])
+
+  def test_bootstrap(self):
+    score_dict, counts = self.counts(self.prediction_dict)
+    intervals = qed_stats.bootstrap(counts, num_samples=2000)
+    self.assertEqual(intervals, qed_stats.bootstrap(counts, num_samples=2000))
+    lower, upper = intervals["exact_match_accuracy"]
+    self.assertLess(lower, score_dict["exact_match_accuracy"])
+    self.assertGreater(upper, score_dict["exact_match_accuracy"])
+    for bound in intervals["pair"]:
+      self.assertLen(bound, 3)
+    with self.assertRaises(ValueError):
+      qed_stats.bootstrap(counts[:0])
+
+  def test_paired_tests(self):
+    _, strong = self.counts(self.annotation_dict)
+    _, weak = self.counts(self.prediction_dict)
+    for test in (qed_stats.paired_bootstrap, qed_stats.permutation_test):
+      difference, p_value = test(strong, weak, num_samples=2000)["pair"]
+      self.assertGreater(difference[2], 0)
+      self.assertLess(p_value[2], 0.01)
+      self.assertEqual(
+          test(weak, weak, num_samples=100)["exact_match_accuracy"],
+          (0.0, 1.0))
+      with self.assertRaises(ValueError):
+        test(strong, weak[1:])
+
+  def test_example_counts_with_workers(self):
+    serial, parallel = [], []
+    for strict in (True, False):
+      qed_eval.compute_scores(
+          self.annotation_dict, self.prediction_dict, strict,
+          example_counts=serial)
+      qed_eval.compute_scores(
+          self.annotation_dict, self.prediction_dict, strict, num_workers=2,
+          example_counts=parallel)
+    self.assertEqual(serial, parallel)
+    self.assertIn(qed_eval.ScoreCounts(), serial)
+
+
+if __name__ == "__main__":
+  absltest.main()
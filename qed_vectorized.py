@@ -0,0 +1,236 @@
+r"""NumPy implementation of non-strict QED scoring over batches of examples.
+
+compute_mention_score and compute_alignment_score in qed_eval compare every
+annotated entity against every predicted entity of the same example with one
+Python call to overlap() per comparison. This module computes the same
+comparisons for a whole batch of examples at once: the entities of all
+examples are laid out in flat arrays, every (annotation, prediction) pair that
+belongs to the same example is enumerated with array arithmetic, and the
+overlap F1 of all those pairs is computed in one go and reduced back to
+per-example tp/tn/fn counts.
+
+The results are identical to the pure Python implementation, including the
+handling of the -1 offsets of bridged context entities.
+
+This module only depends on NumPy. Examples are duck-typed (anything with
+aligned_nps of entities that have start_offset, end_offset and
+normalized_text), so qed_core can import it lazily without a circular import.
+"""
+
+from typing import (Any, Dict, List, MutableMapping, Optional, Sequence, Text,
+                    Tuple)
+
+import numpy as np
+
+
+def overlap_f1(starts1: np.ndarray, ends1: np.ndarray, starts2: np.ndarray,
+               ends2: np.ndarray) -> np.ndarray:
+  """Elementwise overlap F1 of two arrays of spans, as used by overlap().
+
+  Args:
+    starts1: start offsets of the first entity of each pair.
+    ends1: end offsets of the first entity of each pair.
+    starts2: start offsets of the second entity of each pair.
+    ends2: end offsets of the second entity of each pair.
+
+  Returns:
+    Float array with the F1 of each pair. Pairs involving a -1 offset are not
+    handled here, see overlaps().
+  """
+  tp = np.abs(ends1 - starts2)
+  fn = np.abs(starts2 - starts1)
+  fp = np.abs(ends2 - ends1)
+  f1 = np.zeros(tp.shape, dtype=np.float64)
+  np.divide(tp, tp + (fp + fn) / 2, out=f1, where=tp != 0)
+  return f1
+
+
+def overlaps(starts1: np.ndarray, ends1: np.ndarray, starts2: np.ndarray,
+             ends2: np.ndarray, min_f1: float) -> np.ndarray:
+  """Elementwise version of qed_eval.overlap() over arrays of spans.
+
+  Args:
+    starts1: start offsets of the first entity of each pair.
+    ends1: end offsets of the first entity of each pair.
+    starts2: start offsets of the second entity of each pair.
+    ends2: end offsets of the second entity of each pair.
+    min_f1: minimum overlap F1 for two spans to match, i.e.
+      qed_eval.MIN_F1_FOR_NON_STRICT_OVERLAP.
+
+  Returns:
+    Boolean array with one value per pair.
+  """
+  sentinel1 = (starts1 == -1) | (ends1 == -1)
+  sentinel2 = (starts2 == -1) | (ends2 == -1)
+  both_bridged = ((starts1 == -1) & (ends1 == -1) & (starts2 == -1) &
+                  (ends2 == -1))
+  f1 = overlap_f1(starts1, ends1, starts2, ends2)
+  return np.where(sentinel1 | sentinel2, both_bridged,
+                  f1 >= min_f1)
+
+
+def _pair_indices(
+    annotation_example: np.ndarray, prediction_offsets: np.ndarray,
+    prediction_counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  """Enumerates all (annotation, prediction) index pairs within each example.
+
+  Args:
+    annotation_example: example index of each annotated item.
+    prediction_offsets: index of the first predicted item of each example.
+    prediction_counts: number of predicted items of each example.
+
+  Returns:
+    Two equally long arrays holding the annotation and prediction index of
+    each pair.
+  """
+  per_annotation = prediction_counts[annotation_example]
+  pair_annotation = np.repeat(
+      np.arange(len(annotation_example)), per_annotation)
+  first_pair = np.cumsum(per_annotation) - per_annotation
+  pair_prediction = (
+      np.arange(len(pair_annotation)) - np.repeat(first_pair, per_annotation) +
+      np.repeat(prediction_offsets[annotation_example], per_annotation))
+  return pair_annotation, pair_prediction
+
+
+class _AlignedNpArrays:
+  """Flat arrays describing the aligned_nps of a batch of examples."""
+
+  def __init__(self, aligned_nps_per_example: Sequence[Sequence[Tuple[Any,
+                                                                      Any]]],
+               text_ids: Dict[Text, int]):
+    self.counts = np.array([len(nps) for nps in aligned_nps_per_example],
+                           dtype=np.int64)
+    self.offsets = np.cumsum(self.counts) - self.counts
+    self.example = np.repeat(np.arange(len(self.counts)), self.counts)
+    starts, ends, texts = [], [], []
+    for nps in aligned_nps_per_example:
+      columns = getattr(nps, 'columns', None)
+      if columns is not None:
+        # A qed_eval.AlignedEntityList, read column-wise from its store.
+        nps_starts, nps_ends, nps_texts = columns()
+        starts.extend(nps_starts)
+        ends.extend(nps_ends)
+        texts.extend(nps_texts)
+      else:
+        for q, c in nps:
+          starts += (q.start_offset, c.start_offset)
+          ends += (q.end_offset, c.end_offset)
+          texts += (q.normalized_text, c.normalized_text)
+    # Columns 0 and 1 describe question entities, 2 and 3 context entities.
+    self.spans = np.stack(
+        [np.array(starts, dtype=np.int64),
+         np.array(ends, dtype=np.int64)], axis=1).reshape(-1, 4)
+    self.texts = np.array(
+        [text_ids.setdefault(text, len(text_ids)) for text in texts],
+        dtype=np.int64).reshape(-1, 2)
+
+
+def _entity_matches(annot: _AlignedNpArrays, pred: _AlignedNpArrays,
+                    pair_a: np.ndarray, pair_p: np.ndarray, column: int,
+                    min_f1: float,
+                    counters: Optional[MutableMapping[Text, int]]
+                   ) -> np.ndarray:
+  """Whether the entities in the given column match for each pair.
+
+  Two entities match if their normalized texts are equal and the predicted one
+  overlaps the annotated one, as in the non-strict branches of
+  compute_mention_score and compute_alignment_score.
+
+  Args:
+    annot: annotated aligned_nps.
+    pred: predicted aligned_nps.
+    pair_a: annotation index of each pair.
+    pair_p: prediction index of each pair.
+    column: 0 for question entities, 1 for context entities.
+    min_f1: minimum overlap F1 for two entities to match.
+    counters: if given, incremented at 'overlap_comparisons' by the number of
+      overlaps computed.
+
+  Returns:
+    Boolean array with one value per pair.
+  """
+  candidates = np.flatnonzero(
+      annot.texts[pair_a, column] == pred.texts[pair_p, column])
+  a, p = pair_a[candidates], pair_p[candidates]
+  if counters is not None:
+    counters['overlap_comparisons'] += len(candidates)
+  match = np.zeros(len(pair_a), dtype=bool)
+  # overlap() is called with the prediction first.
+  match[candidates] = overlaps(pred.spans[p, 2 * column],
+                               pred.spans[p, 2 * column + 1],
+                               annot.spans[a, 2 * column],
+                               annot.spans[a, 2 * column + 1], min_f1)
+  return match
+
+
+def _counts(annot: _AlignedNpArrays, pred: _AlignedNpArrays, min_f1: float,
+            counters: Optional[MutableMapping[Text, int]]) -> np.ndarray:
+  """Per-example counts of annotated and predicted aligned_nps of a batch."""
+  pair_a, pair_p = _pair_indices(annot.example, pred.offsets, pred.counts)
+  q_match = _entity_matches(annot, pred, pair_a, pair_p, 0, min_f1, counters)
+  c_match = _entity_matches(annot, pred, pair_a, pair_p, 1, min_f1, counters)
+  columns = []
+  for match in (q_match, c_match, q_match & c_match):
+    # An annotated item counts once however many predictions it matches.
+    found = np.zeros(len(annot.example), dtype=bool)
+    found[pair_a[match]] = True
+    tp = np.bincount(annot.example[found], minlength=len(annot.counts))
+    columns.extend([tp, annot.counts - tp, pred.counts - tp])
+  return np.stack(columns, axis=1).astype(np.int64).reshape(-1, 9)
+
+
+def mention_and_alignment_counts(
+    pairs: Sequence[Tuple[Any, Any]],
+    min_f1: float,
+    counters: Optional[MutableMapping[Text, int]] = None) -> np.ndarray:
+  """Non-strict counts of each (annotation, prediction) pair.
+
+  Args:
+    pairs: (annotation, prediction) QEDExample pairs to score.
+    min_f1: minimum overlap F1 for two entities to match, i.e.
+      qed_eval.MIN_F1_FOR_NON_STRICT_OVERLAP.
+    counters: if given, incremented at 'overlap_comparisons' by the number of
+      overlaps computed, i.e. of entity pairs with equal normalized texts.
+
+  Returns:
+    Int array of shape [len(pairs), 9] whose columns are the question mention,
+    context mention and pair tp/tn/fn, in that order.
+  """
+  text_ids = {}
+  annot = _AlignedNpArrays([a.aligned_nps for a, _ in pairs], text_ids)
+  pred = _AlignedNpArrays([p.aligned_nps for _, p in pairs], text_ids)
+  return _counts(annot, pred, min_f1, counters)
+
+
+def multi_system_counts(
+    annotations: Sequence[Any],
+    predictions: Sequence[Sequence[Optional[Any]]],
+    min_f1: float,
+    counters: Optional[MutableMapping[Text, int]] = None) -> List[np.ndarray]:
+  """Non-strict counts of several systems' predictions of the same examples.
+
+  The arrays of the annotations are built once and shared by all systems.
+
+  Args:
+    annotations: annotated QEDExamples.
+    predictions: for each system, its predicted QEDExample of each annotation,
+      or None where it has no prediction.
+    min_f1: minimum overlap F1 for two entities to match, i.e.
+      qed_eval.MIN_F1_FOR_NON_STRICT_OVERLAP.
+    counters: passed on as in mention_and_alignment_counts.
+
+  Returns:
+    For each system, an int array of shape [len(annotations), 9] like the one
+    of mention_and_alignment_counts. Rows of missing predictions are to be
+    ignored.
+  """
+  text_ids = {}
+  annot = _AlignedNpArrays([a.aligned_nps for a in annotations], text_ids)
+  return [
+      _counts(
+          annot,
+          _AlignedNpArrays(
+              [p.aligned_nps if p is not None else () for p in system],
+              text_ids), min_f1, counters) for system in predictions
+  ]
@@ -0,0 +1,104 @@
+# Lint as: python3
+"""Tests for qed_vectorized."""
+
+import random
+
+import numpy as np
+import qed_eval
+import qed_vectorized
+from absl.testing import absltest
+
+
+def random_entity(rng, entity_type):
+  if entity_type == "context" and rng.random() < 0.2:
+    start, end = -1, -1
+  else:
+    start = rng.randrange(-1, 30)
+    end = max(-1, start + rng.randrange(-1, 20))
+  return qed_eval.Entity(
+      start_offset=start,
+      end_offset=end,
+      type=entity_type,
+      text="",
+      normalized_text=rng.choice(["a", "b"]))
+
+
+def random_example(rng, example_id, num_nps):
+  aligned_nps = [(random_entity(rng, "question"), random_entity(rng, "context"))
+                 for _ in range(num_nps)]
+  return qed_eval.QEDExample(
+      example_id=example_id,
+      title="",
+      question="",
+      answer=[],
+      nq_answers=[],
+      aligned_nps=aligned_nps,
+      explanation_type="single_sentence")
+
+
+def jitter(rng, entity):
+  if entity.start_offset == -1 or rng.random() < 0.3:
+    return entity
+  shift = rng.randrange(-1, 2)
+  return qed_eval.Entity(
+      start_offset=entity.start_offset + shift,
+      end_offset=max(-1, entity.end_offset + rng.randrange(-1, 2)),
+      type=entity.type,
+      text="",
+      normalized_text=entity.normalized_text)
+
+
+def random_pair(rng, example_id):
+  annotation = random_example(rng, example_id, rng.randrange(0, 5))
+  prediction = random_example(rng, example_id, rng.randrange(0, 3))
+  prediction.aligned_nps.extend((jitter(rng, q), jitter(rng, c))
+                                for q, c in annotation.aligned_nps
+                                if rng.random() < 0.8)
+  rng.shuffle(prediction.aligned_nps)
+  return annotation, prediction
+
+
+class QedVectorizedTest(absltest.TestCase):
+
+  def test_overlaps_matches_overlap(self):
+    offsets = list(range(-1, 25))
+    spans = [(s, e) for s in offsets for e in offsets]
+    rng = random.Random(0)
+    pairs = [(rng.choice(spans), rng.choice(spans)) for _ in range(20000)]
+    pairs += [((-1, -1), (-1, -1)), ((-1, 5), (-1, -1)), ((3, -1), (3, -1)),
+              ((-1, -1), (0, 0)), ((4, 10), (4, 10)), ((3, 3), (3, 3))]
+    arrays = np.array([s1 + s2 for s1, s2 in pairs], dtype=np.int64).T
+    result = qed_vectorized.overlaps(
+        *arrays, min_f1=qed_eval.MIN_F1_FOR_NON_STRICT_OVERLAP)
+    for (span1, span2), got in zip(pairs, result):
+      ent1 = qed_eval.Entity(span1[0], span1[1], "context", "", "")
+      ent2 = qed_eval.Entity(span2[0], span2[1], "context", "", "")
+      self.assertEqual(got, qed_eval.overlap(ent1, ent2), (span1, span2))
+
+  def test_counts_match_score_example(self):
+    rng = random.Random(1)
+    pairs = [random_pair(rng, i) for i in range(500)]
+    counts = qed_vectorized.mention_and_alignment_counts(
+        pairs, qed_eval.MIN_F1_FOR_NON_STRICT_OVERLAP)
+    self.assertEqual(counts.shape, (500, 9))
+    for (annotation, prediction), row in zip(pairs, counts):
+      expected = qed_eval.score_example(annotation, prediction, False)
+      self.assertEqual(
+          list(row),
+          [expected.q_tp, expected.q_tn, expected.q_fn, expected.c_tp,
+           expected.c_tn, expected.c_fn, expected.pair_tp, expected.pair_tn,
+           expected.pair_fn])
+    self.assertGreater(counts[:, 6].sum(), 0)
+
+  def test_counts_without_predicted_nps(self):
+    rng = random.Random(2)
+    pairs = [(random_example(rng, 0, 3), random_example(rng, 0, 0))]
+    counts = qed_vectorized.mention_and_alignment_counts(
+        pairs, qed_eval.MIN_F1_FOR_NON_STRICT_OVERLAP)
+    self.assertEqual(list(counts[0, 6:]), [0, 3, 0])
+    self.assertEqual(
+        qed_vectorized.mention_and_alignment_counts(
+            [], qed_eval.MIN_F1_FOR_NON_STRICT_OVERLAP).shape, (0, 9))
+
+if __name__ == "__main__":
+  absltest.main()